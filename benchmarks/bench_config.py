@@ -0,0 +1,52 @@
+""" Config generation: rendering, option handling and writing vhost files
+"""
+import pytest
+
+from jhubnginx import utils
+from jhubnginx._impl import render_vhost
+
+from conftest import domain_names
+
+
+@pytest.mark.parametrize('n', [1, 1000])
+def test_render_vhost(benchmark, sandbox, n):
+    domains = domain_names(n)
+    render_vhost(domains[0], sandbox)  # compile template outside of timing
+
+    benchmark(lambda: [render_vhost(d, sandbox, backends=['127.0.0.1:8000']) for d in domains])
+
+
+def test_default_opts(benchmark):
+    benchmark(utils.default_opts)
+
+
+def test_default_opts_merge(benchmark, sandbox):
+    benchmark(utils.default_opts, sandbox)
+
+
+@pytest.mark.parametrize('n', [1, 1000])
+def test_opts_update_from_env(benchmark, monkeypatch, n):
+    monkeypatch.setenv('BENCH_TOKEN', 'secret')
+    opts = utils.default_opts()
+    opts['hubs'] = {d: dict(token='env/BENCH_TOKEN', port=8000, tags=['a', 'b'])
+                    for d in domain_names(n)}
+
+    benchmark(utils.opts_update_from_env, opts)
+
+
+@pytest.mark.parametrize('changed', [False, True], ids=['same', 'changed'])
+@pytest.mark.parametrize('n', [1, 1000])
+def test_write_if_different(benchmark, tmp_path, sandbox, n, changed):
+    files = [(str(tmp_path/(d + '.conf')), render_vhost(d, sandbox)) for d in domain_names(n)]
+    for fname, txt in files:
+        utils.write_if_different(fname, txt)
+
+    flip = [False]
+
+    def run():
+        flip[0] = not flip[0]
+        suffix = '#\n' if changed and flip[0] else ''
+        for fname, txt in files:
+            utils.write_if_different(fname, txt + suffix)
+
+    benchmark(run)
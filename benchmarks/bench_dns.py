@@ -0,0 +1,26 @@
+""" DNS checks with stubbed resolvers, measures our own overhead only
+"""
+import pytest
+
+from jhubnginx import dns
+
+from conftest import domain_names, PUBLIC_IP
+
+
+def test_check_dns_up_to_date(benchmark, sandbox, stub_dns):
+    assert benchmark(dns.check_dns, 'hub.bench.example.com', opts=sandbox) is True
+
+
+def test_check_dns_update(benchmark, sandbox, stub_dns):
+    def run():
+        stub_dns['hub.bench.example.com'] = '198.51.100.1'
+        return dns.check_dns('hub.bench.example.com', opts=sandbox)
+
+    assert benchmark(run) is True
+
+
+@pytest.mark.parametrize('n', [1, 1000])
+def test_check_dns_many(benchmark, sandbox, stub_dns, n):
+    domains = domain_names(n)
+    out = benchmark(dns.check_dns_many, domains, public_ip=PUBLIC_IP, opts=sandbox)
+    assert all(ok for ok, _ in out.values())
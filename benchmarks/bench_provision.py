@@ -0,0 +1,59 @@
+""" Full add_or_check_vhost(s) runs against fake certbot/nginx executables
+"""
+import shutil
+
+import pytest
+
+from jhubnginx import add_or_check_vhost, add_or_check_vhosts, apply_hubs, parse_desired
+
+from conftest import domain_names
+
+
+def _reset(opts):
+    for path in (opts['nginx']['sites'], opts['nginx']['ssl_root'], opts['state_dir']):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def test_add_one_new(benchmark, sandbox, stub_dns, capsys):
+    benchmark.pedantic(add_or_check_vhost, args=('hub.bench.example.com',),
+                       kwargs=dict(opts=sandbox),
+                       setup=lambda: _reset(sandbox),
+                       rounds=10)
+
+
+@pytest.mark.parametrize('reverify_interval', [0, 21600])
+def test_add_one_existing(benchmark, sandbox, stub_dns, capsys, reverify_interval):
+    sandbox['manifest']['reverify_interval'] = reverify_interval
+    add_or_check_vhost('hub.bench.example.com', opts=sandbox)
+    benchmark(add_or_check_vhost, 'hub.bench.example.com', opts=sandbox)
+
+
+@pytest.mark.parametrize('layout', ['per_vhost', 'consolidated'])
+@pytest.mark.parametrize('n', [1000])
+def test_add_many_new(benchmark, sandbox, stub_dns, capsys, n, layout):
+    sandbox['nginx']['layout'] = layout
+    domains = domain_names(n)
+    benchmark.pedantic(add_or_check_vhosts, args=(domains,),
+                       kwargs=dict(opts=sandbox),
+                       setup=lambda: _reset(sandbox),
+                       rounds=3)
+
+
+@pytest.mark.parametrize('layout', ['per_vhost', 'consolidated'])
+@pytest.mark.parametrize('n', [1000])
+def test_add_many_existing(benchmark, sandbox, stub_dns, capsys, n, layout):
+    sandbox['nginx']['layout'] = layout
+    domains = domain_names(n)
+    add_or_check_vhosts(domains, opts=sandbox)
+    benchmark.pedantic(add_or_check_vhosts, args=(domains,),
+                       kwargs=dict(opts=sandbox),
+                       rounds=3)
+
+
+@pytest.mark.parametrize('layout', ['per_vhost', 'consolidated'])
+@pytest.mark.parametrize('n', [300])
+def test_apply_unchanged(benchmark, sandbox, stub_dns, capsys, n, layout):
+    sandbox['nginx']['layout'] = layout
+    desired = parse_desired(domain_names(n))
+    apply_hubs(desired, sandbox)
+    benchmark(apply_hubs, desired, sandbox)
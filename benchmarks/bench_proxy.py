@@ -0,0 +1,47 @@
+""" Smoke test for the proxy benchmark harness, real nginx is only needed to start it
+"""
+import shutil
+import subprocess
+from types import SimpleNamespace
+
+import pytest
+import yaml
+
+import proxy
+
+
+def _nginx_with_http3():
+    nginx = shutil.which('nginx')
+    if nginx is None:
+        return None
+    info = subprocess.run([nginx, '-V'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
+    return nginx if b'http_v3_module' in info else None
+
+
+@pytest.fixture
+def quic_config(tmp_path):
+    cfg = tmp_path/'quic.yml'
+    cfg.write_text(yaml.safe_dump({'nginx': {'tls': {'profile': 'performance', 'http3': True}}}))
+    return str(cfg)
+
+
+def test_proxy_harness_quic(quic_config):
+    if shutil.which('openssl') is None:
+        pytest.skip('needs openssl for the self-signed certificate')
+    srv = proxy.Nginx(_nginx_with_http3() or 'nginx', quic_config, SimpleNamespace(port=8000))
+    try:
+        sites = srv.root + '/sites'
+        shared = open(sites + '/00-jhub-vhost.conf').read()
+        vhost = open(sites + '/{}.conf'.format(proxy.DOMAIN)).read()
+
+        assert 'listen 127.0.0.1:{} quic reuseport;'.format(srv.https_port) in shared
+        assert 'listen 127.0.0.1:{} quic;'.format(srv.https_port) in vhost
+        for txt in (shared, vhost):
+            assert 'listen 443' not in txt
+            assert 'listen 80;' not in txt
+
+        if _nginx_with_http3() is None:
+            pytest.skip('needs nginx built with http_v3 module')
+        srv.start()
+    finally:
+        srv.stop()
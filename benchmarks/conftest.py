@@ -0,0 +1,92 @@
+""" Fixtures shared by the micro-benchmarks.
+
+Nothing here talks to the network or to real nginx/certbot: fake executables
+are put on PATH and DNS lookups are answered from a dictionary.
+"""
+import os
+import stat
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from jhubnginx import utils, dns  # noqa: E402
+
+PUBLIC_IP = '203.0.113.10'
+
+FAKE_CERTBOT = '''#!/bin/sh
+# writes empty certificate files for --cert-name or every --domains
+name=""
+prev=""
+for a in "$@"; do
+  case "$prev" in --cert-name) name=$a;; esac
+  prev=$a
+done
+prev=""
+for a in "$@"; do
+  case "$prev" in
+    --domains)
+      d=${name:-$a}
+      mkdir -p "$SSL_ROOT/$d"
+      touch "$SSL_ROOT/$d/privkey.pem" "$SSL_ROOT/$d/fullchain.pem" "$SSL_ROOT/$d/cert.pem";;
+  esac
+  prev=$a
+done
+'''
+
+FAKE_NGINX = '''#!/bin/sh
+exit 0
+'''
+
+
+def domain_names(n):
+    return ['hub{:04d}.bench.example.com'.format(i) for i in range(n)]
+
+
+def _write_exe(path, txt):
+    with open(str(path), 'w') as f:
+        f.write(txt)
+    os.chmod(str(path), os.stat(str(path)).st_mode | stat.S_IXUSR)
+
+
+@pytest.fixture
+def sandbox(tmp_path, monkeypatch):
+    """ opts pointing all nginx/letsencrypt/state locations into tmp_path,
+        with fake certbot and nginx on PATH
+    """
+    bin_dir = tmp_path/'bin'
+    bin_dir.mkdir()
+    _write_exe(bin_dir/'certbot', FAKE_CERTBOT)
+    _write_exe(bin_dir/'nginx', FAKE_NGINX)
+
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ.get('PATH', ''))
+    monkeypatch.setenv('SSL_ROOT', str(tmp_path/'ssl'))
+
+    return utils.default_opts({
+        'nginx': {'sites': str(tmp_path/'sites'),
+                  'ssl_root': str(tmp_path/'ssl'),
+                  'check_cmd': 'nginx -t',
+                  'reload_cmd': 'nginx -s reload',
+                  'access_log': {'path': str(tmp_path/'log')}},
+        'letsencrypt': {'webroot': str(tmp_path/'www'),
+                        'email': 'bench@example.com'},
+        'state_dir': str(tmp_path/'state'),
+    })
+
+
+@pytest.fixture
+def stub_dns(monkeypatch):
+    """ Every domain resolves to PUBLIC_IP unless listed in the returned dictionary
+    """
+    records = {}
+
+    monkeypatch.setattr(utils, 'public_ip', lambda opts=None, refresh=False: PUBLIC_IP)
+    monkeypatch.setattr(utils, 'resolve_hostname', lambda domain, use_dig=False: records.get(domain, PUBLIC_IP))
+
+    def update_dns_many(pairs, opts):
+        records.update(pairs)
+        return {domain: (True, '') for domain, _ in pairs}
+
+    monkeypatch.setattr(dns, 'update_dns', lambda domain, ip, opts: update_dns_many([(domain, ip)], opts) and True)
+    monkeypatch.setattr(dns, 'update_dns_many', update_dns_many)
+    return records
@@ -0,0 +1,78 @@
+""" Import time budget for the command line tool.
+
+Runs `python -X importtime` for a number of jhub-vhost startup scenarios and
+fails if any of them goes over the time budget or loads modules it has no use
+for. Takes the best of several runs to reduce noise.
+
+    python benchmarks/importtime.py [--budget-ms 150] [--runs 5]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (name, code to run, modules that must not be imported)
+SCENARIOS = [
+    ('help',
+     "from jhubnginx.app import cli; cli(['--help'])",
+     ['jinja2', 'requests', 'yaml', 'boto3', 'libcloud']),
+    ('remove --help',
+     "from jhubnginx.app import cli; cli(['remove', '--help'])",
+     ['jinja2', 'requests', 'boto3', 'libcloud']),
+    ('import _impl',
+     "import jhubnginx._impl",
+     ['jinja2', 'requests', 'boto3', 'libcloud']),
+    ('import jhubnginx',
+     "import jhubnginx",
+     ['jinja2', 'requests', 'yaml', 'boto3', 'libcloud', 'jhubnginx._impl']),
+]
+
+
+def import_times(code):
+    """ Returns (total_us, {module: cumulative_us}) for running code in a fresh interpreter.
+
+    Total only counts top level imports triggered by code, not interpreter startup.
+    """
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import sys; sys.stderr.write("---\\n");' + code],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env)
+    lines = p.stderr.decode('utf-8').splitlines()
+    lines = lines[lines.index('---') + 1:] if '---' in lines else lines
+
+    total, modules = 0, {}
+    for line in lines:
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        modules[name.strip()] = int(cumulative_us)
+        if len(name) - len(name.lstrip()) == 1:
+            total += int(cumulative_us)
+
+    return total, modules
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=150, help='Import time budget per scenario')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs, best one is reported')
+    args = parser.parse_args(args)
+
+    failed = False
+    for name, code, forbidden in SCENARIOS:
+        runs = [import_times(code) for _ in range(args.runs)]
+        total_us, modules = min(runs, key=lambda r: r[0])
+        loaded = [m for m in forbidden if any(k == m or k.startswith(m + '.') for k in modules)]
+        ok = total_us/1000 <= args.budget_ms and not loaded
+        failed = failed or not ok
+
+        print('{:<20} {:8.1f} ms {}{}'.format(name, total_us/1000,
+                                              'ok' if ok else 'FAIL',
+                                              ' loaded: ' + ', '.join(loaded) if loaded else ''))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,435 @@
+""" End-to-end proxy benchmark for generated vhost configs.
+
+Renders a vhost with `render_vhost`, runs a local nginx with it and a
+self-signed certificate in front of a stub JupyterHub (HTTP plus websocket
+echo), then drives load at it from this process. Everything listens on
+127.0.0.1, no outside services are used.
+
+Reports requests/second and p50/p99 latency over keep-alive connections, full
+and resumed TLS handshakes per second and nginx memory per open websocket.
+Every `--config` file is a profile, results are printed side by side:
+
+    python benchmarks/proxy.py -c default.yml -c perf.yml [--duration 10] [--json out.json]
+
+Needs nginx on PATH (or --nginx) and openssl for the certificate.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+DOMAIN = 'hub.bench.test'
+WS_MAGIC = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+NGINX_CONF = '''
+worker_processes {workers};
+daemon off;
+pid {root}/nginx.pid;
+error_log {root}/error.log error;
+
+events {{
+    worker_connections 65535;
+}}
+
+http {{
+    access_log off;
+    client_body_temp_path {root}/tmp/client_body;
+    proxy_temp_path {root}/tmp/proxy;
+    fastcgi_temp_path {root}/tmp/fastcgi;
+    uwsgi_temp_path {root}/tmp/uwsgi;
+    scgi_temp_path {root}/tmp/scgi;
+
+    include {root}/sites/*.conf;
+}}
+'''
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values)*p/100))]
+
+
+# ---------------------------------------------------------------- stub hub
+
+async def _read_head(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    method, path, _ = lines[0].split(' ', 2)
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            k, v = line.split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+    return method, path, headers
+
+
+async def ws_read_frame(reader):
+    b0, b1 = await reader.readexactly(2)
+    n = b1 & 0x7f
+    if n == 126:
+        n, = struct.unpack('!H', await reader.readexactly(2))
+    elif n == 127:
+        n, = struct.unpack('!Q', await reader.readexactly(8))
+    mask = await reader.readexactly(4) if b1 & 0x80 else None
+    data = await reader.readexactly(n)
+    if mask:
+        data = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+    return b0 & 0x0f, data
+
+
+def ws_frame(data, opcode=1, mask=False):
+    head = bytes([0x80 | opcode])
+    n = len(data)
+    bit = 0x80 if mask else 0
+    if n < 126:
+        head += bytes([bit | n])
+    elif n < 65536:
+        head += bytes([bit | 126]) + struct.pack('!H', n)
+    else:
+        head += bytes([bit | 127]) + struct.pack('!Q', n)
+    if mask:
+        key = os.urandom(4)
+        return head + key + bytes(b ^ key[i % 4] for i, b in enumerate(data))
+    return head + data
+
+
+class StubHub(object):
+    """ Answers every request with a fixed body, echoes websocket messages
+    """
+    def __init__(self, body_size=1024):
+        self.body = b'{"x": "' + b'a'*max(0, body_size - 9) + b'"}'
+        self.port = free_port()
+        self._loop = None
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                method, path, headers = await _read_head(reader)
+                if headers.get('upgrade', '').lower() == 'websocket':
+                    accept = base64.b64encode(hashlib.sha1((headers['sec-websocket-key'] + WS_MAGIC)
+                                                           .encode()).digest()).decode()
+                    writer.write(('HTTP/1.1 101 Switching Protocols\r\n'
+                                  'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                                  'Sec-WebSocket-Accept: {}\r\n\r\n').format(accept).encode())
+                    while True:
+                        opcode, data = await ws_read_frame(reader)
+                        if opcode == 8:
+                            return
+                        writer.write(ws_frame(data, opcode))
+                        await writer.drain()
+
+                if 'content-length' in headers:
+                    await reader.readexactly(int(headers['content-length']))
+
+                ctype = 'application/javascript' if '/static/' in path else 'application/json'
+                writer.write(('HTTP/1.1 200 OK\r\nContent-Type: {}\r\nContent-Length: {}\r\n'
+                              'Cache-Control: max-age=3600\r\n\r\n').format(ctype, len(self.body)).encode()
+                             + self.body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            srv = self._loop.run_until_complete(asyncio.start_server(self._handle, '127.0.0.1', self.port,
+                                                                     backlog=4096))
+            ready.set()
+            self._loop.run_until_complete(srv.serve_forever())
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+        return self
+
+
+# ---------------------------------------------------------------- nginx
+
+def self_signed(ssl_dir, key_type='rsa'):
+    os.makedirs(ssl_dir, exist_ok=True)
+    newkey = ['-newkey', 'rsa:2048'] if key_type == 'rsa' else ['-newkey', 'ec', '-pkeyopt',
+                                                                'ec_paramgen_curve:P-256']
+    subprocess.check_call(['openssl', 'req', '-x509', '-nodes', '-days', '2', '-subj', '/CN=' + DOMAIN,
+                           '-addext', 'subjectAltName=DNS:' + DOMAIN,
+                           '-keyout', os.path.join(ssl_dir, 'privkey.pem'),
+                           '-out', os.path.join(ssl_dir, 'fullchain.pem')] + newkey,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class Nginx(object):
+    def __init__(self, nginx, config, hub, workers=1):
+        from jhubnginx import utils
+        from jhubnginx._impl import render_vhost, write_shared_config
+
+        self.root = tempfile.mkdtemp(prefix='jhub-proxy-bench-')
+        self.http_port = free_port()
+        self.https_port = free_port()
+        self._nginx = nginx
+
+        if config:
+            import yaml
+            with open(config) as f:
+                opts = utils.default_opts(yaml.safe_load(f))
+        else:
+            opts = utils.default_opts()
+
+        opts['nginx']['sites'] = os.path.join(self.root, 'sites')
+        opts['nginx']['ssl_root'] = os.path.join(self.root, 'ssl')
+        opts['nginx']['static_cache']['path'] = os.path.join(self.root, 'cache')
+        opts['nginx']['access_log']['path'] = os.path.join(self.root, 'log')
+        opts['state_dir'] = os.path.join(self.root, 'state')
+        os.makedirs(os.path.join(self.root, 'tmp'))
+
+        self_signed(os.path.join(self.root, 'ssl', DOMAIN))
+        if opts['letsencrypt'].get('ecdsa'):
+            self_signed(os.path.join(self.root, 'ssl', DOMAIN + '-ecdsa'), 'ecdsa')
+
+        txt = render_vhost(DOMAIN, opts, backends=['127.0.0.1:{}'.format(hub.port)])
+        shared = write_shared_config(opts)
+        # shared config has its own listeners (QUIC reuseport), move them too
+        shared.txt = self._local_ports(shared.txt)
+        shared.apply()
+        with open(os.path.join(self.root, 'sites', DOMAIN + '.conf'), 'w') as f:
+            f.write(self._local_ports(txt))
+
+        with open(os.path.join(self.root, 'nginx.conf'), 'w') as f:
+            f.write(NGINX_CONF.format(root=self.root, workers=workers))
+
+        self.proc = None
+
+    def _local_ports(self, txt):
+        txt = re.sub(r'listen 80;', 'listen 127.0.0.1:{};'.format(self.http_port), txt)
+        return re.sub(r'listen 443 ', 'listen 127.0.0.1:{} '.format(self.https_port), txt)
+
+    def start(self):
+        conf = os.path.join(self.root, 'nginx.conf')
+        subprocess.check_call([self._nginx, '-t', '-q', '-p', self.root, '-c', conf])
+        self.proc = subprocess.Popen([self._nginx, '-p', self.root, '-c', conf])
+
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.https_port), timeout=0.5).close()
+                return self
+            except OSError:
+                time.sleep(0.05)
+        raise SystemExit('nginx did not start, see {}/error.log'.format(self.root))
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.send_signal(signal.SIGQUIT)
+            self.proc.wait(10)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def workers_rss_kib(self):
+        """ Total resident memory of nginx worker processes
+        """
+        total = 0
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open('/proc/{}/stat'.format(pid)) as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+                if ppid != self.proc.pid:
+                    continue
+                with open('/proc/{}/status'.format(pid)) as f:
+                    total += int(re.search(r'VmRSS:\s+(\d+)', f.read()).group(1))
+            except (OSError, AttributeError, ValueError):
+                pass
+        return total
+
+
+# ---------------------------------------------------------------- load
+
+def client_context():
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+
+async def _http_worker(port, ctx, path, deadline, latencies):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, ssl=ctx,
+                                                   server_hostname=DOMAIN if ctx else None)
+    req = 'GET {} HTTP/1.1\r\nHost: {}\r\nAccept-Encoding: gzip\r\n\r\n'.format(path, DOMAIN).encode()
+    try:
+        while time.perf_counter() < deadline:
+            t0 = time.perf_counter()
+            writer.write(req)
+            _, _, headers = await _read_head(reader)
+            if 'content-length' in headers:
+                await reader.readexactly(int(headers['content-length']))
+            else:  # chunked
+                while True:
+                    n = int((await reader.readline()).strip(), 16)
+                    await reader.readexactly(n + 2)
+                    if n == 0:
+                        break
+            latencies.append(time.perf_counter() - t0)
+    finally:
+        writer.close()
+
+
+def http_load(port, path='/hub/api', connections=32, duration=10, ctx=None):
+    """ Requests over keep-alive connections, returns dict(rps, p50_ms, p99_ms)
+    """
+    latencies = []
+
+    async def run():
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*[_http_worker(port, ctx, path, deadline, latencies)
+                               for _ in range(connections)])
+
+    t0 = time.perf_counter()
+    asyncio.run(run())
+    dt = time.perf_counter() - t0
+
+    return dict(rps=len(latencies)/dt,
+                p50_ms=percentile(latencies, 50)*1000,
+                p99_ms=percentile(latencies, 99)*1000)
+
+
+def handshake_rate(port, resume=False, threads=4, duration=5):
+    """ Completed TLS handshakes per second, optionally resuming previous session
+    """
+    ctx = client_context()
+    ctx.maximum_version = ssl.TLSVersion.TLSv1_2  # session ids, tickets may be off
+    counts = []
+    reused = []
+
+    def run():
+        session, n, r = None, 0, 0
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            with socket.create_connection(('127.0.0.1', port)) as s:
+                with ctx.wrap_socket(s, server_hostname=DOMAIN, session=session if resume else None) as t:
+                    n += 1
+                    r += t.session_reused
+                    session = t.session
+        counts.append(n)
+        reused.append(r)
+
+    ts = [threading.Thread(target=run) for _ in range(threads)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+
+    return sum(counts)/duration, sum(reused)/max(1, sum(counts))
+
+
+async def _open_ws(port, ctx, path, conns):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, ssl=ctx,
+                                                   server_hostname=DOMAIN if ctx else None)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write(('GET {} HTTP/1.1\r\nHost: {}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                  'Sec-WebSocket-Key: {}\r\nSec-WebSocket-Version: 13\r\n\r\n').format(path, DOMAIN, key).encode())
+    await _read_head(reader)
+    writer.write(ws_frame(b'ping', mask=True))
+    await ws_read_frame(reader)
+    conns.append(writer)
+
+
+def websocket_memory(port, rss, count=1000, ctx=None, path='/user/bench/api/kernels/k1/channels'):
+    """ Extra nginx worker memory (KiB) per open websocket connection
+    """
+    async def run():
+        conns = []
+        before = rss()
+        for i in range(0, count, 100):
+            await asyncio.gather(*[_open_ws(port, ctx, path, conns) for _ in range(min(100, count - i))])
+        await asyncio.sleep(0.5)
+        after = rss()
+        for w in conns:
+            w.close()
+        return (after - before)/max(1, len(conns))
+
+    return asyncio.run(run())
+
+
+# ---------------------------------------------------------------- main
+
+def run_profile(nginx_bin, config, args):
+    hub = StubHub(args.body_size).start()
+    srv = Nginx(nginx_bin, config, hub, workers=args.workers).start()
+    ctx = client_context()
+    try:
+        http_load(srv.https_port, args.path, connections=4, duration=1, ctx=ctx)  # warm up
+        out = http_load(srv.https_port, args.path, args.connections, args.duration, ctx=ctx)
+        out['handshakes_full'], _ = handshake_rate(srv.https_port, duration=args.duration/2)
+        out['handshakes_resumed'], out['resumed_ratio'] = handshake_rate(srv.https_port, resume=True,
+                                                                         duration=args.duration/2)
+        out['ws_kib_each'] = websocket_memory(srv.https_port, srv.workers_rss_kib, args.websockets, ctx=ctx)
+    finally:
+        srv.stop()
+    return out
+
+
+COLUMNS = [('rps', '{:.0f}'), ('p50_ms', '{:.2f}'), ('p99_ms', '{:.2f}'),
+           ('handshakes_full', '{:.0f}'), ('handshakes_resumed', '{:.0f}'), ('resumed_ratio', '{:.2f}'),
+           ('ws_kib_each', '{:.1f}')]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', '-c', action='append', default=[],
+                        help='jhub-vhost config file, one profile per file (default config if none)')
+    parser.add_argument('--nginx', default=shutil.which('nginx'), help='nginx executable')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per load test')
+    parser.add_argument('--connections', type=int, default=64, help='Concurrent keep-alive connections')
+    parser.add_argument('--websockets', type=int, default=1000, help='Websockets to open for memory test')
+    parser.add_argument('--workers', type=int, default=1, help='nginx worker processes')
+    parser.add_argument('--path', default='/hub/api', help='Path to request')
+    parser.add_argument('--body-size', type=int, default=1024, help='Size of stub hub responses')
+    parser.add_argument('--json', help='Also write results to this file')
+    args = parser.parse_args(args)
+
+    if args.nginx is None:
+        parser.error('nginx not found, supply --nginx')
+
+    results = {}
+    for config in args.config or [None]:
+        name = os.path.basename(config) if config else 'default'
+        results[name] = run_profile(args.nginx, config, args)
+
+    print('{:<20}'.format('profile') + ''.join('{:>20}'.format(c) for c, _ in COLUMNS))
+    for name, r in results.items():
+        print('{:<20}'.format(name) + ''.join('{:>20}'.format(fmt.format(r[c])) for c, fmt in COLUMNS))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,12 @@
 from .utils import JhubNginxError
-from ._impl import add_or_check_vhost, remove_vhost
 
-__all__ = ['JhubNginxError', 'add_or_check_vhost', 'remove_vhost']
+__all__ = ['JhubNginxError', 'add_or_check_vhost', 'add_or_check_vhosts', 'remove_vhost',
+           'apply_hubs', 'parse_desired']
+
+
+def __getattr__(name):
+    # avoid loading _impl and its dependencies until needed, keeps CLI startup fast
+    if name in __all__:
+        from . import _impl
+        return getattr(_impl, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
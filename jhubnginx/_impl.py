@@ -1,18 +1,23 @@
 import os
-import subprocess
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from jinja2 import Template
 from pydash import get as _get
-import shlex
 
-from . import utils
-from .utils import JhubNginxError, dns_wait, check_first_line
-from ._templates import NGINX_VHOST
-from .dns import check_dns
+from . import utils, timing, manifest, locks
+from .utils import JhubNginxError, check_first_line
+from ._templates import TEMPLATES
+from .dns import check_dns_many
+from .certs import issue_certificates, obtain_certificate, revoke_certificate, read_certificate, ecdsa_name
+from .dnswatch import wait_for_records
+from .reload import reload_scheduler, ConfigChange, ConfigWrite
 
 
 NGINX_VHOST_MARKER = '## Generated by jhub-vhost'
+NGINX_HTTP_MARKER = '## Generated by jhub-vhost, shared by all vhosts'
+NGINX_HUBS_MARKER = '## Generated by jhub-vhost, consolidated hubs'
 
 
 def warn(msg):
@@ -28,26 +33,328 @@ def indent(s, n):
     return '\n'.join(pad + l for l in s.splitlines())
 
 
-def render_vhost(domain, opts, **kwargs):
-    return Template(NGINX_VHOST).render(domain=domain,
-                                        header=NGINX_VHOST_MARKER,
-                                        indent=indent,
-                                        **kwargs, **opts)
+_environments = {}
+
+
+def template_env(opts):
+    """ Shared jinja2 environment, templates are compiled once per process.
+
+    Templates found in `templates.path` override built-in ones, compiled
+    templates are also kept on disk under state_dir when
+    `templates.bytecode_cache` is set.
+    """
+    path = _get(opts, 'templates.path')
+    cache_dir = None
+    if _get(opts, 'templates.bytecode_cache') and _get(opts, 'state_dir'):
+        cache_dir = str(Path(_get(opts, 'state_dir'))/'jinja')
+
+    k = (path, cache_dir)
+    env = _environments.get(k)
+    if env is not None:
+        return env
+
+    from jinja2 import Environment, DictLoader, ChoiceLoader, FileSystemLoader, FileSystemBytecodeCache
+
+    loader = DictLoader(TEMPLATES)
+    if path is not None:
+        loader = ChoiceLoader([FileSystemLoader(path), loader])
+
+    bcc = None
+    if cache_dir is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            bcc = FileSystemBytecodeCache(cache_dir)
+        except OSError as e:
+            debug('Not caching compiled templates: {}'.format(str(e)))
+
+    env = Environment(loader=loader, bytecode_cache=bcc)
+    _environments[k] = env
+    return env
+
+
+def parse_backend(txt, default_port=8000):
+    """ ADDRESS[@WEIGHT] -> dict(address=str, weight=int)
+
+    ADDRESS is host:port, host (default_port is used) or unix:/path/to/socket
+    """
+    address, _, weight = txt.strip().partition('@')
+    try:
+        weight = int(weight) if weight else 1
+    except ValueError:
+        weight = 0
+
+    if not address or weight < 1:
+        raise JhubNginxError("Bad backend: {}, expect ADDRESS[@WEIGHT]".format(txt))
+
+    if not address.startswith('unix:') and not re.search(r':\d+$', address):
+        address = '{}:{}'.format(address, default_port)
+
+    return dict(address=address, weight=weight)
+
+
+def upstream_name(domain):
+    return 'jhub-' + domain
+
+
+def backend_list(backends=None, hub_ip='127.0.0.1', hub_port=8000):
+    """ backends -- list of ADDRESS[@WEIGHT] strings, hub_ip:hub_port when not supplied
+    """
+    if not backends:
+        backends = ['{}:{}'.format(hub_ip, hub_port)]
+    return [parse_backend(b, hub_port) for b in backends]
+
+
+def render_vhost(domain, opts, cert_name=None, hub_ip='127.0.0.1', hub_port=8000, backends=None, **kwargs):
+    """ backends -- list of ADDRESS[@WEIGHT] strings, hub_ip:hub_port when not supplied
+    """
+    ssl_dir = Path(_get(opts, 'nginx.ssl_root'))/(cert_name or domain)
+    template = template_env(opts).get_template('vhost.conf')
+    return template.render(domain=domain,
+                           header=NGINX_VHOST_MARKER,
+                           indent=indent,
+                           ssl_dir=str(ssl_dir),
+                           upstream=upstream_name(domain),
+                           backends=backend_list(backends, hub_ip, hub_port),
+                           **kwargs, **opts)
 
 
 def domain_config_path(domain, opts):
     return Path(_get(opts, 'nginx.sites'))/(domain + '.conf')
 
 
-def nginx_reload(opts):
-    debug('Reloading nginx config')
-    try:
-        subprocess.check_call(_get(opts, 'nginx.check_cmd'), shell=True)
-        subprocess.check_call(_get(opts, 'nginx.reload_cmd'), shell=True)
-    except FileNotFoundError as e:
-        raise JhubNginxError('Failed to reload nginx config, bad command: {}'.format(str(e)))
-    except subprocess.CalledProcessError as e:
-        raise JhubNginxError('Failed to reload nginx config: {}'.format(str(e)))
+def shared_config_path(opts):
+    return Path(_get(opts, 'nginx.sites'))/'00-jhub-vhost.conf'
+
+
+def write_shared_config(opts):
+    """ Update http level config used by all vhosts
+
+    Returns ConfigWrite to pass to nginx_reload or None if no changes were needed
+    """
+    cfg_file = shared_config_path(opts)
+    txt = template_env(opts).get_template('http.conf').render(header=NGINX_HTTP_MARKER, **opts)
+
+    previous = utils.slurp(str(cfg_file))
+    if previous == txt:
+        return None
+
+    if previous is not None and not check_first_line(str(cfg_file), NGINX_HTTP_MARKER):
+        raise JhubNginxError("Refusing to overwrite not mine config file: {}".format(cfg_file))
+
+    log_dir = _get(opts, 'nginx.access_log.path')
+    if log_dir:
+        # nginx refuses configs logging into missing directories
+        os.makedirs(log_dir, exist_ok=True)
+
+    return ConfigWrite(cfg_file, txt)
+
+
+def consolidated(opts):
+    return _get(opts, 'nginx.layout') == 'consolidated'
+
+
+def hubs_config_path(opts):
+    return Path(_get(opts, 'nginx.sites'))/'01-jhub-vhost-hubs.conf'
+
+
+def vhost_config_path(domain, opts):
+    """ File holding config of the domain in the configured layout
+    """
+    if consolidated(opts):
+        return hubs_config_path(opts)
+    return domain_config_path(domain, opts)
+
+
+_MAP_ENTRY = re.compile(r'^\s+(\S+) (\S+);$', re.M)
+_UPSTREAM_BLOCK = re.compile(r'^upstream (\S+) \{\n(.*?)^\}', re.M | re.S)
+_UPSTREAM_SERVER = re.compile(r'^\s+server (\S+?)(?: weight=(\d+))?[ ;]', re.M)
+
+
+def _block(txt, opening):
+    start = txt.find(opening + ' {\n')
+    if start < 0:
+        return ''
+    start += len(opening) + 3
+    return txt[start:txt.index('\n}', start)]
+
+
+def _upstream_backends(block):
+    return [dict(address=a, weight=int(w or 1)) for a, w in _UPSTREAM_SERVER.findall(block)]
+
+
+def parse_hubs(txt):
+    """ Hubs listed in consolidated config
+
+    Returns domain -> dict(ssl_dir=Path|None, backends=[dict(address, weight)]),
+    ssl_dir is None for hubs still waiting for a certificate
+    """
+    certs = dict(_MAP_ENTRY.findall(_block(txt, 'map $ssl_server_name $jhub_ssl_dir')))
+    upstreams = dict(_UPSTREAM_BLOCK.findall(txt))
+    hubs = {}
+    for domain, upstream in _MAP_ENTRY.findall(_block(txt, 'map $host $jhub_upstream')):
+        if domain == 'default':
+            continue
+        ssl_dir = certs.get(domain)
+        hubs[domain] = dict(ssl_dir=Path(ssl_dir) if ssl_dir else None,
+                            backends=_upstream_backends(upstreams.get(upstream, '')))
+    return hubs
+
+
+def read_hubs(opts):
+    """ Hubs in consolidated config, see parse_hubs
+    """
+    cfg_file = hubs_config_path(opts)
+    txt = utils.slurp(str(cfg_file))
+    if txt is None:
+        return {}
+
+    if not check_first_line(str(cfg_file), NGINX_HUBS_MARKER):
+        raise JhubNginxError("Refusing to use not mine config file: {}".format(cfg_file))
+
+    return parse_hubs(txt)
+
+
+_hubs_lock = threading.Lock()
+
+
+def render_hubs(hubs, opts):
+    """ Consolidated config text for hubs, see parse_hubs
+    """
+    return template_env(opts).get_template('hubs.conf').render(
+        header=NGINX_HUBS_MARKER,
+        indent=indent,
+        upstream='$jhub_upstream',
+        log_name='jhub-hubs',
+        hubs=[dict(domain=domain,
+                   upstream=upstream_name(domain),
+                   ssl_dir=str(hub['ssl_dir']) if hub['ssl_dir'] else None,
+                   backends=hub['backends'])
+              for domain, hub in sorted(hubs.items())],
+        **opts)
+
+
+class HubsEdit(ConfigChange):
+    """ Add or replace hubs in consolidated config, drop removed ones.
+
+    update -- domain -> dict(ssl_dir=Path|None, backends=[dict(address, weight)])
+
+    The file is shared by all hubs, so rollback only restores entries of
+    the edited domains and keeps whatever others changed in the meantime.
+    """
+    def __init__(self, opts, update=None, remove=()):
+        ConfigChange.__init__(self, hubs_config_path(opts))
+        self._opts = opts
+        self._update = dict(update or {})
+        self._remove = list(remove)
+        self._before = {}
+
+    def _edit(self, update, remove):
+        with _hubs_lock, locks.lock('hubs', self._opts, message=debug):
+            hubs = read_hubs(self._opts)
+            before = {domain: hubs.get(domain) for domain in list(update) + remove}
+            hubs.update(update)
+            for domain in remove:
+                hubs.pop(domain, None)
+
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            utils.write_if_different(self.path, render_hubs(hubs, self._opts))
+        return before
+
+    def apply(self):
+        self._before = self._edit(self._update, self._remove)
+
+    def rollback(self):
+        before, self._before = self._before, {}
+        self._edit({domain: hub for domain, hub in before.items() if hub is not None},
+                   [domain for domain, hub in before.items() if hub is None])
+
+
+def edit_hubs(opts, update=None, remove=()):
+    """ HubsEdit to pass to nginx_reload, None if no changes are needed
+    """
+    hubs = read_hubs(opts)
+    hubs.update(update or {})
+    for domain in remove:
+        hubs.pop(domain, None)
+
+    if render_hubs(hubs, opts) == utils.slurp(str(hubs_config_path(opts))):
+        return None
+    return HubsEdit(opts, update=update, remove=remove)
+
+
+def managed_vhosts(opts):
+    """ Generate (domain, config_path) for every vhost config created by us
+    """
+    sites = Path(_get(opts, 'nginx.sites'))
+    if not sites.exists():
+        return
+
+    for cfg_file in sorted(sites.glob('*.conf')):
+        if check_first_line(str(cfg_file), NGINX_VHOST_MARKER):
+            yield cfg_file.name[:-len('.conf')], cfg_file
+
+
+def vhost_ssl_dir(cfg_file):
+    """ Extract certificate directory used by generated vhost config
+    """
+    txt = utils.slurp(str(cfg_file)) or ''
+    m = re.search(r'^\s*ssl_certificate\s+(\S+)/fullchain\.pem;', txt, re.M)
+    return Path(m.group(1)) if m else None
+
+
+def vhost_ssl_dirs(opts):
+    """ domain -> certificate directory for every generated vhost in either layout,
+        None for temporary configs waiting for a certificate
+    """
+    out = {domain: vhost_ssl_dir(cfg_file) for domain, cfg_file in managed_vhosts(opts)}
+    out.update((domain, hub['ssl_dir']) for domain, hub in read_hubs(opts).items())
+    return out
+
+
+def current_vhosts(opts):
+    """ Generated vhosts in either layout
+
+    Returns domain -> dict(ssl_dir=Path|None, backends=[dict(address, weight)])
+    """
+    out = {}
+    for domain, cfg_file in managed_vhosts(opts):
+        upstreams = dict(_UPSTREAM_BLOCK.findall(utils.slurp(str(cfg_file)) or ''))
+        out[domain] = dict(ssl_dir=vhost_ssl_dir(cfg_file),
+                           backends=_upstream_backends(upstreams.get(upstream_name(domain), '')))
+    out.update(read_hubs(opts))
+    return out
+
+
+def cert_group_members(ssl_dir, opts):
+    """ Domains whose vhost configs use certificate stored in ssl_dir
+    """
+    return [domain for domain, d in sorted(vhost_ssl_dirs(opts).items())
+            if d == Path(ssl_dir)]
+
+
+def nginx_reload(opts, changes=None):
+    """ Validate and reload nginx config, reloads from concurrent callers are coalesced.
+
+    changes -- ConfigChange for each config file to write, files are written
+               just before the check while holding the reload lock
+
+    Returns dictionary path -> error for changes that nginx rejected, those
+    were rolled back and the rest of the changes are live.
+    """
+    return reload_scheduler(opts, message=debug).submit(changes or [])
+
+
+def rejected_domains(rejected, changes):
+    """ Map nginx_reload output back to domains
+
+    changes -- domain -> ConfigChange|None
+    """
+    out = {}
+    for domain, change in changes.items():
+        err = rejected.get(change.path) if change is not None else None
+        if err is not None:
+            out[domain] = JhubNginxError('nginx rejected config for {}, rolled back:\n{}'.format(domain, err))
+    return out
 
 
 def add_or_check_vhost(domain,
@@ -56,196 +363,680 @@ def add_or_check_vhost(domain,
                        skip_dns_check=False,
                        standalone=False,
                        dns_wait_timeout=5*60,
-                       min_dns_wait=60,
+                       min_dns_wait=0,
+                       backends=None,
                        opts=None):
+    return add_or_check_vhosts([domain],
+                               hub_ip=hub_ip,
+                               hub_port=hub_port,
+                               backends=backends,
+                               skip_dns_check=skip_dns_check,
+                               standalone=standalone,
+                               dns_wait_timeout=dns_wait_timeout,
+                               min_dns_wait=min_dns_wait,
+                               opts=opts)
+
+
+def add_or_check_vhosts(domains,
+                        hub_ip='127.0.0.1',
+                        hub_port='8000',
+                        skip_dns_check=False,
+                        standalone=False,
+                        dns_wait_timeout=5*60,
+                        min_dns_wait=0,
+                        cert_name=None,
+                        backends=None,
+                        opts=None):
+    """Create or update vhost configs for a number of domains at once.
+
+    All temporary configs are written before a single nginx reload, then
+    certificates are obtained and final configs are written followed by
+    one more reload. Domains that fail are cleaned up individually, the
+    rest are still configured, JhubNginxError is raised at the end listing
+    failed domains.
+
+    cert_name -- when supplied one certificate with this name is shared by
+                 all the domains (and any other vhosts already using it),
+                 rather than obtaining a certificate per domain
+
+    backends -- list of hub addresses to balance between, ADDRESS[@WEIGHT]
+                where ADDRESS is host:port or unix:/path, defaults to hub_ip:hub_port
+
+    Domains verified by an earlier call with the same inputs less than
+    `manifest.reverify_interval` seconds ago are skipped without any checks.
 
+    Domains (and cert_name) are locked for the duration of the call, other
+    processes working on the same domains are waited for up to `locks.timeout`
+    seconds, LockTimeout is raised after that.
+    """
+    domains = list(dict.fromkeys(domains))
     opts = utils.default_opts(opts)
-    vhost_cfg_file = domain_config_path(domain, opts)
-    public_ip = None if skip_dns_check else utils.public_ip()
+    timing.configure(opts)
+    for b in backends or []:
+        parse_backend(b, hub_port)  # fail early on bad input
+
+    inputs = manifest.inputs_hash(opts,
+                                  hub_ip=hub_ip,
+                                  hub_port=str(hub_port),
+                                  backends=backends or [],
+                                  cert_name=cert_name)
+    fresh = manifest.fresh_domains(domains, opts, inputs, need_dns=not skip_dns_check)
+    if fresh:
+        debug('No changes since last check: {}'.format(', '.join(fresh)))
+        domains = [d for d in domains if d not in fresh]
+        if not domains:
+            return True
+
+    with locks.vhost_locks(domains, opts, cert_names=[cert_name] if cert_name else [], message=debug):
+        return _add_or_check_vhosts(domains,
+                                    hub_ip=hub_ip,
+                                    hub_port=hub_port,
+                                    skip_dns_check=skip_dns_check,
+                                    standalone=standalone,
+                                    dns_wait_timeout=dns_wait_timeout,
+                                    min_dns_wait=min_dns_wait,
+                                    cert_name=cert_name,
+                                    backends=backends,
+                                    inputs=inputs,
+                                    opts=opts)
+
+
+def _add_or_check_vhosts(domains,
+                         hub_ip,
+                         hub_port,
+                         skip_dns_check,
+                         standalone,
+                         dns_wait_timeout,
+                         min_dns_wait,
+                         cert_name,
+                         backends,
+                         inputs,
+                         opts):
+    public_ip = None if skip_dns_check else utils.public_ip(opts)
     email = _get(opts, 'letsencrypt.email', None)
+    failed = {}
+    dns_updated = []
+    cleanup = []
+    certs_changed = []
+    unverified = []
 
-    def run_certbot(num_tries):
-        debug('Running certbot for {}'.format(domain))
-        if standalone:
-            cmd = ('certbot certonly'
-                   ' --standalone'
-                   ' --text --agree-tos --no-eff-email'
-                   ' --email {email}'
-                   ' --domains {domain}').format(
-                    email=email,
-                    domain=domain).split()
-        else:
-            webroot = Path(_get(opts, 'letsencrypt.webroot'))
-
-            if not webroot.exists():
-                debug('Creating webroot directory: {}'.format(webroot))
-                webroot.mkdir(parents=True)
-
-            cmd = ('certbot certonly'
-                   ' --webroot -w {webroot}'
-                   ' --text --agree-tos --no-eff-email'
-                   ' --email {email}'
-                   ' --domains {domain}').format(
-                    email=email,
-                    webroot=webroot,
-                    domain=domain).split()
-
-        while num_tries > 0:
-            num_tries -= 1
-            try:
-                out = subprocess.check_output(cmd).decode('utf-8')
-                debug(out)
-                return True
-            except FileNotFoundError as e:
-                raise JhubNginxError('certbot is not installed')
-            except subprocess.CalledProcessError as e:
-                if num_tries > 0:
-                    debug('Will re-try in one minute')
-                    time.sleep(60)
-
-        raise JhubNginxError('certbot reported an error')
-        return False
-
-    def gen_config(**kwargs):
+    def write_configs(domains, nossl=False):
+        """ Returns (domain -> ConfigChange|None, list of ConfigChange to reload)
+        """
+        if consolidated(opts):
+            known = read_hubs(opts)
+            ssl_root = Path(_get(opts, 'nginx.ssl_root'))
+
+            def entry(domain):
+                if nossl:
+                    return dict(ssl_dir=None, backends=[])
+                return dict(ssl_dir=ssl_root/(cert_name or domain),
+                            backends=backend_list(backends, hub_ip, hub_port))
+
+            update = {domain: entry(domain) for domain in domains}
+            change = edit_hubs(opts, update=update)
+            if change is None:
+                return {domain: None for domain in domains}, []
+            return {domain: change if known.get(domain) != update[domain] else None
+                    for domain in domains}, [change]
+
+        changes = {domain: gen_config(domain, nossl=nossl) for domain in domains}
+        return changes, [c for c in changes.values() if c is not None]
+
+    def gen_config(domain, **kwargs):
+        vhost_cfg_file = domain_config_path(domain, opts)
         txt = render_vhost(domain, opts,
+                           cert_name=cert_name,
                            hub_port=hub_port,
                            hub_ip=hub_ip,
+                           backends=backends,
                            **kwargs)
 
-        if not vhost_cfg_file.parent.exists():
-            debug('Missing folder: {}, creating'.format(vhost_cfg_file.parent))
-            vhost_cfg_file.parent.mkdir(parents=True)
+        if utils.slurp(str(vhost_cfg_file)) == txt:
+            return None
+
+        return ConfigWrite(vhost_cfg_file, txt)
+
+    def existing_configs(domains):
+        if consolidated(opts):
+            hubs = read_hubs(opts)
+            return [d for d in domains if d in hubs]
+        return [d for d in domains if domain_config_path(d, opts).exists()]
+
+    def remove_configs(domains):
+        """ Returns list of ConfigChange removing configs of domains
+        """
+        if not domains:
+            return []
 
-        return utils.write_if_different(str(vhost_cfg_file), txt)
+        if consolidated(opts):
+            debug('Cleaning up {} from {}'.format(', '.join(domains), hubs_config_path(opts)))
+            return [HubsEdit(opts, remove=domains)]
 
-    def attempt_cleanup():
-        debug('Cleaning up {}'.format(vhost_cfg_file))
+        out = []
+        for domain in domains:
+            vhost_cfg_file = domain_config_path(domain, opts)
+            debug('Cleaning up {}'.format(vhost_cfg_file))
+            out.append(ConfigWrite(vhost_cfg_file, None))
+        return out
 
+    def attempt_cleanup(domains):
         try:
-            os.remove(str(vhost_cfg_file))
-            nginx_reload(opts)
+            rejected = nginx_reload(opts, remove_configs(domains))
         except JhubNginxError as e:
             debug('Ooops failure within a failure: {}'.format(str(e)))
-        except OSError as e:
-            debug('Ooops failure within a failure: {}'.format(str(e)))
+            return
+        for err in rejected.values():
+            debug('Ooops failure within a failure: {}'.format(err))
 
-    def have_ssl_files():
-        ssl_root = Path(_get(opts, 'nginx.ssl_root'))/domain
-        privkey = ssl_root/"privkey.pem"
-        fullchain = ssl_root/"fullchain.pem"
-        return privkey.exists() and fullchain.exists()
+    def have_ssl_files(name):
+        names = [name, ecdsa_name(name)] if _get(opts, 'letsencrypt.ecdsa') else [name]
+        for name in names:
+            ssl_root = Path(_get(opts, 'nginx.ssl_root'))/name
+            privkey = ssl_root/"privkey.pem"
+            fullchain = ssl_root/"fullchain.pem"
+            if not (privkey.exists() and fullchain.exists()):
+                return False
+        return True
 
-    def obtain_ssl():
+    def obtain_ssl(domains):
+        """ Returns list of domains for which certificates were obtained
+        """
         if email is None:
             raise JhubNginxError("Can't request SSL without an E-mail address")
 
+        # vhosts that already exist serve acme challenges, only new ones need temp config
+        temp_domains = [] if standalone else [d for d in domains if d in new_domains]
+
+        if temp_domains:
+            debug(' writing temp vhost configs')
+            changes, pending = write_configs(temp_domains, nossl=True)
+            try:
+                rejected = nginx_reload(opts, pending)
+            except JhubNginxError as e:
+                attempt_cleanup(temp_domains)
+                raise e
+
+            failed.update(rejected_domains(rejected, changes))
+            domains = [d for d in domains if d not in failed]
+
+        done = []
+        if cert_name is None:
+            results = issue_certificates(domains, opts,
+                                         standalone=standalone,
+                                         message=debug)
+        else:
+            ssl_dir = Path(_get(opts, 'nginx.ssl_root'))/cert_name
+            group = cert_group_members(ssl_dir, opts)
+            group += [d for d in all_domains if d not in group]
+
+            def issue_shared(name):
+                return obtain_certificate(group, opts,
+                                          standalone=standalone,
+                                          cert_name=name,
+                                          message=debug)
+
+            err = issue_certificates([cert_name], opts,
+                                     standalone=standalone,
+                                     issue=issue_shared,
+                                     message=debug)[cert_name]
+            results = {domain: err for domain in domains}
+
+        for domain, err in results.items():
+            if err is None:
+                done.append(domain)
+            else:
+                failed[domain] = err
+
+        if done:
+            certs_changed.extend(done)
+
+        cleanup.extend(remove_configs([d for d in temp_domains if d in failed]))
+
+        return done
+
+    def add_ssl_vhosts(domains):
+        with timing.span('write_configs', domains=len(domains)):
+            shared = write_shared_config(opts)
+            changes, pending = write_configs(domains)
+        updated = [domain for domain in domains if changes[domain] is not None]
+
+        for domain in domains:
+            if domain in updated:
+                debug('Updated vhost config {} ({})'.format(domain, vhost_config_path(domain, opts)))
+            else:
+                debug('No changes were required {} ({})'.format(domain, vhost_config_path(domain, opts)))
+
+        if shared is not None:
+            debug('Updated shared config {}'.format(shared.path))
+            pending.append(shared)
+
         if standalone:
-            return run_certbot(2)
+            # nginx is not running, nothing to check configs with
+            with locks.lock('reload', opts, message=debug):
+                for c in pending:
+                    c.apply()
+            return
+
+        pending.extend(cleanup)
+        if len(pending) == 0 and len(certs_changed) == 0:
+            return
 
-        debug(' writing temp vhost config')
-        gen_config(nossl=True)
         try:
-            nginx_reload(opts)
-            run_certbot(2)
+            rejected = nginx_reload(opts, pending)
         except JhubNginxError as e:
-            attempt_cleanup()
+            # changes were rolled back: existing vhosts are back to their
+            # previous config, new ones to temporary config that is not needed
+            attempt_cleanup([d for d in updated if d in new_domains])
             raise e
 
-    def add_ssl_vhost():
-        updated = gen_config()
-        if updated:
-            debug('Updated vhost config {}'.format(vhost_cfg_file))
+        if shared is not None and shared.path in rejected:
+            warn('nginx rejected shared config, rolled back: {}'.format(rejected[shared.path]))
 
-            if standalone:
-                return
+        rejected = rejected_domains(rejected, changes)
+        failed.update(rejected)
 
-            try:
-                nginx_reload(opts)
-            except JhubNginxError as e:
-                attempt_cleanup()
-                raise e
-        else:
-            debug('No changes were required {}'.format(vhost_cfg_file))
+        # rolled back new vhosts are left with temporary config, remove those too
+        leftover = existing_configs([d for d in rejected if d in new_domains])
+        if leftover:
+            attempt_cleanup(leftover)
 
     def on_dns_update(domain, ip):
+        dns_updated.append((domain, ip))
+
+    def wait_for_dns():
+        if len(dns_updated) == 0:
+            return
+
         if min_dns_wait:
             debug('Waiting for {} seconds after updating DNS'.format(min_dns_wait))
-            time.sleep(min_dns_wait)
+            with timing.span('dns_min_wait'):
+                time.sleep(min_dns_wait)
+
+        def cbk(t, pending):
+            debug("Still waiting for DNS to update: {}".format(', '.join(pending)))
 
-        def cbk(t):
-            debug("Still waiting for DNS to update")
+        with timing.span('dns_wait', domains=len(dns_updated)):
+            observed = wait_for_records(dns_updated, opts, timeout=dns_wait_timeout, cbk=cbk)
+        for domain, ok in observed.items():
+            if not ok:
+                warn('Requested DNS record update for {}, but failed to observe the change,'
+                     ' will continue anyway'.format(domain))
 
-        if dns_wait(domain, ip, dns_wait_timeout, cbk=cbk, use_dig=True) is False:
-            warn('Requested DNS record update, but failed to observe the change, will continue anyway')
+    existing = existing_configs(domains)
+    new_domains = [d for d in domains if d not in existing]
 
-    if vhost_cfg_file.exists():
-        if not skip_dns_check:
-            try:
-                check_dns(domain, public_ip, opts, message=debug)
-            except JhubNginxError as e:
-                warn('Virtual host config already exists but DNS check/update failed:\n {}'.format(str(e)))
+    if not skip_dns_check:
+        def check_all(domains, **kwargs):
+            if public_ip is None:
+                return {d: (False, "Can't find public IP of this host") for d in domains}
+            return check_dns_many(domains, public_ip, opts, message=debug, **kwargs)
+
+        for domain, (ok, msg) in check_all(existing).items():
+            if not ok:
+                unverified.append(domain)
+                warn('Virtual host config already exists but DNS check/update failed:\n {}'.format(msg))
+
+        for domain, (ok, msg) in check_all(new_domains, on_update=on_dns_update).items():
+            if not ok:
+                failed[domain] = JhubNginxError(msg)
 
-        add_ssl_vhost()  # Make sure content is up to date
+        new_domains = [d for d in new_domains if d not in failed]
+        wait_for_dns()
+
+    all_domains = existing + new_domains
+    need_ssl = []
+    if cert_name is not None:
+        ssl_dir = Path(_get(opts, 'nginx.ssl_root'))/cert_name
+        members = cert_group_members(ssl_dir, opts)
+        need_ssl = [d for d in all_domains if d not in members]
+        if not have_ssl_files(cert_name) and not need_ssl:
+            need_ssl = all_domains
+
+        if need_ssl:
+            debug('Obtaining shared SSL certificate {} for {}'.format(cert_name, ', '.join(need_ssl)))
     else:
-        if not skip_dns_check:
-            check_dns(domain, public_ip, opts, on_update=on_dns_update, message=debug)
+        # existing vhosts moving off a shared certificate need their own too
+        for domain in all_domains:
+            if have_ssl_files(domain):
+                if domain in new_domains:
+                    debug('Found SSL files for {}, no need to run certbot'.format(domain))
+            else:
+                debug('Obtaining SSL for {}'.format(domain))
+                need_ssl.append(domain)
 
-        if have_ssl_files():
-            debug('Found SSL files, no need to run certbot')
-        else:
-            debug('Obtaining SSL for {}'.format(domain))
-            obtain_ssl()
+    if need_ssl:
+        obtain_ssl(need_ssl)
+        existing = [d for d in existing if d not in failed]
+        new_domains = [d for d in new_domains if d not in failed]
+
+    add_ssl_vhosts(existing + new_domains)
 
-        add_ssl_vhost()
+    # existing vhosts that failed DNS check are checked again next time
+    done = [d for d in existing + new_domains if d not in failed and d not in unverified]
+    ssl_root = Path(_get(opts, 'nginx.ssl_root'))
+    manifest.record(done, opts, inputs,
+                    ip=public_ip,
+                    ssl_dirs={d: ssl_root/(cert_name or d) for d in done},
+                    configs={d: vhost_config_path(d, opts) for d in done})
+    manifest.forget(list(failed), opts)
+
+    if len(failed) == 1 and len(domains) == 1:
+        raise next(iter(failed.values()))
+
+    if failed:
+        err = JhubNginxError('Failed to configure {} out of {} domains:\n{}'.format(
+            len(failed), len(domains),
+            '\n'.join(' {}: {}'.format(d, str(e)) for d, e in failed.items())))
+        err.failed = failed
+        raise err
 
     return True
 
 
 def remove_vhost(domain, opts, keep_certificates=False):
-    def ssl_cert_file():
-        ssl_root = Path(_get(opts, 'nginx.ssl_root'))/domain
-        return ssl_root/"cert.pem"
+    """ Remove vhost config and revoke its certificate.
+
+    When certificate is shared with other vhosts it is re-issued without
+    this domain instead of being revoked.
 
+    Domain and its certificate are locked while this runs, see `locks.timeout`.
+    """
+    opts = utils.default_opts(opts)
+    timing.configure(opts)
+
+    with locks.vhost_locks([domain], opts, message=debug):
+        _remove_vhost(domain, opts, keep_certificates)
+
+
+def _remove_vhost(domain, opts, keep_certificates):
     def revoke(cert_file):
-        args = ['certbot', 'revoke', '-n', '--cert-path', shlex.quote(cert_file)]
+        try:
+            revoke_certificate(cert_file, opts, message=debug)
+        except JhubNginxError as e:
+            return (False, str(e))
 
+        return (True, '')
+
+    def shrink(ssl_dir, remaining):
         try:
-            subprocess.check_call(args)
-        except FileNotFoundError:
-            return (False, 'Failed to find certbot')
-        except subprocess.CalledProcessError as e:
-            return (False, "cerbot reported and error")
+            obtain_certificate(remaining, opts, cert_name=ssl_dir.name, message=debug)
+        except JhubNginxError as e:
+            return (False, str(e))
 
         return (True, '')
 
-    opts = utils.default_opts(opts)
-    vhost_cfg_file = domain_config_path(domain, opts)
+    vhost_cfg_file = vhost_config_path(domain, opts)
 
-    if not vhost_cfg_file.exists():
-        raise JhubNginxError("No configuration for domain {}\n no such file: {}".format(domain, vhost_cfg_file))
+    if consolidated(opts):
+        # ownership is recorded in the hubs map rather than by file marker
+        hub = read_hubs(opts).get(domain)
+        if hub is None:
+            raise JhubNginxError("No configuration for domain {}\n not in: {}".format(domain, vhost_cfg_file))
+        ssl_dir = hub['ssl_dir']
+    else:
+        if not vhost_cfg_file.exists():
+            raise JhubNginxError("No configuration for domain {}\n no such file: {}".format(domain, vhost_cfg_file))
 
-    if not check_first_line(str(vhost_cfg_file), NGINX_VHOST_MARKER):
-        raise JhubNginxError("Refusing to remove not mine config file: {}".format(vhost_cfg_file))
+        if not check_first_line(str(vhost_cfg_file), NGINX_VHOST_MARKER):
+            raise JhubNginxError("Refusing to remove not mine config file: {}".format(vhost_cfg_file))
 
-    if not keep_certificates:
-        cert_path = ssl_cert_file()
-        debug('Will revoke certificate for {}'.format(domain))
+        ssl_dir = vhost_ssl_dir(vhost_cfg_file)
 
-        if cert_path.exists():
-            ok, msg = revoke(str(cert_path))
+    ssl_dir = ssl_dir or Path(_get(opts, 'nginx.ssl_root'))/domain
+
+    with locks.vhost_locks([], opts, cert_names=[ssl_dir.name], message=debug):
+        remaining = [d for d in cert_group_members(ssl_dir, opts) if d != domain]
+
+        if keep_certificates:
+            debug("Keeping certificate in place")
+        elif remaining:
+            debug('Certificate {} is shared, re-issuing it for {}'.format(ssl_dir.name, ', '.join(remaining)))
+            ok, msg = shrink(ssl_dir, remaining)
             if not ok:
                 debug("Error: " + msg)
         else:
-            debug('Warning not revoking SSL certs: not found')
-    else:
-        debug("Keeping certificate in place")
+            cert_path = ssl_dir/"cert.pem"
+            debug('Will revoke certificate for {}'.format(domain))
+
+            if cert_path.exists():
+                ok, msg = revoke(str(cert_path))
+                if not ok:
+                    debug("Error: " + msg)
+            else:
+                debug('Warning not revoking SSL certs: not found')
 
     debug('Cleaning up nginx config: {}'.format(vhost_cfg_file))
+    manifest.forget([domain], opts)
+
+    if consolidated(opts):
+        change = HubsEdit(opts, remove=[domain])
+    else:
+        change = ConfigWrite(vhost_cfg_file, None)
 
     try:
-        os.remove(str(vhost_cfg_file))
-        nginx_reload(opts)
+        rejected = nginx_reload(opts, [change])
     except JhubNginxError as e:
         debug('Failed to reload nginx ({})'.format(str(e)))
-    except OSError as e:
-        debug('Failed to remove config file ({})'.format(str(e)))
+        return
+
+    if change.path in rejected:
+        debug('Failed to remove config ({})'.format(rejected[change.path]))
+
+
+def certificate_inventory(opts):
+    """ Certificates used by generated vhosts, one entry per certificate.
+
+    Returns list of dict(ssl_dir, domains, names, not_after), names and
+    not_after are None when certificate can not be read.
+    """
+    by_dir = {}
+    for domain, ssl_dir in sorted(vhost_ssl_dirs(opts).items()):
+        if ssl_dir is not None:  # temporary configs have no certificate
+            by_dir.setdefault(ssl_dir, []).append(domain)
+
+    ssl_dirs = sorted(by_dir)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        infos = pool.map(lambda d: read_certificate(str(d/'cert.pem')) or {}, ssl_dirs)
+
+    return [dict(ssl_dir=str(ssl_dir),
+                 domains=by_dir[ssl_dir],
+                 names=info.get('names'),
+                 not_after=info.get('not_after'))
+            for ssl_dir, info in zip(ssl_dirs, infos)]
+
+
+def renew_certificates(opts=None, domains=None, renew_before_days=None, dry_run=False):
+    """ Renew certificates of generated vhosts that expire soon.
+
+    Certificates expiring within renew_before_days (letsencrypt.renew_before_days)
+    are renewed concurrently, nginx is reloaded once at the end.
+
+    domains -- only consider certificates used by these domains
+
+    Returns dictionary ssl_dir -> None|exception for certificates that were due
+    """
+    opts = utils.default_opts(opts)
+    timing.configure(opts)
+    if renew_before_days is None:
+        renew_before_days = _get(opts, 'letsencrypt.renew_before_days', 30)
+
+    deadline = time.time() + renew_before_days*24*60*60
+    due = {}
+    for cert in certificate_inventory(opts):
+        if domains is not None and not set(domains) & set(cert['domains']):
+            continue
+        if cert['not_after'] is not None and cert['not_after'] > deadline:
+            continue
+        due[Path(cert['ssl_dir']).name] = cert
+
+    if not due:
+        debug('No certificates are due for renewal')
+        return {}
+
+    for name, cert in due.items():
+        debug('Certificate {} is due for renewal: {}'.format(name, ', '.join(cert['names'] or cert['domains'])))
+
+    if dry_run:
+        return {cert['ssl_dir']: None for cert in due.values()}
+
+    if _get(opts, 'letsencrypt.email') is None:
+        raise JhubNginxError("Can't request SSL without an E-mail address")
+
+    def renew(name):
+        cert = due[name]
+        return obtain_certificate(cert['names'] or cert['domains'], opts,
+                                  cert_name=name,
+                                  force=True,
+                                  message=debug)
+
+    due_domains = [d for cert in due.values() for d in cert['domains']]
+    with locks.vhost_locks(due_domains, opts, cert_names=list(due), message=debug):
+        results = issue_certificates(list(due), opts, issue=renew, message=debug)
+
+    if any(err is None for err in results.values()):
+        nginx_reload(opts)
+
+    return {due[name]['ssl_dir']: err for name, err in results.items()}
+
+
+def parse_desired(data):
+    """ Desired hubs as read from hubs.yml, either a list or a list under `hubs`.
+
+    Every entry is a domain name or a dictionary with `domain` and optional
+    `backends`, `hub_ip`, `hub_port` and `cert_name`.
+
+    Returns domain -> dict(hub_ip, hub_port, backends, cert_name)
+    """
+    hubs = data.get('hubs') if isinstance(data, dict) else data
+    if not isinstance(hubs, list):
+        raise JhubNginxError("Expect a list of hubs under `hubs`")
+
+    keys = {'domain', 'backends', 'hub_ip', 'hub_port', 'cert_name'}
+    out = {}
+    for hub in hubs:
+        if isinstance(hub, str):
+            hub = dict(domain=hub)
+        if not isinstance(hub, dict) or not hub.get('domain'):
+            raise JhubNginxError("Bad hub entry: {}".format(hub))
+        if set(hub) - keys:
+            raise JhubNginxError("Unknown keys for {}: {}".format(hub['domain'], ', '.join(sorted(set(hub) - keys))))
+
+        domain = str(hub['domain'])
+        if domain in out:
+            raise JhubNginxError("Hub listed more than once: {}".format(domain))
+
+        backends = [str(b) for b in hub.get('backends') or []]
+        hub_port = str(hub.get('hub_port', 8000))
+        for b in backends:
+            parse_backend(b, hub_port)
+
+        out[domain] = dict(hub_ip=str(hub.get('hub_ip', '127.0.0.1')),
+                           hub_port=hub_port,
+                           backends=backends,
+                           cert_name=hub.get('cert_name'))
+    return out
+
+
+def plan_changes(desired, opts, prune=True):
+    """ Minimal set of changes turning current vhosts into desired ones.
+
+    A hub is updated when its backends or certificate differ, or when it was
+    last configured with different options (see manifest). Hubs that are not
+    desired are removed when prune is set.
+
+    Returns dict(create=[domain], update=[domain], remove=[domain], unchanged=[domain])
+    """
+    current = current_vhosts(opts)
+    known = manifest.load(opts)
+    ssl_root = Path(_get(opts, 'nginx.ssl_root'))
+    plan = dict(create=[], update=[], remove=[], unchanged=[])
+
+    for domain, hub in sorted(desired.items()):
+        have = current.get(domain)
+        if have is None:
+            plan['create'].append(domain)
+            continue
+
+        inputs = manifest.inputs_hash(opts,
+                                      hub_ip=hub['hub_ip'],
+                                      hub_port=hub['hub_port'],
+                                      backends=hub['backends'],
+                                      cert_name=hub['cert_name'])
+        seen = known.get(domain)
+        if (have['ssl_dir'] != ssl_root/(hub['cert_name'] or domain) or
+                have['backends'] != backend_list(hub['backends'], hub['hub_ip'], hub['hub_port']) or
+                (seen is not None and seen.get('inputs') != inputs)):
+            plan['update'].append(domain)
+        else:
+            plan['unchanged'].append(domain)
+
+    if prune:
+        plan['remove'] = sorted(set(current) - set(desired))
+
+    return plan
+
+
+def apply_hubs(desired, opts=None, prune=True, keep_certificates=False, dry_run=False,
+               skip_dns_check=False, max_workers=8):
+    """ Bring generated vhosts in line with desired state.
+
+    desired -- output of parse_desired
+
+    Only hubs that need to be created, updated or removed are touched.
+    Hubs sharing the same settings are added in one batch, batches and
+    removals run concurrently, domain locks keep them from stepping on
+    each other. Certificates of removed hubs are revoked unless
+    keep_certificates is set.
+
+    Returns plan (see plan_changes) with `failed`: domain -> error added
+    """
+    opts = utils.default_opts(opts)
+    timing.configure(opts)
+
+    plan = plan_changes(desired, opts, prune=prune)
+    debug('{} to create, {} to update, {} to remove, {} unchanged'.format(
+        len(plan['create']), len(plan['update']), len(plan['remove']), len(plan['unchanged'])))
+    for action in ('create', 'update', 'remove'):
+        for domain in plan[action]:
+            debug(' {} {}'.format(action, domain))
+
+    plan['failed'] = {}
+    if dry_run:
+        return plan
+
+    batches = {}
+    for domain in plan['create'] + plan['update']:
+        hub = desired[domain]
+        k = (hub['hub_ip'], hub['hub_port'], tuple(hub['backends']), hub['cert_name'])
+        batches.setdefault(k, []).append(domain)
+
+    def add_batch(k, domains):
+        hub_ip, hub_port, backends, cert_name = k
+        try:
+            add_or_check_vhosts(domains,
+                                hub_ip=hub_ip,
+                                hub_port=hub_port,
+                                backends=list(backends),
+                                cert_name=cert_name,
+                                skip_dns_check=skip_dns_check,
+                                opts=opts)
+        except JhubNginxError as e:
+            return getattr(e, 'failed', None) or {d: e for d in domains}
+        return {}
+
+    def remove(domain):
+        try:
+            remove_vhost(domain, opts, keep_certificates=keep_certificates)
+        except JhubNginxError as e:
+            return {domain: e}
+        return {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        add_batch, remove = utils.same_output(add_batch), utils.same_output(remove)
+        futures = [pool.submit(add_batch, k, domains) for k, domains in batches.items()]
+        futures += [pool.submit(remove, domain) for domain in plan['remove']]
+        for f in futures:
+            plan['failed'].update(f.result())
+
+    return plan
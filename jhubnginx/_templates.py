@@ -2,10 +2,73 @@ DEFAULT_CFG = '''
 nginx:
    check_cmd: 'nginx -t'
    reload_cmd: 'systemctl reload nginx'
+   # seconds to wait for more changes before reloading, reloads requested
+   # within this window are combined into one
+   reload_window: 0
 
    sites: /etc/nginx/conf.d
    ssl_root: /etc/letsencrypt/live
 
+   # upstream pool of hub backends: balancing method is one of
+   # round_robin|least_conn|ip_hash|random, keepalive is the number of idle
+   # connections to the hub kept open per worker
+   upstream:
+     method: round_robin
+     keepalive: 32
+     keepalive_timeout: 60s
+     max_fails: 3
+     fail_timeout: 10s
+
+   # `per_vhost` writes <domain>.conf with a pair of server blocks for every
+   # hub, `consolidated` keeps all hubs in one file served by a single server
+   # pair, certificates are then looked up by SNI during handshake (nginx
+   # 1.15.9+) and reload cost stays close to flat as hubs are added. nginx 1.27.4+ can
+   # keep loaded certificates, e.g. certificate_cache: max=1000 inactive=60s
+   layout: per_vhost
+   consolidated:
+     certificate_cache: null
+
+   # `performance` turns on static_cache and gzip below
+   profile: default
+
+   # cache hub and notebook server static assets in nginx, cache headers sent
+   # by the hub are honoured, `valid` applies to responses without them
+   static_cache:
+     enabled: false
+     path: /var/cache/nginx/jhub-vhost
+     zone_size: 10m
+     max_size: 1g
+     inactive: 7d
+     valid: 1h
+
+   # compress text responses larger than min_length bytes, brotli needs
+   # ngx_brotli module
+   compression:
+     gzip: false
+     brotli: false
+     level: 5
+     min_length: 1024
+     types: application/json application/javascript text/css text/plain image/svg+xml
+
+   # long lived connections to single user servers: kernel websockets,
+   # terminals and event streams. `prefixes` are locations single user
+   # servers are proxied under, JupyterHub's base_url followed by user/
+   streaming:
+     prefixes:
+       - /user/
+     read_timeout: 1h
+     send_timeout: 1h
+     buffering: false
+
+   # per vhost access log with request and upstream timings, one
+   # <domain>.access.log per vhost, read by `jhub-vhost stats`. Writes are
+   # buffered up to `buffer` bytes or `flush` seconds, set path to null to
+   # keep using default access log
+   access_log:
+     path: /var/log/nginx/jhub-vhost
+     buffer: 64k
+     flush: 5s
+
    ssl_options: |
      ssl_session_timeout 1d;
      ssl_session_tickets off;
@@ -19,10 +82,103 @@ nginx:
      add_header X-Frame-Options DENY;
      add_header X-Content-Type-Options nosniff;
 
+   # TLS profile: `performance` adds shared session cache so returning clients
+   # skip full handshake and resolver needed for OCSP stapling. http3 adds QUIC
+   # listeners (reuseport is set once, in the shared config), needs nginx 1.25+
+   # built with http_v3 module
+   tls:
+     profile: default
+     session_cache: 10m
+     resolver: 1.1.1.1 8.8.8.8
+     http3: false
+
 letsencrypt:
    webroot: /var/www/letsencrypt
 
-dns: {}
+   # certificate issuance: number of concurrent requests, concurrent requests
+   # per registered domain, retries with exponential backoff (seconds).
+   # certbot can only run one at a time, workers matter for the acme backend
+   workers: 4
+   domain_concurrency: 2
+   max_tries: 3
+   retry_delay: 30
+   max_retry_delay: 600
+   rate_limit_delay: 900
+
+   # `jhub-vhost renew` renews certificates expiring within this many days
+   renew_before_days: 30
+
+   # certbot|acme, `acme` uses built-in ACME v2 client (needs cryptography)
+   # instead of running certbot for every certificate. `directory` can point
+   # to a test server like Pebble, `verify` is passed to requests (false or
+   # path to CA bundle). Account key defaults to <state_dir>/acme/account.key
+   backend: certbot
+   directory: https://acme-v02.api.letsencrypt.org/directory
+   verify: true
+
+   # also obtain ECDSA certificate, stored next to RSA one as <name>-ecdsa,
+   # nginx then serves ECDSA to clients that support it and RSA to the rest
+   ecdsa: false
+
+dns:
+   # seconds to cache zone and record listing of libcloud DNS providers
+   index_ttl: 3600
+
+# watching DNS changes propagate: name servers authoritative for the zone are
+# discovered via resolver and polled directly until quorum of them agree
+dns_watch:
+   resolver: 8.8.8.8
+   quorum: majority
+   timeout: 2
+   interval: 0.25
+   max_interval: 5
+
+templates:
+   # directory with templates overriding built-in ones, e.g. vhost.conf
+   path: null
+   # keep compiled templates under state_dir
+   bytecode_cache: false
+
+# record time spent in provisioning phases (public IP lookup, DNS check and
+# wait, certbot, nginx check and reload) as JSON lines and/or Prometheus
+# textfile-collector file, see also --timing command line option
+timing:
+   jsonl: null
+   prometheus: null
+
+# `jhub-vhost serve` listens on this socket
+daemon:
+   socket: /run/jhub-vhost.sock
+
+# where to keep cached state between runs
+state_dir: /var/lib/jhub-vhost
+
+# several jhub-vhost processes can work on different domains at the same
+# time, domains and certificates being changed are locked with files under
+# <state_dir>/locks. Seconds to wait for a lock held by another process:
+# `timeout` for domains/certificates (held while certbot runs),
+# `reload_timeout` for nginx reload and files shared by all vhosts
+locks:
+   timeout: 900
+   reload_timeout: 120
+
+# `add` remembers domains it configured and verified, running it again with
+# the same options skips public IP lookup, DNS check and nginx reload until
+# reverify_interval seconds have passed or the certificate has changed,
+# 0 always runs all the checks
+manifest:
+   reverify_interval: 21600
+
+public_ip:
+   # endpoints are queried concurrently, first valid answer wins
+   endpoints:
+     - http://instance-data/latest/meta-data/public-ipv4
+     - http://metadata/computeMetadata/v1/instance/network-interfaces/0/access-configs/0/external-ip
+     - https://api.ipify.org
+   headers:
+     Metadata-Flavor: Google
+   timeout: 2
+   cache_ttl: 3600
 '''
 
 NGINX_VHOST = '''{{header}}
@@ -42,34 +198,234 @@ server {
 }
 
 {% if not nossl %}
+{% include 'upstream.conf' %}
+
 server {
     server_name {{domain}};
     listen 443 ssl http2;
+{%- if nginx['tls']['http3'] %}
+    listen 443 quic;
+    add_header Alt-Svc 'h3=":443"; ma=86400';
+{%- endif %}
+
+    ssl_certificate_key     {{ssl_dir}}/privkey.pem;
+    ssl_certificate         {{ssl_dir}}/fullchain.pem;
+{%- if letsencrypt['ecdsa'] %}
+    ssl_certificate_key     {{ssl_dir}}-ecdsa/privkey.pem;
+    ssl_certificate         {{ssl_dir}}-ecdsa/fullchain.pem;
+{%- endif %}
+    ssl_trusted_certificate {{ssl_dir}}/fullchain.pem;
+
+{% include 'server.conf' %}
+}
+{% endif %}
+'''
+
+# upstream pool of one hub
+NGINX_UPSTREAM = '''upstream {{upstream}} {
+{%- if nginx['upstream']['method'] not in (None, 'round_robin') %}
+    {{nginx['upstream']['method']}};
+{%- endif %}
+{%- for b in backends %}
+    server {{b['address']}}{% if b['weight'] != 1 %} weight={{b['weight']}}{% endif %} max_fails={{nginx['upstream']['max_fails']}} fail_timeout={{nginx['upstream']['fail_timeout']}};
+{%- endfor %}
+{%- if nginx['upstream']['keepalive'] %}
+    keepalive {{nginx['upstream']['keepalive']}};
+    keepalive_timeout {{nginx['upstream']['keepalive_timeout']}};
+{%- endif %}
+}
+'''
+
+# body of TLS server block proxying to the hub, included by vhost.conf and hubs.conf
+NGINX_SERVER = '''{{indent(nginx['ssl_options'], 4)}}
+{%- if nginx['access_log']['path'] %}
 
-    ssl_certificate_key     {{nginx['ssl_root']}}/{{domain}}/privkey.pem;
-    ssl_certificate         {{nginx['ssl_root']}}/{{domain}}/fullchain.pem;
-    ssl_trusted_certificate {{nginx['ssl_root']}}/{{domain}}/fullchain.pem;
+    access_log {{nginx['access_log']['path']}}/{{log_name|default(domain)}}.access.log jhub_timing buffer={{nginx['access_log']['buffer']}} flush={{nginx['access_log']['flush']}};
+{%- endif %}
+{% set perf = nginx['profile'] == 'performance' %}
+{%- if perf or nginx['compression']['gzip'] %}
 
-{{indent(nginx['ssl_options'], 4)}}
+    gzip on;
+    gzip_proxied any;
+    gzip_vary on;
+    gzip_comp_level {{nginx['compression']['level']}};
+    gzip_min_length {{nginx['compression']['min_length']}};
+    gzip_types {{nginx['compression']['types']}};
+{%- endif %}
+{%- if nginx['compression']['brotli'] %}
+
+    brotli on;
+    brotli_comp_level {{nginx['compression']['level']}};
+    brotli_min_length {{nginx['compression']['min_length']}};
+    brotli_types {{nginx['compression']['types']}};
+{%- endif %}
+{%- set cache = perf or nginx['static_cache']['enabled'] %}
+{%- set streaming = nginx['streaming'] %}
+{%- macro proxy(pad='        ') %}
+{{pad}}proxy_pass http://{{upstream}};
+{{pad}}proxy_set_header X-Real-IP $remote_addr;
+{{pad}}proxy_set_header Host $host;
+{{pad}}proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+{{pad}}# keep connections to the hub open, upgrade websockets
+{{pad}}proxy_http_version 1.1;
+{{pad}}proxy_set_header Upgrade $http_upgrade;
+{{pad}}proxy_set_header Connection $jhub_connection_upgrade;
+{%- endmacro %}
+{%- macro cached(pad='        ') %}
+{{pad}}proxy_buffering on;
+{{pad}}proxy_cache jhub_static;
+{{pad}}proxy_cache_valid 200 {{nginx['static_cache']['valid']}};
+{{pad}}proxy_cache_use_stale error timeout updating;
+{{pad}}proxy_cache_lock on;
+{%- endmacro %}
+{%- if cache %}
+
+    # Static assets of the hub
+{%- for prefix in ['/hub/static/', '/static/'] %}
+    location ^~ {{prefix}} {
+{{- proxy() }}
+{{- cached() }}
+    }
+{%- endfor %}
+{%- endif %}
 
     # Managing literal requests to the JupyterHub front end
     location / {
-        proxy_pass http://{{hub_ip}}:{{hub_port}};
-        proxy_set_header X-Real-IP $remote_addr;
-        proxy_set_header Host $host;
-        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+{{- proxy() }}
     }
-    # Managing WebHook/Socket requests between hub user servers and external proxy
-    location ~* /(api/kernels/[^/]+/(channels|iopub|shell|stdin)|terminals/websocket)/? {
-        proxy_pass http://{{hub_ip}}:{{hub_port}};
-        proxy_set_header X-Real-IP $remote_addr;
-        proxy_set_header Host $host;
-        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
-        # WebSocket support
-        proxy_http_version 1.1;
-        proxy_set_header Upgrade $http_upgrade;
-        proxy_set_header Connection "upgrade";
+{%- for prefix in streaming['prefixes'] %}
+
+    # Single user servers: kernel websockets, terminals and event streams
+    location {{prefix}} {
+{{- proxy() }}
+        proxy_read_timeout {{streaming['read_timeout']}};
+        proxy_send_timeout {{streaming['send_timeout']}};
+        proxy_buffering {{'on' if streaming['buffering'] else 'off'}};
+{%- if cache %}
+
+        location ~ ^{{prefix}}[^/]+/(static|lab/static|nbextensions)/ {
+{{- proxy('            ') }}
+{{- cached('            ') }}
+        }
+{%- endif %}
     }
+{%- endfor %}
+'''
+
+# consolidated layout: every hub is an entry in the maps below, all of them
+# are served by one pair of server blocks
+NGINX_HUBS = '''{{header}}
+map $host $jhub_upstream {
+    default "";
+{%- for h in hubs %}
+    {{h['domain']}} {{h['upstream'] if h['ssl_dir'] else '""'}};
+{%- endfor %}
 }
-{% endif %}
+
+map $ssl_server_name $jhub_ssl_dir {
+    default "";
+{%- for h in hubs if h['ssl_dir'] %}
+    {{h['domain']}} {{h['ssl_dir']}};
+{%- endfor %}
+}
+{%- for h in hubs if h['ssl_dir'] %}
+{%- with upstream=h['upstream'], backends=h['backends'] %}
+
+{% include 'upstream.conf' %}
+{%- endwith %}
+{%- endfor %}
+{%- if hubs %}
+
+server {
+    listen 80;
+{%- for h in hubs %}
+    server_name {{h['domain']}};
+{%- endfor %}
+
+    # Hubs with certificates are redirected to HTTPS
+    location / {
+       if ($jhub_upstream = "") {
+          return 404;
+       }
+       return 302 https://$host$request_uri;
+    }
+
+    location ^~ /.well-known/acme-challenge/ {
+       default_type "text/plain";
+       root {{letsencrypt['webroot']}};
+    }
+}
+{%- endif %}
+{%- if hubs|selectattr('ssl_dir')|list %}
+
+server {
+    listen 443 ssl http2;
+{%- if nginx['tls']['http3'] %}
+    listen 443 quic;
+    add_header Alt-Svc 'h3=":443"; ma=86400';
+{%- endif %}
+{%- for h in hubs if h['ssl_dir'] %}
+    server_name {{h['domain']}};
+{%- endfor %}
+
+    # certificate is picked during handshake by SNI
+    ssl_certificate_key     $jhub_ssl_dir/privkey.pem;
+    ssl_certificate         $jhub_ssl_dir/fullchain.pem;
+{%- if letsencrypt['ecdsa'] %}
+    ssl_certificate_key     $jhub_ssl_dir-ecdsa/privkey.pem;
+    ssl_certificate         $jhub_ssl_dir-ecdsa/fullchain.pem;
+{%- endif %}
+{%- if nginx['consolidated']['certificate_cache'] %}
+    ssl_certificate_cache   {{nginx['consolidated']['certificate_cache']}};
+{%- endif %}
+
+    if ($jhub_upstream = "") {
+       return 404;
+    }
+
+{% include 'server.conf' %}
+}
+{%- endif %}
+
 '''
+
+# http level settings shared by all generated vhosts, written once
+NGINX_HTTP = '''{{header}}
+map $http_upgrade $jhub_connection_upgrade {
+    default upgrade;
+    ''      '';
+}
+{%- if nginx['access_log']['path'] %}
+log_format jhub_timing '$msec\\t$host\\t$request_method\\t$uri\\t$status\\t$http_upgrade\\t'
+                       '$request_time\\t$upstream_connect_time\\t$upstream_response_time\\t$body_bytes_sent';
+{%- endif %}
+{%- if nginx['tls']['profile'] == 'performance' %}
+ssl_session_cache shared:jhub_ssl:{{nginx['tls']['session_cache']}};
+resolver {{nginx['tls']['resolver']}} valid=300s;
+resolver_timeout 5s;
+{%- endif %}
+{%- if nginx['profile'] == 'performance' or nginx['static_cache']['enabled'] %}
+proxy_cache_path {{nginx['static_cache']['path']}} levels=1:2 use_temp_path=off
+                 keys_zone=jhub_static:{{nginx['static_cache']['zone_size']}}
+                 max_size={{nginx['static_cache']['max_size']}}
+                 inactive={{nginx['static_cache']['inactive']}};
+{%- endif %}
+{%- if nginx['tls']['http3'] %}
+
+# reuseport may appear only once per address, vhosts listen without it.
+# Names not served by any vhost are refused during handshake.
+server {
+    listen 443 quic reuseport;
+    ssl_reject_handshake on;
+}
+{%- endif %}
+
+'''
+
+TEMPLATES = {
+    'vhost.conf': NGINX_VHOST,
+    'http.conf': NGINX_HTTP,
+    'hubs.conf': NGINX_HUBS,
+    'server.conf': NGINX_SERVER,
+    'upstream.conf': NGINX_UPSTREAM,
+}
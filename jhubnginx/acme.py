@@ -0,0 +1,365 @@
+""" Built-in ACME v2 client, an alternative to running certbot for every certificate.
+
+Uses one account key and one pooled HTTP session for all orders, solves
+http-01 challenges by writing tokens into `letsencrypt.webroot` and stores
+certificates in `nginx.ssl_root/<name>/` using the same file names as
+certbot: privkey.pem, cert.pem, chain.pem and fullchain.pem.
+
+Needs `cryptography` library. Enable with `letsencrypt.backend: acme`.
+"""
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from pydash import get as _get
+
+from .certs import CertIssueError, classify_certbot_error, PERMANENT, TRANSIENT
+
+LETSENCRYPT_DIRECTORY = 'https://acme-v02.api.letsencrypt.org/directory'
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _crypto():
+    try:
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec, rsa, utils as asym_utils
+        from cryptography.x509.oid import NameOID
+    except ImportError:
+        raise CertIssueError('Built-in ACME client needs cryptography library', PERMANENT)
+
+    return dict(x509=x509, hashes=hashes, serialization=serialization,
+                ec=ec, rsa=rsa, asym_utils=asym_utils, NameOID=NameOID)
+
+
+def _write_private(path, data):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    fd = os.open(str(tmp), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(str(tmp), str(path))
+
+
+class AcmeError(CertIssueError):
+    def __init__(self, problem, status=None):
+        if isinstance(problem, dict):
+            msg = '{} {}'.format(problem.get('type', ''), problem.get('detail', '')).strip()
+        else:
+            msg = str(problem)
+
+        kind = classify_certbot_error(msg)
+        if status is not None and status >= 500:
+            kind = TRANSIENT
+        CertIssueError.__init__(self, 'ACME error: {}'.format(msg), kind)
+        self.problem = problem
+
+
+def _json(r):
+    """ JSON object in ACME server response, AcmeError if there is none
+    """
+    try:
+        obj = r.json()
+    except ValueError:
+        obj = None
+    if not isinstance(obj, dict):
+        raise AcmeError('Malformed response from ACME server ({} {})'.format(r.status_code, r.url), r.status_code)
+    return obj
+
+
+def _field(obj, *path):
+    """ obj[path[0]][path[1]]..., AcmeError when ACME server left it out
+    """
+    for k in path:
+        try:
+            obj = obj[k]
+        except (KeyError, IndexError, TypeError):
+            raise AcmeError('Malformed response from ACME server, missing {}'.format('.'.join(map(str, path))))
+    return obj
+
+
+def _location(r):
+    url = r.headers.get('Location')
+    if not url:
+        raise AcmeError('Malformed response from ACME server, no Location for {}'.format(r.url))
+    return url
+
+
+class AcmeClient(object):
+    """ Thread safe ACME v2 client, one per account.
+    """
+    def __init__(self, directory_url, account_key_path, email=None, verify=True, timeout=30,
+                 poll_interval=1, poll_timeout=120, message=lambda x: None):
+        import requests
+
+        c = _crypto()
+        self._c = c
+        self._directory_url = directory_url
+        self._email = email
+        self._timeout = timeout
+        self._poll_interval = poll_interval
+        self._poll_timeout = poll_timeout
+        self._message = message
+        self._lock = threading.Lock()
+        self._account_lock = threading.Lock()
+        self._nonces = []
+        self._directory = None
+        self._kid = None
+
+        self._session = requests.Session()
+        self._session.verify = verify
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+        key_path = Path(account_key_path)
+        if key_path.exists():
+            with open(str(key_path), 'rb') as f:
+                self._key = c['serialization'].load_pem_private_key(f.read(), password=None)
+        else:
+            self._key = c['ec'].generate_private_key(c['ec'].SECP256R1())
+            _write_private(key_path, self._key.private_bytes(
+                c['serialization'].Encoding.PEM,
+                c['serialization'].PrivateFormat.PKCS8,
+                c['serialization'].NoEncryption()))
+
+        nums = self._key.public_key().public_numbers()
+        self._jwk = dict(crv='P-256', kty='EC',
+                         x=b64(nums.x.to_bytes(32, 'big')),
+                         y=b64(nums.y.to_bytes(32, 'big')))
+        jwk_json = json.dumps(self._jwk, sort_keys=True, separators=(',', ':'))
+        self._thumbprint = b64(hashlib.sha256(jwk_json.encode('utf-8')).digest())
+
+    def _request(self, method, url, **kwargs):
+        try:
+            r = self._session.request(method, url, timeout=self._timeout, **kwargs)
+        except IOError as e:
+            raise CertIssueError('Failed to talk to ACME server: {}'.format(e))
+
+        nonce = r.headers.get('Replay-Nonce')
+        if nonce:
+            with self._lock:
+                self._nonces.append(nonce)
+        return r
+
+    def directory(self):
+        if self._directory is None:
+            r = self._request('GET', self._directory_url)
+            if not r.ok:
+                raise AcmeError('Failed to fetch directory {}'.format(self._directory_url), r.status_code)
+            self._directory = _json(r)
+        return self._directory
+
+    def _endpoint(self, name):
+        return _field(self.directory(), name)
+
+    def _nonce(self):
+        with self._lock:
+            if self._nonces:
+                return self._nonces.pop()
+
+        self._request('HEAD', self._endpoint('newNonce'))
+        with self._lock:
+            if not self._nonces:
+                raise CertIssueError('ACME server did not supply a nonce')
+            return self._nonces.pop()
+
+    def _sign(self, url, payload, use_jwk=False):
+        c = self._c
+        protected = dict(alg='ES256', nonce=self._nonce(), url=url)
+        if use_jwk:
+            protected['jwk'] = self._jwk
+        else:
+            protected['kid'] = self.account()
+
+        protected = b64(json.dumps(protected).encode('utf-8'))
+        payload = '' if payload is None else b64(json.dumps(payload).encode('utf-8'))
+        der = self._key.sign('{}.{}'.format(protected, payload).encode('ascii'),
+                             c['ec'].ECDSA(c['hashes'].SHA256()))
+        r, s = c['asym_utils'].decode_dss_signature(der)
+        return dict(protected=protected, payload=payload,
+                    signature=b64(r.to_bytes(32, 'big') + s.to_bytes(32, 'big')))
+
+    def post(self, url, payload=None, use_jwk=False):
+        """ Signed POST, payload None means POST-as-GET
+        """
+        for attempt in range(3):
+            body = self._sign(url, payload, use_jwk=use_jwk)
+            r = self._request('POST', url, data=json.dumps(body),
+                              headers={'Content-Type': 'application/jose+json'})
+            if r.ok:
+                return r
+
+            try:
+                problem = _json(r)
+            except AcmeError:
+                problem = dict(detail=r.text)
+
+            if str(problem.get('type', '')).endswith(':badNonce'):
+                continue
+            raise AcmeError(problem, r.status_code)
+
+        raise AcmeError(problem, r.status_code)
+
+    def account(self):
+        """ Register (or look up) account, returns account URL
+        """
+        with self._account_lock:
+            if self._kid is None:
+                payload = dict(termsOfServiceAgreed=True)
+                if self._email:
+                    payload['contact'] = ['mailto:' + self._email]
+
+                r = self.post(self._endpoint('newAccount'), payload, use_jwk=True)
+                self._kid = _location(r)
+            return self._kid
+
+    def _poll(self, url, pending=('pending', 'processing')):
+        t0 = time.time()
+        while True:
+            r = self.post(url)
+            obj = _json(r)
+            if obj.get('status') not in pending:
+                return obj
+
+            if time.time() - t0 > self._poll_timeout:
+                raise CertIssueError('Timed out waiting for ACME server: {}'.format(url))
+
+            try:
+                delay = float(r.headers.get('Retry-After', self._poll_interval))
+            except ValueError:
+                delay = self._poll_interval
+            time.sleep(min(max(delay, 0.1), 10))
+
+    def _authorize(self, authz_url, webroot):
+        authz = _json(self.post(authz_url))
+        if authz.get('status') == 'valid':
+            return
+
+        domain = _field(authz, 'identifier', 'value')
+        challenges = [ch for ch in authz.get('challenges', [])
+                      if isinstance(ch, dict) and ch.get('type') == 'http-01']
+        if not challenges:
+            raise CertIssueError('No http-01 challenge offered for {}'.format(domain), PERMANENT)
+
+        ch = challenges[0]
+        token = _field(ch, 'token')
+        if not isinstance(token, str) or '/' in token or token in ('', '.', '..'):
+            raise AcmeError('Malformed challenge token from ACME server: {!r}'.format(token))
+        token_file = Path(webroot)/'.well-known'/'acme-challenge'/token
+        token_file.parent.mkdir(parents=True, exist_ok=True)
+        token_file.write_text('{}.{}'.format(token, self._thumbprint))
+
+        try:
+            self.post(_field(ch, 'url'), {})
+            authz = self._poll(authz_url)
+        finally:
+            try:
+                token_file.unlink()
+            except OSError:
+                pass
+
+        if authz.get('status') != 'valid':
+            problems = [c.get('error') for c in authz.get('challenges', []) if c.get('error')]
+            raise AcmeError(problems[0] if problems else 'Authorization failed for {}'.format(domain))
+
+    def issue(self, domains, ssl_dir, webroot, key_type='rsa'):
+        """ Obtain certificate for domains and store it in ssl_dir
+        """
+        c = self._c
+        self._message('Requesting certificate for {}'.format(', '.join(domains)))
+
+        r = self.post(self._endpoint('newOrder'),
+                      dict(identifiers=[dict(type='dns', value=d) for d in domains]))
+        order_url = _location(r)
+        order = _json(r)
+
+        for authz_url in _field(order, 'authorizations'):
+            self._authorize(authz_url, webroot)
+
+        if key_type == 'ecdsa':
+            key = c['ec'].generate_private_key(c['ec'].SECP256R1())
+        else:
+            key = c['rsa'].generate_private_key(public_exponent=65537, key_size=2048)
+
+        x509 = c['x509']
+        csr = (x509.CertificateSigningRequestBuilder()
+               .subject_name(x509.Name([x509.NameAttribute(c['NameOID'].COMMON_NAME, domains[0])]))
+               .add_extension(x509.SubjectAlternativeName([x509.DNSName(d) for d in domains]), critical=False)
+               .sign(key, c['hashes'].SHA256()))
+
+        self.post(_field(order, 'finalize'), dict(csr=b64(csr.public_bytes(c['serialization'].Encoding.DER))))
+        order = self._poll(order_url, pending=('pending', 'ready', 'processing'))
+        if order.get('status') != 'valid':
+            raise AcmeError(order.get('error', 'Order failed for {}'.format(', '.join(domains))))
+
+        fullchain = self.post(_field(order, 'certificate')).text
+        end = '-----END CERTIFICATE-----'
+        if end not in fullchain:
+            raise AcmeError('ACME server returned no certificate for {}'.format(', '.join(domains)))
+        cert = fullchain[:fullchain.index(end) + len(end)] + '\n'
+        chain = fullchain[len(cert):].lstrip()
+
+        ssl_dir = Path(ssl_dir)
+        _write_private(ssl_dir/'privkey.pem', key.private_bytes(
+            c['serialization'].Encoding.PEM,
+            c['serialization'].PrivateFormat.TraditionalOpenSSL,
+            c['serialization'].NoEncryption()))
+        for name, txt in [('cert.pem', cert), ('chain.pem', chain), ('fullchain.pem', fullchain)]:
+            _write_private(ssl_dir/name, txt.encode('ascii'))
+
+        return True
+
+    def revoke(self, cert_path):
+        c = self._c
+        with open(str(cert_path), 'rb') as f:
+            cert = c['x509'].load_pem_x509_certificate(f.read())
+
+        der = cert.public_bytes(c['serialization'].Encoding.DER)
+        self.post(self._endpoint('revokeCert'), dict(certificate=b64(der)))
+        return True
+
+
+def acme_client(opts, message=lambda x: None):
+    """ Client shared by everyone in this process using the same account
+    """
+    cfg = _get(opts, 'letsencrypt', {})
+    directory = cfg.get('directory') or LETSENCRYPT_DIRECTORY
+    key_path = cfg.get('account_key') or str(Path(_get(opts, 'state_dir'))/'acme'/'account.key')
+    verify = cfg.get('verify', True)
+
+    k = (directory, key_path)
+    with _clients_lock:
+        client = _clients.get(k)
+        if client is None:
+            client = AcmeClient(directory, key_path,
+                                email=cfg.get('email'),
+                                verify=verify,
+                                message=message)
+            _clients[k] = client
+    return client
+
+
+def issue(domains, opts, cert_name=None, key_type='rsa', message=lambda x: None):
+    """ Obtain certificate covering domains, stored in `nginx.ssl_root/<cert_name or first domain>`
+    """
+    if isinstance(domains, str):
+        domains = [domains]
+
+    ssl_dir = Path(_get(opts, 'nginx.ssl_root'))/(cert_name or domains[0])
+    return acme_client(opts, message=message).issue(domains, ssl_dir, _get(opts, 'letsencrypt.webroot'),
+                                                    key_type=key_type)
+
+
+def revoke(cert_path, opts, message=lambda x: None):
+    return acme_client(opts, message=message).revoke(cert_path)
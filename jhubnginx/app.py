@@ -1,9 +1,9 @@
 import click
 import sys
+from pydash import get as _get
 
 from .utils import JhubNginxError
 from . import utils
-from ._impl import add_or_check_vhost, remove_vhost
 
 
 def message(msg):
@@ -24,16 +24,65 @@ def parse_config(ctx, param, value):
     ctx.obj['opts'] = utils.opts_update_from_env(opts)
 
 
+def set_socket(ctx, param, value):
+    if ctx.obj is None:
+        ctx.obj = {}
+
+    ctx.obj['socket'] = value
+
+
+def forward(ctx, cmd, **args):
+    """ Run command on jhub-vhost daemon, print its output and exit
+    """
+    from .server import request, DaemonError
+
+    try:
+        resp = request(ctx['socket'], cmd, **args)
+    except DaemonError as e:
+        message(str(e))
+        sys.exit(1)
+
+    if resp.get('output'):
+        click.echo(resp['output'], nl=False)
+    if resp.get('error'):
+        message(resp['error'])
+
+    if not resp.get('ok'):
+        sys.exit(1)
+
+    return resp.get('result')
+
+
 @click.group()
 @click.option('--config', '-c', help='Supply config file', callback=parse_config)
-def cli(config):
-    pass
+@click.option('--socket', type=str, envvar='JHUB_VHOST_SOCKET', callback=set_socket, expose_value=False,
+              help="Send commands to jhub-vhost daemon listening on this Unix socket")
+@click.option('--timing', type=str, envvar='JHUB_VHOST_TIMING',
+              help="Record time spent in each phase to this file, "
+              "Prometheus textfile format for *.prom, JSON lines otherwise")
+@click.pass_obj
+def cli(ctx, config, timing):
+    if timing is not None:
+        ctx['opts'].setdefault('timing', {})['prometheus' if timing.endswith('.prom') else 'jsonl'] = timing
+
+
+def read_domains_file(filename):
+    txt = utils.slurp(filename)
+    if txt is None:
+        raise click.BadParameter("Failed to read {}".format(filename))
+
+    lines = (l.split('#')[0].strip() for l in txt.splitlines())
+    return [l for l in lines if l]
 
 
 @cli.command('add')
-@click.argument('domain', type=str)
+@click.argument('domains', type=str, nargs=-1)
+@click.option('--domains-file', '-f', type=str, help="Read domain names from a file, one per line")
 @click.option('--hub-ip', type=str, default='127.0.0.1', help="IP JupyterHub is running on")
 @click.option('--hub-port', type=int, default=8000, help="Port JupyterHub is running on")
+@click.option('--backend', 'backends', type=str, multiple=True,
+              help="Hub backend ADDRESS[@WEIGHT] (host:port or unix:/path), can be repeated, "
+              "replaces --hub-ip/--hub-port")
 @click.option('--skip-dns-check', default=False, is_flag=True, help="Don't check DNS record")
 @click.option('--email', type=str, help="Supply E-mail address for Let's Encrypt")
 @click.option('--token', type=str, help="Supply `duckdns.org` token for updating DNS entry")
@@ -41,27 +90,53 @@ def cli(config):
               help="Use route53 DNS provider with credentials queried with boto3")
 @click.option('--standalone', default=False, is_flag=True,
               help="Obtain SSL certs using standalone mode of certbot (no nginx running)")
+@click.option('--cert-name', type=str,
+              help="Share one certificate with this name between all supplied domains")
+@click.option('--refresh-ip', default=False, is_flag=True, help="Ignore cached public IP")
 @click.pass_obj
-def add(ctx, domain, hub_ip, hub_port, skip_dns_check, email, token, route53, standalone):
+def add(ctx, domains, domains_file, hub_ip, hub_port, backends, skip_dns_check, email, token, route53, standalone,
+        cert_name, refresh_ip):
     """ Create new or update existing proxy config
+
+    Multiple domains can be supplied at once, nginx is then reloaded only
+    twice for the whole batch.
     """
     opts = ctx['opts']
+    domains = list(domains)
+
+    if domains_file is not None:
+        domains += read_domains_file(domains_file)
+
+    if len(domains) == 0:
+        raise click.UsageError("Need at least one domain")
 
-    if email is not None:
-        opts['letsencrypt']['email'] = email
+    overrides = dict(email=email, token=token, route53=route53, refresh_ip=refresh_ip)
 
-    if token is not None:
-        opts['dns']['token'] = token
-    elif route53:
-        opts['dns']['type'] = 'route53'
+    if ctx['socket'] is not None:
+        forward(ctx, 'add',
+                domains=domains,
+                hub_ip=hub_ip,
+                hub_port=hub_port,
+                backends=list(backends),
+                skip_dns_check=skip_dns_check,
+                standalone=standalone,
+                cert_name=cert_name,
+                overrides=overrides)
+        sys.exit(0)
+
+    from ._impl import add_or_check_vhosts
+
+    utils.apply_overrides(opts, **overrides)
 
     try:
-        add_or_check_vhost(domain,
-                           hub_ip=hub_ip,
-                           hub_port=hub_port,
-                           skip_dns_check=skip_dns_check,
-                           standalone=standalone,
-                           opts=opts)
+        add_or_check_vhosts(domains,
+                            hub_ip=hub_ip,
+                            hub_port=hub_port,
+                            backends=list(backends),
+                            skip_dns_check=skip_dns_check,
+                            standalone=standalone,
+                            cert_name=cert_name,
+                            opts=opts)
     except JhubNginxError as e:
         print(e)
         sys.exit(1)
@@ -80,6 +155,12 @@ def remove(ctx, domain, keep_certificates):
     """
     opts = ctx['opts']
 
+    if ctx['socket'] is not None:
+        forward(ctx, 'remove', domain=domain, keep_certificates=keep_certificates)
+        sys.exit(0)
+
+    from ._impl import remove_vhost
+
     try:
         remove_vhost(domain, opts, keep_certificates=keep_certificates)
     except JhubNginxError as e:
@@ -89,23 +170,88 @@ def remove(ctx, domain, keep_certificates):
     sys.exit(0)
 
 
+@cli.command('apply')
+@click.option('--file', '-f', 'filename', type=str, required=True, help="YAML file listing desired hubs")
+@click.option('--prune/--no-prune', default=None,
+              help="Remove generated vhosts not listed in the file, on by default unless the file lists no hubs")
+@click.option('--keep-certificates', default=False, is_flag=True,
+              help="Don't revoke certificates of pruned vhosts")
+@click.option('--dry-run', default=False, is_flag=True, help="Only show what would change")
+@click.option('--skip-dns-check', default=False, is_flag=True, help="Don't check DNS records")
+@click.option('--email', type=str, help="Supply E-mail address for Let's Encrypt")
+@click.pass_obj
+def apply(ctx, filename, prune, keep_certificates, dry_run, skip_dns_check, email):
+    """ Create, update and remove vhosts to match hubs listed in a file
+
+    Only hubs that differ from what is configured are touched.
+    """
+    import yaml
+    from ._impl import parse_desired
+
+    txt = utils.slurp(filename)
+    if txt is None:
+        raise click.BadParameter("Failed to read {}".format(filename))
+
+    try:
+        desired = parse_desired(yaml.safe_load(txt))
+    except (yaml.YAMLError, JhubNginxError) as e:
+        raise click.BadParameter("{}: {}".format(filename, e))
+
+    if prune is None:
+        if not desired:
+            raise click.BadParameter("{} lists no hubs, pass --prune to remove all vhosts".format(filename))
+        prune = True
+
+    overrides = dict(email=email)
+    args = dict(prune=prune,
+                keep_certificates=keep_certificates,
+                dry_run=dry_run,
+                skip_dns_check=skip_dns_check)
+
+    if ctx['socket'] is not None:
+        result = forward(ctx, 'apply', desired=desired, overrides=overrides, **args)
+    else:
+        from ._impl import apply_hubs
+
+        opts = ctx['opts']
+        utils.apply_overrides(opts, **overrides)
+
+        try:
+            result = apply_hubs(desired, opts, **args)
+        except JhubNginxError as e:
+            print(e)
+            sys.exit(1)
+
+    for domain, err in sorted(result['failed'].items()):
+        message('Failed {}: {}'.format(domain, err))
+
+    sys.exit(0 if not result['failed'] else 1)
+
+
 @cli.command('dns')
 @click.option('--update/--no-update', default=True, help="Whether to attempt DNS update")
 @click.option('--route53', default=False, is_flag=True,
               help="Use route53 DNS provider with credentials queried with boto3")
 @click.option('--token', type=str, help="Supply `duckdns.org` token for updating DNS entry")
+@click.option('--refresh-ip', default=False, is_flag=True, help="Ignore cached public IP")
 @click.argument('domain', type=str)
 @click.pass_obj
-def dns(ctx, domain, update, route53=None, token=None):
+def dns(ctx, domain, update, route53=None, token=None, refresh_ip=False):
     """ Check if DNS record is up to date
     """
     from . import dns
 
     opts = ctx['opts']
-    if token is not None:
-        opts['dns']['token'] = token
-    elif route53:
-        opts['dns']['type'] = 'route53'
+    overrides = dict(token=token, route53=route53, refresh_ip=refresh_ip)
+
+    if ctx['socket'] is not None:
+        result = forward(ctx, 'dns', domains=[domain], no_update=not update, overrides=overrides)
+        ok, msg = result[domain]
+        if msg:
+            message(msg)
+        sys.exit(0 if ok else 1)
+
+    utils.apply_overrides(opts, **overrides)
 
     try:
         result = dns.check_dns(domain,
@@ -122,3 +268,128 @@ def dns(ctx, domain, update, route53=None, token=None):
         sys.exit(1)
 
     sys.exit(0)
+
+
+@cli.command('renew')
+@click.argument('domains', type=str, nargs=-1)
+@click.option('--days', type=int, help="Renew certificates expiring within this many days")
+@click.option('--dry-run', default=False, is_flag=True, help="Only report certificates that are due")
+@click.option('--email', type=str, help="Supply E-mail address for Let's Encrypt")
+@click.pass_obj
+def renew(ctx, domains, days, dry_run, email):
+    """ Renew certificates of generated vhosts that expire soon
+
+    Only certificates used by DOMAINS are considered if any are given.
+    Nginx is reloaded once after all certificates are renewed.
+    """
+    opts = ctx['opts']
+    domains = list(domains) or None
+    overrides = dict(email=email)
+
+    if ctx['socket'] is not None:
+        result = forward(ctx, 'renew',
+                         domains=domains,
+                         renew_before_days=days,
+                         dry_run=dry_run,
+                         overrides=overrides)
+        sys.exit(0 if all(err is None for err in result.values()) else 1)
+
+    from ._impl import renew_certificates
+
+    utils.apply_overrides(opts, **overrides)
+
+    try:
+        result = renew_certificates(opts,
+                                    domains=domains,
+                                    renew_before_days=days,
+                                    dry_run=dry_run)
+    except JhubNginxError as e:
+        print(e)
+        sys.exit(1)
+
+    for ssl_dir, err in result.items():
+        if err is not None:
+            message('Failed to renew {}: {}'.format(ssl_dir, err))
+
+    sys.exit(0 if all(err is None for err in result.values()) else 1)
+
+
+@cli.command('stats')
+@click.argument('files', type=str, nargs=-1)
+@click.option('--domain', '-d', 'domains', type=str, multiple=True, help="Only report this domain")
+@click.option('--follow', '-F', default=False, is_flag=True, help="Keep reading appended log lines")
+@click.option('--interval', type=float, default=10, help="Seconds between reports with --follow")
+@click.pass_obj
+def stats(ctx, files, domains, follow, interval):
+    """ Request rates and latency percentiles from vhost access logs
+
+    Reads FILES or all logs under nginx.access_log.path, reports per domain
+    and route class (static, api, websocket, page).
+    """
+    import time
+    from .stats import LogStats, log_files, follow_lines, format_report
+
+    paths = list(files) or log_files(ctx['opts'])
+    if not paths:
+        message('No access logs found, check nginx.access_log.path')
+        sys.exit(1)
+
+    acc = LogStats()
+    last_report = time.monotonic()
+    try:
+        for line in follow_lines(paths, follow=follow):
+            if line is not None:
+                acc.add_line(line)
+            elif time.monotonic() - last_report >= interval:
+                message(format_report(acc.report(domains)) + '\n')
+                last_report = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+
+    message(format_report(acc.report(domains)))
+
+
+@cli.command('locks')
+@click.pass_obj
+def show_locks(ctx):
+    """ Show domains, certificates and nginx reload locked by running jhub-vhost processes
+    """
+    from .locks import holders, describe_holder
+
+    for h in holders(ctx['opts']):
+        message('{}: {}'.format(h['name'], describe_holder(h)))
+
+
+@cli.command('serve')
+@click.option('--socket', 'socket_path', type=str, help="Unix socket to listen on (daemon.socket)")
+@click.pass_obj
+def serve(ctx, socket_path):
+    """ Run as a daemon serving add/remove/dns/status requests.
+
+    Other jhub-vhost invocations talk to it when given --socket or
+    JHUB_VHOST_SOCKET.
+    """
+    from .server import serve, DaemonError
+
+    opts = ctx['opts']
+    socket_path = socket_path or ctx['socket'] or _get(opts, 'daemon.socket')
+
+    try:
+        serve(socket_path, opts, message=message)
+    except DaemonError as e:
+        message(str(e))
+        sys.exit(1)
+
+
+@cli.command('status')
+@click.pass_obj
+def status(ctx):
+    """ Show vhosts known to jhub-vhost daemon
+    """
+    if ctx['socket'] is None:
+        raise click.UsageError("Need --socket or JHUB_VHOST_SOCKET to query daemon")
+
+    result = forward(ctx, 'status')
+    message('Daemon pid: {}'.format(result['pid']))
+    for domain, info in sorted(result['vhosts'].items()):
+        message('{} {}'.format(domain, info['ssl_dir']))
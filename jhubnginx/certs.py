@@ -0,0 +1,398 @@
+import calendar
+import random
+import re
+import ssl
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from pydash import get as _get
+
+from .utils import JhubNginxError
+from . import timing, utils
+
+TRANSIENT = 'transient'
+RATE_LIMITED = 'rate-limited'
+PERMANENT = 'permanent'
+
+# Substrings of certbot/ACME error output, matched case-insensitively
+RATE_LIMIT_PATTERNS = [
+    'ratelimited',
+    'rate limit',
+    'too many certificates',
+    'too many failed authorizations',
+    'too many new orders',
+    'too many registrations',
+    'too many requests',
+]
+
+PERMANENT_PATTERNS = [
+    'unauthorized',
+    'rejectedidentifier',
+    'invalid response from',
+    'dns problem',
+    'nxdomain',
+    'caa record',
+    'invalidemail',
+    'invalidcontact',
+    'malformed',
+    'policy forbids',
+    'unsupportedidentifier',
+]
+
+# Public suffixes with more than one label, enough to group domains for
+# rate limiting purposes without pulling in the full public suffix list.
+MULTI_LABEL_SUFFIXES = {
+    'co.uk', 'org.uk', 'ac.uk', 'gov.uk',
+    'com.au', 'net.au', 'org.au', 'edu.au', 'gov.au',
+    'co.nz', 'org.nz', 'co.jp', 'co.za', 'com.br', 'com.cn',
+    'duckdns.org',
+}
+
+
+# certbot holds a lock on its config directory, concurrent runs fail with this
+CERTBOT_BUSY = 'another instance of certbot is already running'
+
+_certbot_lock = threading.Lock()
+
+
+class CertIssueError(JhubNginxError):
+    def __init__(self, msg, kind=TRANSIENT):
+        JhubNginxError.__init__(self, msg)
+        self.kind = kind
+
+
+def classify_certbot_error(txt):
+    """ Map certbot output to one of TRANSIENT|RATE_LIMITED|PERMANENT
+    """
+    txt = txt.lower()
+
+    if any(p in txt for p in RATE_LIMIT_PATTERNS):
+        return RATE_LIMITED
+    if any(p in txt for p in PERMANENT_PATTERNS):
+        return PERMANENT
+
+    return TRANSIENT
+
+
+def registered_domain(domain, suffixes=MULTI_LABEL_SUFFIXES):
+    """ Approximate registered domain: jupyter.example.com -> example.com
+    """
+    parts = domain.rstrip('.').lower().split('.')
+    for n in (3, 2):
+        if len(parts) > n and '.'.join(parts[-n:]) in suffixes:
+            return '.'.join(parts[-n-1:])
+    return '.'.join(parts[-2:])
+
+
+def backoff_delay(attempt, base, max_delay):
+    """ Exponential backoff with jitter, attempt counts from 0
+    """
+    delay = min(max_delay, base * (2 ** attempt))
+    return delay/2 + random.uniform(0, delay/2)
+
+
+class DomainThrottle(object):
+    """ Limits number of concurrent requests per registered domain and
+        lets a rate limited domain be paused for everyone.
+    """
+    def __init__(self, concurrency=1):
+        self._concurrency = concurrency
+        self._cond = threading.Condition()
+        self._active = {}
+        self._not_before = {}
+
+    def acquire(self, key):
+        with self._cond:
+            while True:
+                wait = self._not_before.get(key, 0) - time.time()
+                if wait <= 0 and self._active.get(key, 0) < self._concurrency:
+                    self._active[key] = self._active.get(key, 0) + 1
+                    return
+                self._cond.wait(timeout=wait if wait > 0 else None)
+
+    def release(self, key):
+        with self._cond:
+            self._active[key] -= 1
+            self._cond.notify_all()
+
+    def pause(self, key, delay):
+        with self._cond:
+            self._not_before[key] = max(self._not_before.get(key, 0), time.time() + delay)
+            self._cond.notify_all()
+
+
+def ecdsa_name(name):
+    """ Name of ECDSA certificate issued alongside RSA one
+    """
+    return name + '-ecdsa'
+
+
+def certbot_cmd(domains, opts, standalone=False, cert_name=None, extra_args=()):
+    """ domains -- single domain or a list of domains to include in one certificate
+    """
+    if isinstance(domains, str):
+        domains = [domains]
+
+    email = _get(opts, 'letsencrypt.email')
+
+    if standalone:
+        cmd = ('certbot certonly'
+               ' --standalone'
+               ' --text --agree-tos --no-eff-email'
+               ' --email {email}').format(
+                   email=email).split()
+    else:
+        webroot = Path(_get(opts, 'letsencrypt.webroot'))
+        cmd = ('certbot certonly'
+               ' --webroot -w {webroot}'
+               ' --text --agree-tos --no-eff-email'
+               ' --email {email}').format(
+                   email=email,
+                   webroot=webroot).split()
+
+    if cert_name is not None:
+        cmd += ['--non-interactive', '--cert-name', cert_name]
+
+    for domain in domains:
+        cmd += ['--domains', domain]
+
+    return cmd + list(extra_args)
+
+
+def run_certbot(domains, opts, standalone=False, cert_name=None, extra_args=(), message=lambda x: None):
+    """ Run certbot once, raises CertIssueError with classified failure
+
+    domains -- single domain or a list of domains, when cert_name is supplied
+               certificate with that name is created or re-issued to cover
+               exactly the given list of domains
+    """
+    what = domains if isinstance(domains, str) else ', '.join(domains)
+    cmd = certbot_cmd(domains, opts,
+                      standalone=standalone,
+                      cert_name=cert_name,
+                      extra_args=extra_args)
+    message('Running certbot for {}'.format(what))
+    out = _certbot(cmd, opts, message=message)
+    message(out)
+    return True
+
+
+def _certbot(cmd, opts, message=lambda x: None):
+    """ Run certbot command, one at a time in this process.
+
+    certbot started by another process holds certbot's lock, waiting for it
+    (up to `locks.timeout` seconds) is not counted as a failed attempt.
+
+    Returns output, raises CertIssueError with classified failure
+    """
+    deadline = time.time() + float(_get(opts, 'locks.timeout', 900))
+
+    with _certbot_lock:
+        while True:
+            try:
+                return subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode('utf-8', 'replace')
+            except FileNotFoundError:
+                raise CertIssueError('certbot is not installed', PERMANENT)
+            except subprocess.CalledProcessError as e:
+                out = e.output.decode('utf-8', 'replace') if e.output else ''
+
+            if CERTBOT_BUSY not in out.lower() or time.time() > deadline:
+                message(out)
+                raise CertIssueError('certbot reported an error', classify_certbot_error(out))
+
+            message('Another certbot is running, waiting for it to finish')
+            time.sleep(random.uniform(0.5, 2))
+
+
+def _obtain_one(domains, opts, standalone, cert_name, key_type, force, message):
+    backend = _get(opts, 'letsencrypt.backend', 'certbot')
+
+    with timing.span(backend, cert=cert_name or domains[0], key_type=key_type, domains=len(domains)):
+        return _obtain_with(backend, domains, opts, standalone, cert_name, key_type, force, message)
+
+
+def _obtain_with(backend, domains, opts, standalone, cert_name, key_type, force, message):
+
+    if backend == 'certbot':
+        extra_args = ['--force-renewal'] if force else []
+        # certbot 2.0+ defaults to ECDSA, always say which one is wanted
+        if key_type == 'ecdsa':
+            extra_args += ['--key-type', 'ecdsa', '--elliptic-curve', 'secp256r1']
+        else:
+            extra_args += ['--key-type', 'rsa']
+        return run_certbot(domains, opts,
+                           standalone=standalone,
+                           cert_name=cert_name,
+                           extra_args=extra_args,
+                           message=message)
+
+    if backend != 'acme':
+        raise CertIssueError('Unknown letsencrypt.backend: {}'.format(backend), PERMANENT)
+    if standalone:
+        raise CertIssueError('Standalone mode needs certbot backend', PERMANENT)
+
+    from . import acme
+    return acme.issue(domains, opts, cert_name=cert_name, key_type=key_type, message=message)
+
+
+def obtain_certificate(domains, opts, standalone=False, cert_name=None, force=False, message=lambda x: None):
+    """ Issue certificate with configured backend (`letsencrypt.backend`)
+
+    When `letsencrypt.ecdsa` is set ECDSA certificate named ecdsa_name(cert_name)
+    is obtained as well.
+
+    force -- re-issue even if certificate is not due for renewal
+    """
+    if isinstance(domains, str):
+        domains = [domains]
+
+    _obtain_one(domains, opts, standalone, cert_name, 'rsa', force, message)
+
+    if _get(opts, 'letsencrypt.ecdsa'):
+        _obtain_one(domains, opts, standalone, ecdsa_name(cert_name or domains[0]), 'ecdsa', force, message)
+
+    return True
+
+
+def _revoke_one(cert_path, opts, message):
+    with timing.span('revoke', cert=Path(cert_path).parent.name):
+        return _revoke_with(cert_path, opts, message)
+
+
+def _revoke_with(cert_path, opts, message):
+    if _get(opts, 'letsencrypt.backend', 'certbot') == 'acme':
+        from . import acme
+        return acme.revoke(cert_path, opts, message=message)
+
+    message(_certbot(['certbot', 'revoke', '-n', '--cert-path', str(cert_path)], opts, message=message))
+    return True
+
+
+def revoke_certificate(cert_path, opts, message=lambda x: None):
+    """ Revoke certificate with configured backend, raises CertIssueError on failure
+
+    ECDSA companion certificate is revoked too if present.
+    """
+    cert_path = Path(cert_path)
+    _revoke_one(cert_path, opts, message)
+
+    ecdsa_path = cert_path.parent.with_name(ecdsa_name(cert_path.parent.name))/cert_path.name
+    if ecdsa_path.exists():
+        _revoke_one(ecdsa_path, opts, message)
+
+    return True
+
+
+def _read_certificate_openssl(path):
+    try:
+        out = subprocess.check_output(['openssl', 'x509', '-noout', '-enddate', '-text', '-in', path],
+                                      stderr=subprocess.DEVNULL).decode('utf-8', 'replace')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    m = re.search(r'^notAfter=(.*)$', out, re.M)
+    if m is None:
+        return None
+
+    return dict(not_after=ssl.cert_time_to_seconds(m.group(1).strip()),
+                names=re.findall(r'DNS:([^,\s]+)', out))
+
+
+def read_certificate(path):
+    """ Expiry time (unix seconds) and DNS names of a PEM certificate.
+
+    Parsed in-process when `cryptography` is installed, otherwise with
+    `openssl x509`. Returns None if certificate can not be read.
+
+    Returns dict(not_after=float, names=[str])
+    """
+    try:
+        from cryptography import x509
+    except ImportError:
+        return _read_certificate_openssl(path)
+
+    try:
+        with open(path, 'rb') as f:
+            cert = x509.load_pem_x509_certificate(f.read())
+    except (OSError, ValueError):
+        return None
+
+    if hasattr(cert, 'not_valid_after_utc'):
+        not_after = cert.not_valid_after_utc.timestamp()
+    else:
+        not_after = calendar.timegm(cert.not_valid_after.utctimetuple())
+
+    try:
+        san = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName)
+        names = san.value.get_values_for_type(x509.DNSName)
+    except x509.ExtensionNotFound:
+        names = []
+
+    return dict(not_after=not_after, names=names)
+
+
+def issue_certificates(domains, opts,
+                       standalone=False,
+                       issue=None,
+                       message=lambda x: None):
+    """ Obtain certificates for a number of domains concurrently.
+
+    Failures are retried with exponential backoff unless permanent, rate
+    limited registered domains are paused for all workers.
+
+    issue -- callable(domain) that obtains certificate for one domain, by
+             default uses `obtain_certificate`, should raise CertIssueError on failure
+
+    Returns dictionary domain -> None on success or exception on failure
+    """
+    cfg = _get(opts, 'letsencrypt', {})
+    workers = 1 if standalone else max(1, int(cfg.get('workers', 4)))
+    max_tries = int(cfg.get('max_tries', 3))
+    retry_delay = float(cfg.get('retry_delay', 30))
+    max_retry_delay = float(cfg.get('max_retry_delay', 600))
+    rate_limit_delay = float(cfg.get('rate_limit_delay', 900))
+    throttle = DomainThrottle(int(cfg.get('domain_concurrency', 2)))
+
+    if issue is None:
+        def issue(domain):
+            return obtain_certificate(domain, opts, standalone=standalone, message=message)
+
+    if not standalone:
+        webroot = Path(_get(opts, 'letsencrypt.webroot'))
+        if not webroot.exists():
+            message('Creating webroot directory: {}'.format(webroot))
+            webroot.mkdir(parents=True, exist_ok=True)
+
+    def process(domain):
+        key = registered_domain(domain)
+
+        for attempt in range(max_tries):
+            throttle.acquire(key)
+            try:
+                issue(domain)
+                return None
+            except CertIssueError as e:
+                err = e
+            except JhubNginxError as e:
+                err = CertIssueError(str(e))
+            finally:
+                throttle.release(key)
+
+            if err.kind == PERMANENT or attempt + 1 >= max_tries:
+                return err
+
+            if err.kind == RATE_LIMITED:
+                delay = backoff_delay(attempt, rate_limit_delay, max(max_retry_delay, rate_limit_delay))
+                throttle.pause(key, delay)
+            else:
+                delay = backoff_delay(attempt, retry_delay, max_retry_delay)
+
+            message('{}: {} error, will re-try in {:.0f} seconds'.format(domain, err.kind, delay))
+            time.sleep(delay)
+
+        return err
+
+    with ThreadPoolExecutor(max_workers=min(workers, max(1, len(domains)))) as pool:
+        return dict(zip(domains, pool.map(utils.same_output(process), domains)))
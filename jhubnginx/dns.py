@@ -1,26 +1,55 @@
-import requests
-from . import utils
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from . import utils, timing
 from .utils import JhubNginxError
 from pydash import get as _get
 
-try:
-    import boto3
-except ImportError:
-    boto3 = None
 
-try:
-    import libcloud
-except ImportError:
-    libcloud = None
+# boto3 and libcloud are slow to import and only needed by some providers,
+# they are imported on first use
+
+
+def import_boto3():
+    try:
+        import boto3
+    except ImportError:
+        return None
+    return boto3
+
+
+def import_libcloud():
+    try:
+        import libcloud.dns.base
+        import libcloud.dns.providers
+    except ImportError:
+        return None
+    return libcloud
 
 DEFAULT_TTL = 300
+DEFAULT_INDEX_TTL = 3600
+MAX_CHANGE_BATCH = 500
+DUCKDNS_URL = 'https://www.duckdns.org/update'
+
+_boto3_session = None
+_drivers = {}
+_indexes = {}
+_cache_lock = threading.Lock()  # daemon serves requests concurrently
 
 
 def credentials_from_boto3():
-    if boto3 is None:
-        raise JhubNginxError("Need boto3 library to query AWS credentials")
+    global _boto3_session
+
+    with _cache_lock:
+        if _boto3_session is None:
+            boto3 = import_boto3()
+            if boto3 is None:
+                raise JhubNginxError("Need boto3 library to query AWS credentials")
+            _boto3_session = boto3.Session()
 
-    creds = boto3.Session().get_credentials().get_frozen_credentials()
+    creds = _boto3_session.get_credentials().get_frozen_credentials()
     out = dict(key=creds.access_key,
                secret=creds.secret_key)
     if hasattr(creds, 'token'):
@@ -28,10 +57,9 @@ def credentials_from_boto3():
     return out
 
 
-def update_dns_libcloud(domain, public_ip, opts):
-    domain = domain.rstrip('.')
-
-    cfg = opts.get('dns')
+def libcloud_driver(cfg):
+    """ Construct libcloud DNS driver, drivers are re-used across calls
+    """
     driver_type = cfg.get('type')
 
     if driver_type == 'route53' and cfg.get('key') is None:
@@ -40,56 +68,255 @@ def update_dns_libcloud(domain, public_ip, opts):
         creds = {k: cfg[k] for k in ['key', 'secret', 'token']
                  if k in cfg}
 
-    driver = libcloud.dns.providers.get_driver(driver_type)(**creds)
+    k = (driver_type, tuple(sorted(creds.items())))
+    with _cache_lock:
+        driver = _drivers.get(k)
+        if driver is None:
+            driver = import_libcloud().dns.providers.get_driver(driver_type)(**creds)
+            _drivers[k] = driver
+
+    return driver
+
+
+def zone_for_domain(domain, zone_names):
+    """ Longest zone name that domain belongs to, or None
+    """
+    domain = domain.rstrip('.').lower()
+    best = None
+    for z in zone_names:
+        z = z.rstrip('.').lower()
+        if domain == z or domain.endswith('.' + z):
+            if best is None or len(z) > len(best):
+                best = z
+    return best
+
+
+def _json_safe(extra):
+    return {k: v for k, v in (extra or {}).items()
+            if isinstance(v, (str, int, float, bool)) or v is None}
+
+
+class ZoneIndex(object):
+    """ Zones and A records of a libcloud DNS account.
+
+    Listing is cached in memory and in a json file for `ttl` seconds, so
+    finding the record to update does not need to page through all zones
+    and records every time. Records are updated in the index on writes,
+    and the zone is dropped from the index if a write fails. Safe to use
+    from several threads.
+    """
+    def __init__(self, driver, cache_file=None, ttl=DEFAULT_INDEX_TTL):
+        self._lock = threading.RLock()
+        self._driver = driver
+        self._cache_file = cache_file
+        self._ttl = ttl
+        self._data = utils.read_json(cache_file) if cache_file else None
+        if not isinstance(self._data, dict):
+            self._data = {}
+
+    def _fresh(self, entry):
+        return entry is not None and time.time() - entry.get('time', 0) < self._ttl
+
+    def save(self):
+        if self._cache_file:
+            with self._lock:
+                utils.write_json(self._cache_file, self._data)
+
+    def invalidate(self, zone=None):
+        with self._lock:
+            if zone is None:
+                self._data = {}
+            else:
+                self._data.get('records', {}).pop(zone.id, None)
+            self.save()
+
+    def _zones(self):
+        zones = self._data.get('zones')
+        if not self._fresh(zones):
+            zones = dict(time=time.time(),
+                         items=[dict(id=z.id, domain=z.domain, type=z.type, ttl=z.ttl,
+                                     extra=_json_safe(z.extra))
+                                for z in self._driver.list_zones()])
+            self._data['zones'] = zones
+            self._data['records'] = {}
+            self.save()
+        return zones['items']
+
+    def zone_for(self, domain):
+        with self._lock:
+            zones = self._zones()
+        name = zone_for_domain(domain, [z['domain'] for z in zones])
+        if name is None:
+            raise JhubNginxError("No zone for domain: %s" % domain)
+
+        matches = [z for z in zones if z['domain'].rstrip('.').lower() == name]
+        if len(matches) > 1:
+            raise JhubNginxError("More than one zone for domain: %s" % domain)
+
+        z = matches[0]
+        return import_libcloud().dns.base.Zone(z['id'], z['domain'], z['type'], z['ttl'], self._driver, extra=z['extra'])
+
+    def _records(self, zone):
+        all_recs = self._data.setdefault('records', {})
+        recs = all_recs.get(zone.id)
+        if not self._fresh(recs):
+            recs = dict(time=time.time(),
+                        items={r.name or '': dict(id=r.id, data=r.data, extra=_json_safe(r.extra))
+                               for r in zone.list_records() if r.type == 'A'})
+            all_recs[zone.id] = recs
+            self.save()
+        return recs['items']
+
+    def find_record(self, zone, name):
+        with self._lock:
+            r = self._records(zone).get(name or '')
+        if r is None:
+            return None
+        return import_libcloud().dns.base.Record(r['id'], name, 'A', r['data'], zone, self._driver, extra=r['extra'])
+
+    def put_record(self, zone, name, rec):
+        self.put_records(zone, {name: rec})
+
+    def put_records(self, zone, recs):
+        """ recs -- name -> Record
+        """
+        with self._lock:
+            items = self._records(zone)
+            for name, rec in recs.items():
+                items[name or ''] = dict(id=rec.id, data=rec.data, extra=_json_safe(rec.extra))
+            self.save()
+
+
+def zone_index(driver, cfg, opts):
+    ttl = cfg.get('index_ttl', DEFAULT_INDEX_TTL)
+    state_dir = _get(opts, 'state_dir')
+    cache_file = None
+    if state_dir is not None and ttl:
+        account = hashlib.sha1(repr(sorted((k, str(cfg.get(k))) for k in ['type', 'key'])).encode('utf-8'))
+        cache_file = str(Path(state_dir)/'dns-index-{}.json'.format(account.hexdigest()[:16]))
+
+    k = (id(driver), cache_file)
+    with _cache_lock:
+        index = _indexes.get(k)
+        if index is None:
+            index = ZoneIndex(driver, cache_file=cache_file, ttl=ttl or 0)
+            _indexes[k] = index
+    return index
+
 
-    zones = [z for z in driver.list_zones()
-             if domain.endswith(z.domain.rstrip('.'))]
+def update_dns_libcloud(domain, public_ip, opts):
+    domain = domain.rstrip('.')
 
-    if len(zones) < 1:
-        raise JhubNginxError("No zone for domain: %s" % domain)
-    if len(zones) > 1:
-        raise JhubNginxError("More than one zone for domain: %s" % domain)
+    cfg = opts.get('dns')
+    driver = libcloud_driver(cfg)
+    index = zone_index(driver, cfg, opts)
+
+    def upsert():
+        zone = index.zone_for(domain)
+        name = domain[:-len(zone.domain.rstrip('.'))-1]
+
+        rec = index.find_record(zone, name)
+        try:
+            if rec is None:
+                rec = zone.create_record(name,
+                                         type='A',
+                                         data=public_ip,
+                                         extra={'ttl': DEFAULT_TTL})
+            else:
+                rec = rec.update(data=public_ip)
+        except Exception:
+            index.invalidate(zone)
+            raise
 
-    zone = zones[0]
-    name = domain[:-len(zone.domain.rstrip('.'))-1]
+        index.put_record(zone, name, rec)
 
-    recs = [rec for rec in zone.list_records() if rec.name == name]
-    if len(recs) == 0:
-        rec = zone.create_record(name,
-                                 type='A',
-                                 data=public_ip,
-                                 extra={'ttl': DEFAULT_TTL})
-    else:
-        rec = recs[0]
-        rec.update(data=public_ip)
+    try:
+        upsert()
+    except JhubNginxError:
+        raise
+    except Exception:
+        # index might have been stale, retry once with fresh listing
+        upsert()
 
     return True
 
 
-def update_duck_dns(domain, public_ip, opts):
+def update_dns_libcloud_many(pairs, opts):
+    """ Update many A records, grouped by zone.
 
-    token = _get(opts, 'dns.token',
-                 _get(opts, 'dns.key',
-                      _get(opts, 'duckdns.token', None)))
+    Providers that accept change batches (route53) get one request per zone,
+    others fall back to one update per record.
 
-    if token is None:
-        return False
+    Returns dictionary domain -> (ok, message)
+    """
+    cfg = opts.get('dns')
+    driver = libcloud_driver(cfg)
+    index = zone_index(driver, cfg, opts)
+    out = {}
+    by_zone = {}
+
+    for domain, ip in pairs:
+        domain = domain.rstrip('.')
+        try:
+            zone = index.zone_for(domain)
+        except JhubNginxError as e:
+            out[domain] = (False, str(e))
+            continue
+        name = domain[:-len(zone.domain.rstrip('.'))-1]
+        by_zone.setdefault(zone.id, (zone, []))[1].append((domain, name, ip))
+
+    for zone, items in by_zone.values():
+        if not hasattr(driver, '_post_changeset'):
+            for domain, _, ip in items:
+                try:
+                    update_dns_libcloud(domain, ip, opts)
+                    out[domain] = (True, '')
+                except Exception as e:
+                    out[domain] = (False, str(e))
+            continue
+
+        for i in range(0, len(items), MAX_CHANGE_BATCH):
+            batch = items[i:i+MAX_CHANGE_BATCH]
+            changes = [('UPSERT', name, 'A', ip, {'ttl': DEFAULT_TTL})
+                       for _, name, ip in batch]
+            try:
+                ok = driver._post_changeset(zone, changes)
+                result = (True, '') if ok else (False, 'DNS provider rejected the change batch')
+            except Exception as e:
+                ok, result = False, (False, str(e))
+
+            for domain, _, _ in batch:
+                out[domain] = result
+
+            if not ok:
+                index.invalidate(zone)
+                continue
+
+            Record = import_libcloud().dns.base.Record
+            recs = {}
+            for _, name, ip in batch:
+                prev = index.find_record(zone, name)
+                recs[name] = Record(prev.id if prev else 'A:' + name, name, 'A', ip, zone, driver,
+                                    extra=prev.extra if prev else {'ttl': DEFAULT_TTL})
+            index.put_records(zone, recs)
 
-    if not domain.endswith('.duckdns.org'):
-        return False
+    return out
 
-    domain = domain.split('.')[-3]
+
+def duck_dns_request(names, public_ip, token, opts):
+    url = _get(opts, 'dns.duckdns_url', DUCKDNS_URL)
+    names = ','.join(names)
 
     try:
-        with requests.get('https://www.duckdns.org/update',
-                          dict(domains=domain,
-                               token=token,
-                               ip=public_ip)) as req:
+        with utils.http_session().get(url,
+                                      params=dict(domains=names,
+                                                  token=token,
+                                                  ip=public_ip)) as req:
             if req and req.text == "OK":
                 return True
 
             if req.text == 'KO':
-                raise JhubNginxError('Duck DNS refused to update -- {} token:{}'.format(domain, token))
+                raise JhubNginxError('Duck DNS refused to update -- {} token:{}'.format(names, token))
             else:
                 raise JhubNginxError('Failed to contact duck DNS')
 
@@ -99,16 +326,99 @@ def update_duck_dns(domain, public_ip, opts):
     return False
 
 
+def duck_dns_token(opts):
+    return _get(opts, 'dns.token',
+                _get(opts, 'dns.key',
+                     _get(opts, 'duckdns.token', None)))
+
+
+def update_duck_dns(domain, public_ip, opts):
+
+    token = duck_dns_token(opts)
+
+    if token is None:
+        return False
+
+    if not domain.endswith('.duckdns.org'):
+        return False
+
+    return duck_dns_request([domain.split('.')[-3]], public_ip, token, opts)
+
+
+def update_duck_dns_many(pairs, opts):
+    """ Update many duckdns.org names, one request per distinct IP
+
+    Returns dictionary domain -> (ok, message)
+    """
+    token = duck_dns_token(opts)
+    if token is None:
+        return {domain: (False, 'No duckdns token configured') for domain, _ in pairs}
+
+    by_ip = {}
+    for domain, ip in pairs:
+        by_ip.setdefault(ip, []).append(domain)
+
+    out = {}
+    for ip, domains in by_ip.items():
+        try:
+            duck_dns_request([d.split('.')[-3] for d in domains], ip, token, opts)
+            result = (True, '')
+        except JhubNginxError as e:
+            result = (False, str(e))
+
+        out.update({domain: result for domain in domains})
+
+    return out
+
+
 def update_dns(domain, public_ip, opts):
     if domain.endswith('.duckdns.org'):
         return update_duck_dns(domain, public_ip, opts)
 
-    if libcloud is not None and _get(opts, 'dns.type') is not None:
+    if _get(opts, 'dns.type') is not None and import_libcloud() is not None:
         return update_dns_libcloud(domain, public_ip, opts)
 
     return False
 
 
+def update_dns_many(pairs, opts):
+    """ Bulk version of update_dns
+
+    pairs -- list of (domain, ip)
+
+    Returns dictionary domain -> (ok, message)
+    """
+    duck = [(d, ip) for d, ip in pairs if d.endswith('.duckdns.org')]
+    other = [(d, ip) for d, ip in pairs if not d.endswith('.duckdns.org')]
+    out = {}
+
+    if duck:
+        out.update(update_duck_dns_many(duck, opts))
+
+    if other:
+        if _get(opts, 'dns.type') is not None and import_libcloud() is not None:
+            out.update(update_dns_libcloud_many(other, opts))
+        else:
+            out.update({d: (False, 'no way to update') for d, _ in other})
+
+    return out
+
+
+def confirm_public_ip(public_ip, opts, message=lambda x: None):
+    """ Public IP may come from cache, query endpoints again before overwriting
+        DNS records that disagree with it
+
+    Returns current public IP, None if it can not be found
+    """
+    if not _get(opts, 'public_ip.cache_ttl'):
+        return public_ip
+
+    ip = utils.public_ip(opts, refresh=True)
+    if ip is not None and ip != public_ip:
+        message('Public IP changed: {} -> {}'.format(public_ip, ip))
+    return ip
+
+
 def check_dns(domain,
               public_ip=None,
               opts=None,
@@ -128,6 +438,7 @@ def check_dns(domain,
        opts['dns']['key'] -- e.g. AWS_ACCESS_KEY for route53, email for cloudflare
        opts['dns']['secret'] -- (optional), AWS_SECRET_KEY for route53
        opts['dns']['token'] -- (optional), AWS_SESSION_TOKEN route53 IAM roles need that
+       opts['dns']['index_ttl'] -- (optional), seconds to cache zone and record listing for
 
     For EC2+route53 users it's best to leave key|secret|token un-configured,
     they will be queried using boto3 library.
@@ -137,22 +448,33 @@ def check_dns(domain,
 
     '''
     opts = opts if opts else utils.default_opts()
+    timing.configure(opts)
 
     if public_ip is None:
-        public_ip = utils.public_ip()
+        public_ip = utils.public_ip(opts)
         if public_ip is None:
             raise JhubNginxError("Can't find public IP of this host")
 
-    domain_ip = utils.resolve_hostname(domain)
+    with timing.span('dns_resolve', domains=1):
+        domain_ip = utils.resolve_hostname(domain)
 
     if domain_ip == public_ip:
         message('DNS record is already up to date')
         return True
 
+    public_ip = confirm_public_ip(public_ip, opts, message)
+    if public_ip is None:
+        raise JhubNginxError("Can't find public IP of this host")
+    if domain_ip == public_ip:
+        return True
+
     if no_update:
         return False
 
-    if update_dns(domain, public_ip, opts):
+    with timing.span('dns_update', domains=1):
+        updated = update_dns(domain, public_ip, opts)
+
+    if updated:
         message('Updated DNS record successfully')
         if on_update:
             on_update(domain, public_ip)
@@ -163,3 +485,63 @@ def check_dns(domain,
     else:
         raise JhubNginxError("DNS record doesn't match public IP: {} is {} should be {}".format(
             domain, domain_ip, public_ip))
+
+
+def check_dns_many(domains,
+                   public_ip=None,
+                   opts=None,
+                   message=lambda x: None,
+                   on_update=None,
+                   no_update=False):
+    """ Bulk version of check_dns, records needing an update are updated in batches.
+
+    Returns dictionary domain -> (ok, message)
+    """
+    opts = opts if opts else utils.default_opts()
+    timing.configure(opts)
+
+    if public_ip is None:
+        public_ip = utils.public_ip(opts)
+        if public_ip is None:
+            raise JhubNginxError("Can't find public IP of this host")
+
+    with timing.span('dns_resolve', domains=len(domains)), ThreadPoolExecutor(max_workers=16) as pool:
+        resolved = dict(zip(domains, pool.map(utils.resolve_hostname, domains)))
+
+    stale = [d for d in domains if resolved[d] != public_ip]
+    if stale:
+        public_ip = confirm_public_ip(public_ip, opts, message)
+        if public_ip is None:
+            out = {d: (True, '') for d in domains if d not in stale}
+            out.update({d: (False, "Can't find public IP of this host") for d in stale})
+            return out
+
+    out = {d: (True, '') for d, ip in resolved.items() if ip == public_ip}
+    stale = [d for d in domains if d not in out]
+
+    if out:
+        message('DNS records are already up to date: {}'.format(', '.join(out)))
+
+    if no_update:
+        out.update({d: (False, "DNS record doesn't match public ip") for d in stale})
+        return out
+
+    updated = {}
+    if stale:
+        with timing.span('dns_update', domains=len(stale)):
+            updated = update_dns_many([(d, public_ip) for d in stale], opts)
+
+    for domain in stale:
+        ok, msg = updated.get(domain, (False, ''))
+        if ok:
+            message('Updated DNS record for {} successfully'.format(domain))
+            if on_update:
+                on_update(domain, public_ip)
+        elif resolved[domain] is None:
+            msg = 'No DNS record for {}, and no way to update ({})'.format(domain, msg)
+        else:
+            msg = "DNS record doesn't match public IP: {} is {} should be {} ({})".format(
+                domain, resolved[domain], public_ip, msg)
+        out[domain] = (ok, msg)
+
+    return out
@@ -0,0 +1,249 @@
+""" Watch DNS changes propagate by querying authoritative name servers directly.
+
+Minimal DNS client over UDP, only understands A, NS, CNAME and SOA records.
+"""
+import random
+import socket
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pydash import get as _get
+
+TYPE_A = 1
+TYPE_NS = 2
+TYPE_CNAME = 5
+TYPE_SOA = 6
+
+RCODE_NXDOMAIN = 3
+
+
+class DnsQueryError(IOError):
+    pass
+
+
+def parse_server(server, default_port=53):
+    """ '8.8.8.8' -> ('8.8.8.8', 53), '127.0.0.1:5353' -> ('127.0.0.1', 5353)
+    """
+    if isinstance(server, (tuple, list)):
+        return tuple(server)
+
+    host, _, port = str(server).partition(':')
+    return (host, int(port) if port else default_port)
+
+
+def encode_name(name):
+    out = b''
+    for label in name.rstrip('.').split('.'):
+        if label:
+            out += struct.pack('B', len(label)) + label.encode('idna')
+    return out + b'\0'
+
+
+def build_query(name, qtype, qid):
+    header = struct.pack('>HHHHHH', qid, 0x0100, 1, 0, 0, 0)  # RD set
+    return header + encode_name(name) + struct.pack('>HH', qtype, 1)
+
+
+def decode_name(data, off):
+    labels = []
+    end = None
+    for _ in range(128):
+        n = data[off]
+        if n & 0xC0 == 0xC0:
+            if end is None:
+                end = off + 2
+            off = ((n & 0x3F) << 8) | data[off + 1]
+        elif n == 0:
+            off += 1
+            break
+        else:
+            labels.append(data[off + 1:off + 1 + n].decode('ascii', 'replace'))
+            off += 1 + n
+    else:
+        raise DnsQueryError('Bad name compression in DNS response')
+
+    return '.'.join(labels).lower(), (end if end is not None else off)
+
+
+def parse_response(data):
+    """ Returns (qid, rcode, sections) where sections is a list of three lists
+        (answer, authority, additional) of (name, type, ttl, value) tuples.
+    """
+    try:
+        qid, flags, qdcount, ancount, nscount, arcount = struct.unpack('>HHHHHH', data[:12])
+        off = 12
+        for _ in range(qdcount):
+            _, off = decode_name(data, off)
+            off += 4
+
+        sections = []
+        for count in (ancount, nscount, arcount):
+            recs = []
+            for _ in range(count):
+                name, off = decode_name(data, off)
+                rtype, _, ttl, rdlen = struct.unpack('>HHIH', data[off:off + 10])
+                off += 10
+                rdata = data[off:off + rdlen]
+                if rtype == TYPE_A and rdlen == 4:
+                    value = socket.inet_ntoa(rdata)
+                elif rtype in (TYPE_NS, TYPE_CNAME, TYPE_SOA):
+                    value, _ = decode_name(data, off)
+                else:
+                    value = rdata
+                recs.append((name, rtype, ttl, value))
+                off += rdlen
+            sections.append(recs)
+    except (struct.error, IndexError) as e:
+        raise DnsQueryError('Malformed DNS response: {}'.format(e))
+
+    return qid, flags & 0xF, sections
+
+
+def query(server, name, qtype=TYPE_A, timeout=2):
+    """ Send single query over UDP, server is (host, port)
+    """
+    qid = random.randint(0, 0xFFFF)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.settimeout(timeout)
+        try:
+            s.sendto(build_query(name, qtype, qid), server)
+            deadline = time.time() + timeout
+            while True:
+                data, _ = s.recvfrom(4096)
+                rid, rcode, sections = parse_response(data)
+                if rid == qid:
+                    return rcode, sections
+                s.settimeout(max(0.01, deadline - time.time()))
+        except socket.timeout:
+            raise DnsQueryError('Timeout querying {} for {}'.format(server[0], name))
+        except OSError as e:
+            raise DnsQueryError('Failed to query {}: {}'.format(server[0], e))
+
+
+def query_a(server, domain, timeout=2):
+    """ Returns set of IPs domain resolves to according to server, empty set for NXDOMAIN
+    """
+    rcode, (answer, _, _) = query(server, domain, TYPE_A, timeout=timeout)
+    return set(v for (_, t, _, v) in answer if t == TYPE_A)
+
+
+def find_zone(domain, resolver, timeout=2):
+    """ Find zone apex and its name server host names using recursive resolver
+    """
+    domain = domain.rstrip('.').lower()
+    _, (answer, authority, _) = query(resolver, domain, TYPE_NS, timeout=timeout)
+
+    ns = [v for (n, t, _, v) in answer if t == TYPE_NS and n == domain]
+    if ns:
+        return domain, ns
+
+    soa = [n for (n, t, _, _) in authority if t == TYPE_SOA]
+    if not soa:
+        raise DnsQueryError('Failed to find zone for {}'.format(domain))
+
+    zone = soa[0]
+    _, (answer, _, _) = query(resolver, zone, TYPE_NS, timeout=timeout)
+    ns = [v for (n, t, _, v) in answer if t == TYPE_NS and n == zone]
+    if not ns:
+        raise DnsQueryError('No name servers for zone {}'.format(zone))
+
+    return zone, ns
+
+
+def authoritative_servers(domain, resolver, port=53, timeout=2):
+    """ List of (ip, port) of name servers authoritative for domain
+    """
+    zone, ns_names = find_zone(domain, resolver, timeout=timeout)
+    out = []
+    for ns in ns_names:
+        try:
+            ips = query_a(resolver, ns, timeout=timeout)
+        except DnsQueryError:
+            ips = set()
+        out.extend((ip, port) for ip in sorted(ips))
+
+    if not out:
+        raise DnsQueryError('Failed to resolve name servers for zone {}'.format(zone))
+
+    return list(dict.fromkeys(out))
+
+
+def quorum_size(quorum, n):
+    if quorum == 'all':
+        return n
+    if quorum == 'majority':
+        return n//2 + 1
+    return max(1, min(n, int(quorum)))
+
+
+def wait_for_records(pairs, opts=None, timeout=5*60, cbk=None):
+    """ Wait until authoritative name servers agree that domain resolves to ip.
+
+    pairs -- list of (domain, ip)
+    cbk   -- called with (elapsed_seconds, pending_domains) between polling rounds
+
+    Configured with opts['dns_watch']: resolver used to discover name servers,
+    name server port, quorum ('all'|'majority'|number), per-query timeout,
+    initial and maximum polling interval.
+
+    Returns dictionary domain -> True|False, False meaning change was not
+    observed before timeout.
+    """
+    cfg = _get(opts or {}, 'dns_watch', {}) or {}
+    resolver = parse_server(cfg.get('resolver', '8.8.8.8'))
+    port = int(cfg.get('port', 53))
+    quorum = cfg.get('quorum', 'majority')
+    query_timeout = float(cfg.get('timeout', 2))
+    interval = float(cfg.get('interval', 0.25))
+    max_interval = float(cfg.get('max_interval', 5))
+    nameservers = cfg.get('nameservers')
+
+    pending = dict(pairs)
+    result = {domain: False for domain in pending}
+    servers = {}
+    t0 = time.time()
+
+    with ThreadPoolExecutor(max_workers=int(cfg.get('workers', 16))) as pool:
+        def discover(domain):
+            if nameservers:
+                return [parse_server(s, port) for s in nameservers]
+            return authoritative_servers(domain, resolver, port=port, timeout=query_timeout)
+
+        def check(domain, server):
+            try:
+                return pending[domain] in query_a(server, domain, timeout=query_timeout)
+            except DnsQueryError:
+                return False
+
+        while pending:
+            undiscovered = [d for d in pending if d not in servers]
+            for domain, f in [(d, pool.submit(discover, d)) for d in undiscovered]:
+                try:
+                    servers[domain] = f.result()
+                except DnsQueryError:
+                    pass
+
+            jobs = [(domain, pool.submit(check, domain, server))
+                    for domain in pending if domain in servers
+                    for server in servers[domain]]
+
+            agreed = {}
+            for domain, f in jobs:
+                agreed[domain] = agreed.get(domain, 0) + (1 if f.result() else 0)
+
+            for domain, n in agreed.items():
+                if n >= quorum_size(quorum, len(servers[domain])):
+                    result[domain] = True
+                    del pending[domain]
+
+            dt = time.time() - t0
+            if not pending or dt > timeout:
+                break
+
+            if cbk:
+                cbk(dt, list(pending))
+
+            time.sleep(min(interval, max(0, timeout - dt)))
+            interval = min(max_interval, interval*1.5)
+
+    return result
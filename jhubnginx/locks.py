@@ -0,0 +1,180 @@
+""" File locks coordinating concurrent jhub-vhost processes.
+
+Locks live under <state_dir>/locks: one per domain and per certificate name,
+held while a vhost is added or removed, and short lived ones around nginx
+reload and files shared by all vhosts. Locks are flock(2) based, the kernel
+drops them when the holder exits, so nothing stale is left behind. Holder
+pid, host, command and start time are written into the lock file, waiting
+callers report them.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import re
+import socket
+import sys
+import time
+from pathlib import Path
+from pydash import get as _get
+
+from .utils import JhubNginxError
+
+
+class LockTimeout(JhubNginxError):
+    pass
+
+
+def lock_dir(opts):
+    state_dir = _get(opts, 'state_dir')
+    return None if state_dir is None else Path(state_dir)/'locks'
+
+
+def _read_holder(path):
+    try:
+        with open(str(path), 'r') as f:
+            return json.loads(f.read() or 'null')
+    except (OSError, ValueError):
+        return None
+
+
+def describe_holder(info):
+    if not info:
+        return 'unknown process'
+    return 'pid {} on {} ({}) for {:.0f}s'.format(info.get('pid'),
+                                                  info.get('host'),
+                                                  info.get('cmd'),
+                                                  time.time() - info.get('since', time.time()))
+
+
+class FileLock(object):
+    """ Exclusive lock on a file, waits up to `timeout` seconds then raises LockTimeout
+    """
+    def __init__(self, path, timeout=0, message=lambda x: None):
+        self.path = Path(path)
+        self.timeout = timeout
+        self._message = message
+        self._fd = None
+
+    def acquire(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.monotonic() + self.timeout
+        waiting = False
+
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                holder = describe_holder(_read_holder(self.path))
+                if time.monotonic() >= deadline:
+                    os.close(fd)
+                    raise LockTimeout('Timed out waiting for lock {}, held by {}'.format(self.path, holder))
+                if not waiting:
+                    self._message('Waiting for lock {}, held by {}'.format(self.path, holder))
+                    waiting = True
+                time.sleep(0.1)
+
+        info = dict(pid=os.getpid(),
+                    host=socket.gethostname(),
+                    cmd=' '.join(sys.argv),
+                    since=time.time())
+        os.ftruncate(fd, 0)
+        os.write(fd, json.dumps(info).encode('utf-8'))
+        self._fd = fd
+        return self
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def _file_name(name):
+    return re.sub(r'[^\w.-]', '_', name) + '.lock'
+
+
+def _reserve_fds(n):
+    """ Every held lock is an open file, make sure large batches fit
+    """
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        want = n + 256
+        if soft != resource.RLIM_INFINITY and soft < want:
+            if hard != resource.RLIM_INFINITY:
+                want = min(want, hard)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (want, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def lock(name, opts, timeout=None, message=lambda x: None):
+    """ Short lived lock (nginx reload, shared files), waits `locks.reload_timeout` by default
+
+    Does nothing when there is no state_dir.
+    """
+    d = lock_dir(opts)
+    if d is None:
+        return contextlib.nullcontext()
+    if timeout is None:
+        timeout = _get(opts, 'locks.reload_timeout', 120)
+    return FileLock(d/_file_name(name), timeout=timeout, message=message)
+
+
+@contextlib.contextmanager
+def vhost_locks(domains, opts, cert_names=(), message=lambda x: None):
+    """ Hold locks of all domains, then of all certificate names, waits `locks.timeout`
+
+    Locks are always taken in the same order, so callers locking overlapping
+    sets can not deadlock.
+    """
+    d = lock_dir(opts)
+    if d is None:
+        yield
+        return
+
+    timeout = _get(opts, 'locks.timeout', 900)
+    names = (['domain-' + x for x in sorted(set(domains))] +
+             ['cert-' + x for x in sorted(set(cert_names))])
+    _reserve_fds(len(names))
+
+    with contextlib.ExitStack() as stack:
+        for name in names:
+            stack.enter_context(FileLock(d/_file_name(name), timeout=timeout, message=message))
+        yield
+
+
+def holders(opts):
+    """ Locks currently held: list of dict(name, pid, host, cmd, since)
+    """
+    d = lock_dir(opts)
+    if d is None or not d.exists():
+        return []
+
+    out = []
+    for path in sorted(d.glob('*.lock')):
+        try:
+            fd = os.open(str(path), os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            continue  # nobody holds it
+        except BlockingIOError:
+            pass
+        finally:
+            os.close(fd)
+
+        info = _read_holder(path) or {}
+        out.append(dict(info, name=path.name[:-len('.lock')]))
+    return out
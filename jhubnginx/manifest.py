@@ -0,0 +1,146 @@
+""" Record of vhosts fully verified by `add`.
+
+Kept in <state_dir>/manifest.json, one entry per domain:
+
+  inputs   -- hash of options, templates and `add` parameters config is rendered from
+  config   -- config file holding the vhost
+  ssl_dir  -- certificate directory, with sha256 and expiry of cert.pem
+  ip       -- public IP DNS record was verified against, None if DNS check was skipped
+  verified -- time of the last full check
+
+Re-running `add` for a domain with matching inputs and certificate within
+`manifest.reverify_interval` seconds of the last check only needs local file
+reads: no public IP lookup, DNS check, template rendering or nginx reload.
+"""
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from pydash import get as _get
+
+from . import utils, locks
+from ._templates import TEMPLATES
+from .certs import read_certificate, ecdsa_name
+
+
+def manifest_path(opts):
+    state_dir = _get(opts, 'state_dir')
+    return None if state_dir is None else Path(state_dir)/'manifest.json'
+
+
+def load(opts):
+    path = manifest_path(opts)
+    if path is None:
+        return {}
+    return utils.read_json(str(path)) or {}
+
+
+def _update(opts, entries=None, remove=()):
+    path = manifest_path(opts)
+    if path is None:
+        return
+
+    with locks.lock('manifest', opts):
+        m = load(opts)
+        m.update(entries or {})
+        for domain in remove:
+            m.pop(domain, None)
+        utils.write_json(str(path), m)
+
+
+def inputs_hash(opts, **params):
+    """ Hash of everything vhost config depends on, apart from the domain name
+
+    Only options that end up in rendered config are included, so that
+    changing e.g. timing, locks or the E-mail address does not force a
+    full re-check of every vhost.
+    """
+    rendered = dict(nginx=_get(opts, 'nginx'),
+                    webroot=_get(opts, 'letsencrypt.webroot'),
+                    ecdsa=_get(opts, 'letsencrypt.ecdsa'),
+                    templates=_get(opts, 'templates.path'))
+    h = hashlib.sha256()
+    h.update(json.dumps(dict(opts=rendered, params=params), sort_keys=True, default=str).encode('utf-8'))
+    for name in sorted(TEMPLATES):
+        h.update(TEMPLATES[name].encode('utf-8'))
+
+    path = _get(opts, 'templates.path')
+    if path is not None:
+        try:
+            for e in sorted(os.scandir(path), key=lambda e: e.name):
+                h.update('{} {}'.format(e.name, e.stat().st_mtime_ns).encode('utf-8'))
+        except OSError:
+            pass
+
+    return h.hexdigest()
+
+
+def cert_fingerprint(ssl_dir, opts):
+    """ sha256 of cert.pem (and of ECDSA companion when enabled), None if missing
+    """
+    dirs = [Path(ssl_dir)]
+    if _get(opts, 'letsencrypt.ecdsa'):
+        dirs.append(dirs[0].parent/ecdsa_name(dirs[0].name))
+
+    h = hashlib.sha256()
+    for d in dirs:
+        try:
+            with open(str(d/'cert.pem'), 'rb') as f:
+                h.update(f.read())
+        except OSError:
+            return None
+    return h.hexdigest()
+
+
+def fresh_domains(domains, opts, inputs, need_dns=True):
+    """ Domains verified less than `manifest.reverify_interval` seconds ago
+        with the same inputs and certificate
+    """
+    interval = _get(opts, 'manifest.reverify_interval') or 0
+    if not interval:
+        return []
+
+    m = load(opts)
+    now = time.time()
+    out = []
+    for domain in domains:
+        e = m.get(domain)
+        if e is None or e.get('inputs') != inputs:
+            continue
+        if now - e.get('verified', 0) > interval:
+            continue
+        if need_dns and e.get('ip') is None:
+            continue
+        if not Path(e['config']).exists():
+            continue
+        if e.get('cert_sha256') is None or cert_fingerprint(e['ssl_dir'], opts) != e['cert_sha256']:
+            continue
+        out.append(domain)
+
+    return out
+
+
+def record(domains, opts, inputs, ip, ssl_dirs, configs):
+    """ Remember successfully verified domains
+
+    ssl_dirs, configs -- domain -> path
+    """
+    now = time.time()
+    entries = {}
+    for domain in domains:
+        ssl_dir = ssl_dirs[domain]
+        info = read_certificate(str(Path(ssl_dir)/'cert.pem')) or {}
+        entries[domain] = dict(inputs=inputs,
+                               config=str(configs[domain]),
+                               ssl_dir=str(ssl_dir),
+                               cert_sha256=cert_fingerprint(ssl_dir, opts),
+                               cert_not_after=info.get('not_after'),
+                               ip=ip,
+                               verified=now)
+    _update(opts, entries)
+
+
+def forget(domains, opts):
+    if domains:
+        _update(opts, remove=domains)
@@ -0,0 +1,240 @@
+""" Coalescing nginx reloads.
+
+Every reload starts a new set of nginx workers, so reloads requested at about
+the same time (within `nginx.reload_window` seconds) are combined: config is
+validated once for the combined set of changes and nginx is reloaded once.
+When validation fails and nginx names a file that was changed, only that file
+is rolled back and validation is repeated for the rest. When no changed file
+is named, all changes of the batch are rolled back.
+
+Changes are written to disk by the reload leader just before the config check,
+while holding the reload lock (a file lock when state_dir is configured). No
+other process can see, check or roll back a file half way through.
+"""
+import os
+import re
+import subprocess
+import threading
+import contextlib
+import time
+from pydash import get as _get
+
+from .utils import JhubNginxError, write_if_different, slurp
+from . import timing, locks
+
+_FILE_IN_ERROR = re.compile(r' in (\S+?):\d+')
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+class ConfigChange(object):
+    """ Config file written by a caller.
+
+    previous -- content of the file before the change, None if the file is new
+
+    Subclasses write the file in apply(), called under the reload lock.
+    """
+    def __init__(self, path, previous=None):
+        self.path = os.path.abspath(str(path))
+        self.previous = previous
+
+    def apply(self):
+        pass
+
+    def rollback(self):
+        if self.previous is None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        else:
+            write_if_different(self.path, self.previous)
+
+
+class ConfigWrite(ConfigChange):
+    """ Replace content of a config file, txt=None removes it
+    """
+    def __init__(self, path, txt):
+        ConfigChange.__init__(self, path)
+        self.txt = txt
+
+    def apply(self):
+        self.previous = slurp(self.path)
+        if self.txt is None:
+            if self.previous is not None:
+                os.remove(self.path)
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_if_different(self.path, self.txt)
+        except OSError:
+            self.rollback()  # do not leave partially written file behind
+            raise
+
+
+class _Request(object):
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.rejected = {}
+        self.error = None
+        self.done = threading.Event()
+
+
+def _run(cmd):
+    try:
+        out = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+        return True, out.decode('utf-8', 'replace')
+    except FileNotFoundError as e:
+        raise JhubNginxError('Failed to reload nginx config, bad command: {}'.format(str(e)))
+    except subprocess.CalledProcessError as e:
+        return False, (e.output or b'').decode('utf-8', 'replace')
+
+
+def _as_error(e):
+    if isinstance(e, JhubNginxError):
+        return e
+    return JhubNginxError('Failed to reload nginx config: {}'.format(e))
+
+
+def files_in_error(output):
+    """ Config files nginx mentions in error output of `nginx -t`
+    """
+    return set(os.path.abspath(f) for f in _FILE_IN_ERROR.findall(output))
+
+
+class ReloadScheduler(object):
+    def __init__(self, check_cmd, reload_cmd, window=0, lock=contextlib.nullcontext, message=lambda x: None):
+        """ lock -- returns context manager held while config is checked and nginx reloaded
+        """
+        self._check_cmd = check_cmd
+        self._reload_cmd = reload_cmd
+        self._window = window
+        self._reload_lock = lock
+        self._message = message
+        self._lock = threading.Lock()
+        self._pending = []
+        self._running = False
+
+    def submit(self, changes=()):
+        """ Request nginx reload and wait for it to happen.
+
+        changes -- ConfigChange for every file to write (or written) since last reload
+
+        Returns dictionary path -> nginx error output for changes that failed
+        to write or validate and were rolled back, everything else is live. Raises
+        JhubNginxError if nginx could not be reloaded at all.
+        """
+        req = _Request(changes)
+        with self._lock:
+            self._pending.append(req)
+            leader = not self._running
+            self._running = True
+
+        if leader:
+            self._lead()
+
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.rejected
+
+    def _lead(self):
+        try:
+            while True:
+                if self._window:
+                    time.sleep(self._window)
+
+                with self._lock:
+                    batch, self._pending = self._pending, []
+                    if not batch:
+                        self._running = False
+                        return
+
+                try:
+                    with self._reload_lock():
+                        self._process(batch)
+                except BaseException as e:
+                    for req in batch:
+                        req.error = _as_error(e)
+                    if not isinstance(e, Exception):
+                        raise
+                finally:
+                    for req in batch:
+                        req.done.set()
+        except BaseException as e:
+            # never leave followers waiting for a leader that is gone
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._running = False
+            for req in batch:
+                req.error = _as_error(e)
+                req.done.set()
+            raise
+
+    def _process(self, batch):
+        self._message('Reloading nginx config')
+        live = []
+        for req in batch:
+            for c in req.changes:
+                try:
+                    c.apply()
+                except (OSError, JhubNginxError) as e:
+                    req.rejected[c.path] = 'Failed to write config: {}'.format(e)
+                else:
+                    live.append((req, c))
+
+        while True:
+            with timing.span('nginx_check', files=len(live)):
+                ok, out = _run(self._check_cmd)
+            if ok:
+                break
+
+            mentioned = files_in_error(out)
+            bad = [(req, c) for req, c in live if c.path in mentioned]
+            if not bad:
+                # can't tell which change broke it, leave config that passed last check
+                self._rollback_all(live)
+                raise JhubNginxError('Failed to reload nginx config: {}'.format(out.strip()))
+
+            for req, c in bad:
+                self._message('Rolling back {}, it fails nginx config check'.format(c.path))
+                c.rollback()
+                req.rejected[c.path] = out.strip()
+                live.remove((req, c))
+
+        with timing.span('nginx_reload', files=len(live)):
+            ok, out = _run(self._reload_cmd)
+        if not ok:
+            raise JhubNginxError('Failed to reload nginx config: {}'.format(out.strip()))
+
+    def _rollback_all(self, live):
+        errors = []
+        for _, c in reversed(live):
+            self._message('Rolling back {}'.format(c.path))
+            try:
+                c.rollback()
+            except Exception as e:
+                errors.append('{}: {}'.format(c.path, e))
+        if errors:
+            raise JhubNginxError('Failed to roll back nginx config: {}'.format('; '.join(errors)))
+
+
+def reload_scheduler(opts, message=lambda x: None):
+    """ Scheduler shared by everyone in this process using the same nginx commands
+    """
+    check_cmd = _get(opts, 'nginx.check_cmd')
+    reload_cmd = _get(opts, 'nginx.reload_cmd')
+    window = float(_get(opts, 'nginx.reload_window', 0) or 0)
+    lock_dir = locks.lock_dir(opts)
+
+    def reload_lock():
+        return locks.lock('reload', opts, message=message)
+
+    k = (check_cmd, reload_cmd, window, lock_dir)
+    with _schedulers_lock:
+        s = _schedulers.get(k)
+        if s is None:
+            s = ReloadScheduler(check_cmd, reload_cmd, window=window, lock=reload_lock, message=message)
+            _schedulers[k] = s
+    return s
@@ -0,0 +1,174 @@
+""" Long running daemon serving add/remove/dns/status requests over a Unix socket.
+
+Keeps parsed config, DNS drivers, HTTP sessions and vhost inventory warm
+between requests. Protocol is a single JSON object per line each way:
+
+  request:  {"cmd": "add", "args": {...}}
+  response: {"ok": true|false, "output": "...", "error": "...", "result": ...}
+"""
+import copy
+import io
+import json
+import os
+import socket
+import socketserver
+
+
+class DaemonError(IOError):
+    pass
+
+
+def request(socket_path, cmd, timeout=None, **args):
+    """ Send one request to the daemon and wait for the response
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            s.connect(socket_path)
+            s.sendall((json.dumps(dict(cmd=cmd, args=args)) + '\n').encode('utf-8'))
+            with s.makefile('rb') as f:
+                line = f.readline()
+    except OSError as e:
+        raise DaemonError('Failed to talk to jhub-vhost daemon at {}: {}'.format(socket_path, e))
+
+    if not line:
+        raise DaemonError('jhub-vhost daemon closed connection without response')
+
+    return json.loads(line.decode('utf-8'))
+
+
+class VhostDaemon(object):
+    """ Dispatches requests to library calls.
+
+    Requests run concurrently, domain and certificate locks (see locks.py)
+    keep them from stepping on each other. Output of every request is
+    captured separately and returned to the client.
+    """
+    def __init__(self, opts):
+        self._opts = opts
+        self._inventory = None
+
+    def opts(self, **overrides):
+        from .utils import apply_overrides
+        return apply_overrides(copy.deepcopy(self._opts), **overrides)
+
+    def inventory(self, refresh=False):
+        from ._impl import certificate_inventory
+
+        if self._inventory is None or refresh:
+            self._inventory = {domain: dict(ssl_dir=cert['ssl_dir'], not_after=cert['not_after'])
+                               for cert in certificate_inventory(self._opts)
+                               for domain in cert['domains']}
+        return self._inventory
+
+    def cmd_add(self, domains, overrides=None, **kwargs):
+        from ._impl import add_or_check_vhosts
+        try:
+            return add_or_check_vhosts(domains, opts=self.opts(**(overrides or {})), **kwargs)
+        finally:
+            self.inventory(refresh=True)
+
+    def cmd_apply(self, desired, overrides=None, **kwargs):
+        from ._impl import apply_hubs
+        try:
+            out = apply_hubs(desired, opts=self.opts(**(overrides or {})), **kwargs)
+        finally:
+            self.inventory(refresh=True)
+        out['failed'] = {domain: str(err) for domain, err in out['failed'].items()}
+        return out
+
+    def cmd_renew(self, overrides=None, **kwargs):
+        from ._impl import renew_certificates
+        try:
+            out = renew_certificates(self.opts(**(overrides or {})), **kwargs)
+        finally:
+            self.inventory(refresh=True)
+        return {ssl_dir: None if err is None else str(err) for ssl_dir, err in out.items()}
+
+    def cmd_remove(self, domain, keep_certificates=False):
+        from ._impl import remove_vhost
+        try:
+            return remove_vhost(domain, self.opts(), keep_certificates=keep_certificates)
+        finally:
+            self.inventory(refresh=True)
+
+    def cmd_dns(self, domains, no_update=False, overrides=None):
+        from .dns import check_dns_many
+        out = check_dns_many(domains,
+                             opts=self.opts(**(overrides or {})),
+                             message=print,
+                             no_update=no_update)
+        return {domain: list(r) for domain, r in out.items()}
+
+    def cmd_status(self):
+        return dict(pid=os.getpid(), vhosts=self.inventory())
+
+    def dispatch(self, req):
+        from .utils import JhubNginxError, capture_output
+
+        cmd = req.get('cmd')
+        handler = getattr(self, 'cmd_' + str(cmd), None)
+        if handler is None:
+            return dict(ok=False, output='', error='Unknown command: {}'.format(cmd), result=None)
+
+        def run():
+            try:
+                return dict(ok=True, error=None, result=handler(**req.get('args', {})))
+            except (JhubNginxError, TypeError) as e:
+                return dict(ok=False, error=str(e), result=None)
+            except Exception as e:
+                # unexpected failure of one request must not take the daemon down
+                return dict(ok=False, error='{}: {}'.format(type(e).__name__, e), result=None)
+
+        if cmd == 'status':
+            return dict(run(), output='')
+
+        with capture_output(io.StringIO()) as out:
+            resp = run()
+        return dict(resp, output=out.getvalue())
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                req = json.loads(line.decode('utf-8'))
+            except ValueError as e:
+                resp = dict(ok=False, output='', error='Bad request: {}'.format(e), result=None)
+            else:
+                resp = self.server.vhost_daemon.dispatch(req)
+
+            self.wfile.write((json.dumps(resp) + '\n').encode('utf-8'))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path, opts, message=lambda x: None):
+    """ Serve requests on a Unix socket until interrupted
+    """
+    if os.path.exists(socket_path):
+        try:
+            request(socket_path, 'status', timeout=1)
+        except DaemonError:
+            os.remove(socket_path)  # stale socket left behind
+        else:
+            raise DaemonError('Daemon is already running on {}'.format(socket_path))
+
+    from . import _impl, dns  # noqa: F401 -- import once up front rather than on first request
+
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+    daemon = VhostDaemon(opts)
+    daemon.inventory()
+
+    with _Server(socket_path, _Handler) as srv:
+        srv.vhost_daemon = daemon
+        os.chmod(socket_path, 0o660)
+        message('Serving on {}'.format(socket_path))
+        try:
+            srv.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
@@ -0,0 +1,258 @@
+""" Proxy latency statistics from access logs of generated vhosts.
+
+Vhosts log in `jhub_timing` format (see http.conf template), one tab separated
+line per request:
+
+  msec  host  method  uri  status  upgrade  request_time  upstream_connect_time  upstream_response_time  bytes
+
+Logs are streamed, memory use does not depend on log size: per domain and
+route class (static, api, websocket, page) only counts and fixed size
+quantile sketches are kept.
+"""
+import glob
+import math
+import os
+import re
+import time
+from pathlib import Path
+from pydash import get as _get
+
+ROUTE_CLASSES = ('static', 'api', 'websocket', 'page')
+
+_STATIC = re.compile(r'^(/hub)?/static/|^/user/[^/]+/(static|lab/static|nbextensions)/')
+_WEBSOCKET = re.compile(r'/api/kernels/[^/]+/(channels|iopub|shell|stdin)|/terminals/websocket/')
+_NUM_FIELDS = 10
+
+
+class QuantileSketch(object):
+    """ Streaming quantiles with bounded relative error (DDSketch style).
+
+    Values are counted in logarithmically sized buckets, quantile estimates
+    are within `relative_accuracy` of the true value. Number of buckets only
+    depends on the range of values seen, not on how many were added.
+    """
+    def __init__(self, relative_accuracy=0.01, min_value=1e-6):
+        self._gamma = (1 + relative_accuracy)/(1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._min_value = min_value
+        self._buckets = {}
+        self._zeros = 0
+        self.count = 0
+
+    def add(self, v):
+        self.count += 1
+        if v < self._min_value:
+            self._zeros += 1
+            return
+        k = int(math.ceil(math.log(v)/self._log_gamma))
+        self._buckets[k] = self._buckets.get(k, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self._zeros += other._zeros
+        for k, n in other._buckets.items():
+            self._buckets[k] = self._buckets.get(k, 0) + n
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+
+        rank = q*(self.count - 1)
+        seen = self._zeros
+        if rank < seen:
+            return 0.0
+
+        for k in sorted(self._buckets):
+            seen += self._buckets[k]
+            if rank < seen:
+                return 2*self._gamma**k/(self._gamma + 1)
+
+        return 2*self._gamma**max(self._buckets)/(self._gamma + 1)
+
+
+def route_class(uri, upgrade=''):
+    if upgrade not in ('', '-') or _WEBSOCKET.search(uri):
+        return 'websocket'
+    if _STATIC.search(uri):
+        return 'static'
+    if '/api/' in uri:
+        return 'api'
+    return 'page'
+
+
+def _seconds(v):
+    """ upstream times are '-' without upstream and comma separated on retries
+    """
+    try:
+        return sum(float(x) for x in v.replace(':', ',').split(',') if x.strip() not in ('', '-'))
+    except ValueError:
+        return None
+
+
+def parse_line(line):
+    """ Returns dict(ts, host, uri, status, upgrade, request_time, connect_time, response_time) or None
+    """
+    parts = line.rstrip('\n').split('\t')
+    if len(parts) < _NUM_FIELDS:
+        return None
+
+    # uri may contain tabs, everything around it has a fixed position
+    n = len(parts) - _NUM_FIELDS
+    ts, host, method = parts[:3]
+    uri = '\t'.join(parts[3:4 + n])
+    status, upgrade, request_time, connect_time, response_time, _ = parts[4 + n:]
+
+    try:
+        return dict(ts=float(ts),
+                    host=host,
+                    method=method,
+                    uri=uri,
+                    status=int(status),
+                    upgrade=upgrade,
+                    request_time=float(request_time),
+                    connect_time=_seconds(connect_time),
+                    response_time=_seconds(response_time))
+    except ValueError:
+        return None
+
+
+class RouteStats(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.first = None
+        self.last = None
+        self.request_time = QuantileSketch()
+        self.response_time = QuantileSketch()
+
+    def add(self, r):
+        self.count += 1
+        self.errors += r['status'] >= 500
+        self.first = r['ts'] if self.first is None else min(self.first, r['ts'])
+        self.last = r['ts'] if self.last is None else max(self.last, r['ts'])
+        self.request_time.add(r['request_time'])
+        if r['response_time'] is not None:
+            self.response_time.add(r['response_time'])
+
+    def rate(self):
+        if self.count < 2 or self.last <= self.first:
+            return None
+        return self.count/(self.last - self.first)
+
+
+class LogStats(object):
+    """ Accumulates per (domain, route class) statistics
+    """
+    def __init__(self):
+        self.routes = {}
+        self.skipped = 0
+
+    def add_line(self, line):
+        r = parse_line(line)
+        if r is None:
+            self.skipped += 1
+            return
+
+        k = (r['host'], route_class(r['uri'], r['upgrade']))
+        s = self.routes.get(k)
+        if s is None:
+            s = self.routes[k] = RouteStats()
+        s.add(r)
+
+    def report(self, domains=None):
+        """ Returns list of dict(domain, route, count, rate, errors, p50, p95, p99, upstream_p99)
+        """
+        out = []
+        for (domain, route), s in sorted(self.routes.items()):
+            if domains and domain not in domains:
+                continue
+            out.append(dict(domain=domain,
+                            route=route,
+                            count=s.count,
+                            rate=s.rate(),
+                            errors=s.errors,
+                            p50=s.request_time.quantile(0.5),
+                            p95=s.request_time.quantile(0.95),
+                            p99=s.request_time.quantile(0.99),
+                            upstream_p99=s.response_time.quantile(0.99)))
+        return out
+
+
+def log_files(opts):
+    """ Access logs of generated vhosts
+    """
+    path = _get(opts, 'nginx.access_log.path')
+    if not path:
+        return []
+    return sorted(glob.glob(str(Path(path)/'*.access.log')))
+
+
+def follow_lines(paths, follow=False, poll=1, stop=lambda: False):
+    """ Generate lines from all files, with follow keep reading appended lines.
+
+    Files replaced by log rotation are re-opened. Yields None whenever all
+    files are exhausted so that caller can report progress.
+    """
+    files = {}
+
+    def reopen(path):
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return None
+        # partially written line is kept as bytes until its newline arrives,
+        # multi-byte characters split across writes are decoded only once whole
+        files[path] = (f, os.fstat(f.fileno()).st_ino, [b''])
+        return f
+
+    def decode(line):
+        return line.decode('utf-8', 'replace')
+
+    for path in paths:
+        reopen(path)
+
+    while True:
+        for path in list(files):
+            f, _, partial = files[path]
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                if not line.endswith(b'\n'):  # partially written, finish later
+                    partial[0] += line
+                    break
+                yield decode(partial[0] + line)
+                partial[0] = b''
+
+        if not follow or stop():
+            return
+
+        yield None
+        time.sleep(poll)
+
+        for path, (f, ino, partial) in list(files.items()):
+            try:
+                rotated = os.stat(path).st_ino != ino
+            except OSError:
+                continue
+            if rotated:
+                tail = partial[0] + f.read()  # whatever was written before rotation
+                for line in tail.splitlines(keepends=True):
+                    yield decode(line)
+                f.close()
+                reopen(path)
+
+
+def format_report(rows):
+    def ms(v):
+        return '-' if v is None else '{:.1f}'.format(v*1000)
+
+    header = '{:<32} {:<10} {:>10} {:>8} {:>7} {:>9} {:>9} {:>9} {:>11}'.format(
+        'domain', 'route', 'requests', 'req/s', '5xx', 'p50 ms', 'p95 ms', 'p99 ms', 'up p99 ms')
+    lines = [header]
+    for r in rows:
+        lines.append('{:<32} {:<10} {:>10} {:>8} {:>7} {:>9} {:>9} {:>9} {:>11}'.format(
+            r['domain'], r['route'], r['count'],
+            '-' if r['rate'] is None else '{:.1f}'.format(r['rate']),
+            r['errors'], ms(r['p50']), ms(r['p95']), ms(r['p99']), ms(r['upstream_p99'])))
+    return '\n'.join(lines)
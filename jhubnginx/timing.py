@@ -0,0 +1,160 @@
+""" Timing of provisioning phases.
+
+Code wraps phases it wants measured with `span(name, **labels)`, every
+finished span is passed to all registered sinks as a dictionary:
+
+  {"name": "certbot", "seconds": 12.5, "ok": true, "start": 1700000000.0,
+   "pid": 123, "domain": "jupyter.example.com"}
+
+Sinks are callables, `configure(opts)` registers file sinks listed under
+`timing` in config: JSON lines appended to a file and Prometheus
+textfile-collector output. Spans cost next to nothing when no sink is
+registered.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+from pydash import get as _get
+
+_sinks = []
+_configured = set()
+_lock = threading.Lock()
+
+
+def add_sink(sink):
+    with _lock:
+        if sink not in _sinks:
+            _sinks.append(sink)
+
+
+def remove_sink(sink):
+    with _lock:
+        if sink in _sinks:
+            _sinks.remove(sink)
+
+
+@contextlib.contextmanager
+def span(name, **labels):
+    """ Measure time spent in the with block, exceptions are recorded as ok=False
+    """
+    if not _sinks:
+        yield
+        return
+
+    start = time.time()
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        record = dict(name=name,
+                      seconds=time.perf_counter() - t0,
+                      ok=ok,
+                      start=start,
+                      pid=os.getpid(),
+                      **labels)
+        for sink in list(_sinks):
+            sink(record)
+
+
+class JsonLinesSink(object):
+    """ Appends one JSON object per span to a file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock, open(self.path, 'a') as f:
+            f.write(line)
+
+
+class PrometheusSink(object):
+    """ Keeps a textfile-collector file with per phase totals.
+
+    Totals are re-read from the file on every update while holding a lock
+    on `<path>.lock`, so counters keep growing across runs of the command
+    line tool and concurrent processes do not lose each other's updates.
+    """
+    PREFIX = 'jhub_vhost_phase'
+    _LINE = re.compile(r'^(\w+)\{phase="([^"]*)"\} (\S+)$')
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        stats = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    m = self._LINE.match(line.strip())
+                    if m:
+                        metric, phase, value = m.groups()
+                        stats.setdefault(phase, {})[metric[len(self.PREFIX) + 1:]] = float(value)
+        except (OSError, ValueError):
+            pass
+        return stats
+
+    def _render(self, stats):
+        metrics = [('seconds_sum', 'summary', 'Time spent in provisioning phase'),
+                   ('seconds_count', None, None),
+                   ('failures_total', 'counter', 'Provisioning phases that failed'),
+                   ('last_seconds', 'gauge', 'Duration of the most recent run of the phase')]
+        out = []
+        for metric, kind, help in metrics:
+            name = '{}_{}'.format(self.PREFIX, metric)
+            if kind is not None:
+                base = name[:-len('_sum')] if metric == 'seconds_sum' else name
+                out.append('# HELP {} {}'.format(base, help))
+                out.append('# TYPE {} {}'.format(base, kind))
+            for phase in sorted(stats):
+                out.append('{}{{phase="{}"}} {}'.format(name, phase, repr(stats[phase].get(metric, 0.0))))
+        return '\n'.join(out) + '\n'
+
+    def __call__(self, record):
+        with self._lock, open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stats = self._load()
+
+            s = stats.setdefault(record['name'], {})
+            s['seconds_sum'] = s.get('seconds_sum', 0.0) + record['seconds']
+            s['seconds_count'] = s.get('seconds_count', 0.0) + 1
+            s['failures_total'] = s.get('failures_total', 0.0) + (0 if record['ok'] else 1)
+            s['last_seconds'] = record['seconds']
+
+            tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(self._render(stats))
+            os.replace(tmp, self.path)
+
+
+def sink_for_file(path):
+    """ Prometheus sink for *.prom files, JSON lines otherwise
+    """
+    if path.endswith('.prom'):
+        return PrometheusSink(path)
+    return JsonLinesSink(path)
+
+
+def configure(opts):
+    """ Register file sinks from `timing.jsonl` and `timing.prometheus`, once per file
+    """
+    for key, cls in (('jsonl', JsonLinesSink), ('prometheus', PrometheusSink)):
+        path = _get(opts, 'timing.' + key)
+        if not path:
+            continue
+
+        with _lock:
+            if (key, path) in _configured:
+                continue
+            _configured.add((key, path))
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        add_sink(cls(path))
@@ -1,13 +1,21 @@
-import requests
 import socket
-import yaml
 import os
+import sys
+import contextlib
+import copy
+import functools
+import json
 import time
 import subprocess
 import shlex
 import shutil
-from pydash import map_values_deep, defaults_deep
+import ipaddress
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from pydash import map_values_deep, defaults_deep, get as _get
 from ._templates import DEFAULT_CFG
+from . import timing
 
 
 class JhubNginxError(Exception):
@@ -57,25 +65,157 @@ def dns_wait(domain, ip, timeout, cbk=None, use_dig=True):
     return True
 
 
-def public_ip():
-    endpoints = [
-        ('http://instance-data/latest/meta-data/public-ipv4', None),  # AWS
-        ('http://metadata/computeMetadata/v1/instance/network-interfaces/0/access-configs/0/external-ip',
-         {"Metadata-Flavor": "Google"}),  # GCE
-        ('https://api.ipify.org', None),  # all other
-    ]
+_shared_lock = threading.Lock()
+_session = None
+_ip_pool = None
 
-    for (url, hdrs) in endpoints:
-        try:
-            with requests.get(url, headers=hdrs, timeout=1) as req:
-                if req:
-                    return req.text
-        except IOError:
-            pass
+
+def http_session():
+    """ Requests session shared by all threads, keeps connections alive between calls
+
+    Daemon serves every connection on a new thread, per-thread sessions
+    would never be reused there.
+    """
+    global _session
+    with _shared_lock:
+        if _session is None:
+            import requests
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+
+_output = threading.local()
+_capturing = 0
+
+
+class _ThreadOutput(object):
+    """ sys.stdout replacement, writes go to the stream captured by the current thread
+    """
+    def __init__(self, default):
+        self._default = default
+
+    def _stream(self):
+        return getattr(_output, 'stream', None) or self._default
+
+    def write(self, txt):
+        return self._stream().write(txt)
+
+    def flush(self):
+        return self._stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream(), name)
+
+
+@contextlib.contextmanager
+def capture_output(stream):
+    """ Send print() output of this thread to stream, other threads are not affected.
+
+    Work handed to other threads should be wrapped with same_output.
+    """
+    global _capturing
+    with _shared_lock:
+        if _capturing == 0 and not isinstance(sys.stdout, _ThreadOutput):
+            sys.stdout = _ThreadOutput(sys.stdout)
+        _capturing += 1
+
+    prev = getattr(_output, 'stream', None)
+    _output.stream = stream
+    try:
+        yield stream
+    finally:
+        _output.stream = prev
+        with _shared_lock:
+            _capturing -= 1
+            if _capturing == 0 and isinstance(sys.stdout, _ThreadOutput):
+                sys.stdout = sys.stdout._default
+
+
+def same_output(fn):
+    """ Wrap fn so that it prints wherever the calling thread prints, whichever thread runs it
+    """
+    stream = getattr(_output, 'stream', None)
+    if stream is None:
+        return fn
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        with capture_output(stream):
+            return fn(*args, **kwargs)
+    return run
+
+
+def _public_ip_pool():
+    global _ip_pool
+    with _shared_lock:
+        if _ip_pool is None:
+            _ip_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='public-ip')
+    return _ip_pool
+
+
+def _fetch_ip(url, headers, timeout):
+    try:
+        with http_session().get(url, headers=headers, timeout=timeout) as req:
+            if req:
+                ip = req.text.strip()
+                ipaddress.IPv4Address(ip)
+                return ip
+    except (IOError, ValueError):
+        pass
 
     return None
 
 
+def query_public_ip(endpoints, headers=None, timeout=1):
+    """ Query all endpoints concurrently, return first valid IPv4 answer
+    """
+    if len(endpoints) == 0:
+        return None
+
+    futures = [_public_ip_pool().submit(_fetch_ip, url, headers, timeout) for url in endpoints]
+    try:
+        for f in as_completed(futures):
+            ip = f.result()
+            if ip is not None:
+                return ip
+    finally:
+        for f in futures:
+            f.cancel()
+
+    return None
+
+
+def public_ip(opts=None, refresh=False):
+    """ Find public IP of this host, result is cached on disk for `public_ip.cache_ttl` seconds
+
+    refresh -- ignore cached value
+    """
+    opts = default_opts() if opts is None else opts
+    cfg = _get(opts, 'public_ip', {})
+    ttl = cfg.get('cache_ttl', 0)
+    state_dir = _get(opts, 'state_dir')
+    cache_file = None if state_dir is None else Path(state_dir)/'public_ip.json'
+
+    if cache_file is not None and ttl and not refresh:
+        cached = read_json(str(cache_file))
+        if cached is not None and time.time() - cached.get('time', 0) < ttl:
+            return cached.get('ip')
+
+    with timing.span('public_ip'):
+        ip = query_public_ip(cfg.get('endpoints', []),
+                             headers=cfg.get('headers'),
+                             timeout=cfg.get('timeout', 1))
+
+    if ip is not None and cache_file is not None:
+        write_json(str(cache_file), dict(ip=ip, time=time.time()))
+
+    return ip
+
+
 def slurp(filename):
     try:
         with open(filename, 'r') as f:
@@ -84,6 +224,32 @@ def slurp(filename):
         return None
 
 
+def read_json(filename):
+    txt = slurp(filename)
+    if txt is None:
+        return None
+
+    try:
+        return json.loads(txt)
+    except ValueError:
+        return None
+
+
+def write_json(filename, data):
+    """ Write json atomically, returns False if state directory is not writable
+    """
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, filename)
+    except OSError:
+        return False
+
+    return True
+
+
 def check_first_line(fname, header):
     with open(fname, 'rt') as f:
         return f.readline().rstrip() == header
@@ -103,8 +269,16 @@ def write_if_different(filename, content):
     return True
 
 
+@functools.lru_cache(maxsize=1)
+def _parsed_default_cfg():
+    import yaml
+    return yaml.safe_load(DEFAULT_CFG)
+
+
 def default_opts(opts=None):
-    default_opts = yaml.load(DEFAULT_CFG)
+    """ Fill in defaults, DEFAULT_CFG is parsed once, every call gets its own copy
+    """
+    default_opts = copy.deepcopy(_parsed_default_cfg())
     if opts is None:
         return default_opts
 
@@ -112,6 +286,8 @@ def default_opts(opts=None):
 
 
 def opts_from_file(filename, ignore_missing=False):
+    import yaml
+
     txt = slurp(filename)
 
     if txt is None:
@@ -137,3 +313,20 @@ def resolve_env(v, prefix='env/'):
 
 def opts_update_from_env(opts):
     return map_values_deep(opts, lambda x: resolve_env(x, prefix='env/'))
+
+
+def apply_overrides(opts, email=None, token=None, route53=False, refresh_ip=False):
+    """ Apply command line overrides to config
+    """
+    if email is not None:
+        opts['letsencrypt']['email'] = email
+
+    if token is not None:
+        opts['dns']['token'] = token
+    elif route53:
+        opts['dns']['type'] = 'route53'
+
+    if refresh_ip:
+        opts['public_ip']['cache_ttl'] = 0
+
+    return opts
@@ -27,6 +27,7 @@ Automates exposing jupyterhub instances to the web in a safe manner.
     extras_require=dict(
         dns=['apache-libcloud'],
         ec2=['apache-libcloud', 'boto3'],
+        acme=['cryptography'],
     ),
     entry_points={
         "console_scripts": [
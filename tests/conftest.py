@@ -0,0 +1,78 @@
+import os
+import stat
+
+import pytest
+
+from jhubnginx import utils
+
+FAKE_CERTBOT = '''#!/bin/sh
+# logs arguments, writes empty certificate files for --cert-name or every --domains
+echo "$@" >> "$CERTBOT_LOG"
+[ "$1" = "revoke" ] && exit 0
+name=""
+prev=""
+for a in "$@"; do
+  case "$prev" in --cert-name) name=$a;; esac
+  prev=$a
+done
+prev=""
+for a in "$@"; do
+  case "$prev" in
+    --domains)
+      d=${name:-$a}
+      mkdir -p "$SSL_ROOT/$d"
+      touch "$SSL_ROOT/$d/privkey.pem" "$SSL_ROOT/$d/fullchain.pem" "$SSL_ROOT/$d/cert.pem";;
+  esac
+  prev=$a
+done
+'''
+
+# fails like `nginx -t` does when a certificate used by a vhost is missing,
+# the error names no config file
+CHECK_CERTS = '''#!/bin/sh
+for f in $(sed -n 's/^ *ssl_certificate  *\\([^$][^ ;]*\\);/\\1/p' "$1"/*.conf); do
+  [ -e "$f" ] || { echo "nginx: [emerg] cannot load certificate \\"$f\\""; exit 1; }
+done
+'''
+
+
+def _write_exe(path, txt):
+    path.write_text(txt)
+    os.chmod(str(path), os.stat(str(path)).st_mode | stat.S_IXUSR)
+
+
+@pytest.fixture
+def sandbox(tmp_path, monkeypatch):
+    """ opts pointing everything into tmp_path, fake certbot on PATH logging
+        its arguments to tmp_path/certbot.log, nginx check fails on missing certificates
+    """
+    bin_dir = tmp_path/'bin'
+    bin_dir.mkdir()
+    _write_exe(bin_dir/'certbot', FAKE_CERTBOT)
+    _write_exe(bin_dir/'check-certs', CHECK_CERTS)
+
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ.get('PATH', ''))
+    monkeypatch.setenv('SSL_ROOT', str(tmp_path/'ssl'))
+    monkeypatch.setenv('CERTBOT_LOG', str(tmp_path/'certbot.log'))
+
+    return utils.default_opts({
+        'nginx': {'sites': str(tmp_path/'sites'),
+                  'ssl_root': str(tmp_path/'ssl'),
+                  'check_cmd': '{} {}'.format(bin_dir/'check-certs', tmp_path/'sites'),
+                  'reload_cmd': 'true',
+                  'access_log': {'path': str(tmp_path/'log')}},
+        'letsencrypt': {'webroot': str(tmp_path/'www'),
+                        'email': 'test@example.com',
+                        'retry_delay': 0},
+        'state_dir': str(tmp_path/'state'),
+    })
+
+
+@pytest.fixture
+def certbot_log(tmp_path):
+    """ Returns callable listing arguments of every fake certbot run, one list per run
+    """
+    def read():
+        txt = utils.slurp(str(tmp_path/'certbot.log')) or ''
+        return [line.split() for line in txt.splitlines()]
+    return read
@@ -0,0 +1,267 @@
+import base64
+import datetime
+import hashlib
+import json
+import os
+
+import pytest
+
+pytest.importorskip('cryptography')
+pytest.importorskip('requests')
+
+from cryptography import x509  # noqa: E402
+from cryptography.hazmat.primitives import hashes  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import ec, rsa, utils  # noqa: E402
+from cryptography.hazmat.primitives.serialization import (  # noqa: E402
+    Encoding, PublicFormat, load_pem_private_key)
+from cryptography.x509.oid import NameOID  # noqa: E402
+
+from jhubnginx.acme import AcmeClient, AcmeError  # noqa: E402
+
+DIRECTORY = 'https://acme.test/directory'
+
+
+class FakeResponse(object):
+    def __init__(self, body='', status=200, headers=None, url=''):
+        self.text = body if isinstance(body, str) else json.dumps(body)
+        self.status_code = status
+        self.ok = status < 400
+        self.headers = dict({'Replay-Nonce': 'nonce'}, **(headers or {}))
+        self.url = url
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeSession(object):
+    """ Answers requests from url -> FakeResponse
+    """
+    def __init__(self, responses):
+        self.responses = responses
+
+    def request(self, method, url, **kwargs):
+        r = self.responses[url]
+        r.url = url
+        return r
+
+
+def _client(tmp_path, responses):
+    responses.setdefault(DIRECTORY, FakeResponse(dict(newNonce='https://acme.test/nonce',
+                                                      newAccount='https://acme.test/account',
+                                                      newOrder='https://acme.test/order')))
+    responses.setdefault('https://acme.test/nonce', FakeResponse())
+    c = AcmeClient(DIRECTORY, str(tmp_path/'account.key'))
+    c._session = FakeSession(responses)
+    return c
+
+
+def test_directory_not_json(tmp_path):
+    c = _client(tmp_path, {DIRECTORY: FakeResponse('<html>maintenance</html>')})
+    with pytest.raises(AcmeError):
+        c.directory()
+
+
+def test_account_without_location(tmp_path):
+    c = _client(tmp_path, {'https://acme.test/account': FakeResponse(dict(status='valid'))})
+    with pytest.raises(AcmeError):
+        c.account()
+
+
+def test_order_missing_fields(tmp_path):
+    c = _client(tmp_path, {
+        'https://acme.test/account': FakeResponse({}, headers={'Location': 'https://acme.test/acct/1'}),
+        'https://acme.test/order': FakeResponse(dict(status='pending'),
+                                                headers={'Location': 'https://acme.test/order/1'}),
+    })
+    with pytest.raises(AcmeError, match='authorizations'):
+        c.issue(['a.example.com'], str(tmp_path/'ssl'), str(tmp_path/'www'))
+
+
+def test_error_response_not_json(tmp_path):
+    c = _client(tmp_path, {'https://acme.test/account': FakeResponse('Bad Gateway', status=502)})
+    with pytest.raises(AcmeError, match='Bad Gateway'):
+        c.account()
+
+
+class FakeAcmeServer(object):
+    """ In-process ACME server: checks signatures and nonces, validates http-01
+    by reading token files from webroot and signs CSRs with its own CA.
+    """
+    def __init__(self, webroot):
+        self.webroot = webroot
+        self.nonces = set()
+        self.accounts = {}
+        self.orders = {}
+        self.calls = []
+        self.seen_tokens = {}
+        self.revoked = []
+
+        self.ca_key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'Fake ACME CA')])
+        now = datetime.datetime.utcnow()
+        self.ca_cert = (x509.CertificateBuilder()
+                        .subject_name(name).issuer_name(name)
+                        .public_key(self.ca_key.public_key())
+                        .serial_number(1)
+                        .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=30))
+                        .sign(self.ca_key, hashes.SHA256()))
+
+    def _url(self, path):
+        return 'https://acme.test/' + path
+
+    def _response(self, body='', status=200, headers=None):
+        nonce = 'n{}'.format(len(self.calls))
+        self.nonces.add(nonce)
+        return FakeResponse(body, status, dict({'Replay-Nonce': nonce}, **(headers or {})))
+
+    def _verify(self, url, body):
+        def unb64(s):
+            return base64.urlsafe_b64decode(s + '='*(-len(s) % 4))
+
+        protected = json.loads(unb64(body['protected']))
+        assert protected['url'] == url
+        assert protected['alg'] == 'ES256'
+        assert protected['nonce'] in self.nonces
+        self.nonces.remove(protected['nonce'])
+
+        if 'jwk' in protected:
+            jwk = protected['jwk']
+        else:
+            jwk = self.accounts[protected['kid']]
+        key = ec.EllipticCurvePublicNumbers(int.from_bytes(unb64(jwk['x']), 'big'),
+                                            int.from_bytes(unb64(jwk['y']), 'big'),
+                                            ec.SECP256R1()).public_key()
+        sig = unb64(body['signature'])
+        key.verify(utils.encode_dss_signature(int.from_bytes(sig[:32], 'big'), int.from_bytes(sig[32:], 'big')),
+                   '{}.{}'.format(body['protected'], body['payload']).encode('ascii'),
+                   ec.ECDSA(hashes.SHA256()))
+        return jwk, (json.loads(unb64(body['payload'])) if body['payload'] else None)
+
+    def _thumbprint(self, jwk):
+        jwk_json = json.dumps(jwk, sort_keys=True, separators=(',', ':'))
+        return base64.urlsafe_b64encode(hashlib.sha256(jwk_json.encode('utf-8')).digest()).rstrip(b'=').decode()
+
+    def _issue(self, csr_der):
+        csr = x509.load_der_x509_csr(csr_der)
+        assert csr.is_signature_valid
+        now = datetime.datetime.utcnow()
+        cert = (x509.CertificateBuilder()
+                .subject_name(csr.subject).issuer_name(self.ca_cert.subject)
+                .public_key(csr.public_key())
+                .serial_number(x509.random_serial_number())
+                .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=90))
+                .add_extension(csr.extensions.get_extension_for_class(x509.SubjectAlternativeName).value,
+                               critical=False)
+                .sign(self.ca_key, hashes.SHA256()))
+        return (cert.public_bytes(Encoding.PEM) + self.ca_cert.public_bytes(Encoding.PEM)).decode('ascii')
+
+    def request(self, method, url, data=None, **kwargs):
+        path = url[len(self._url('')):]
+        self.calls.append(path.split('/')[0])
+
+        if path == 'directory':
+            return self._response(dict(newNonce=self._url('nonce'), newAccount=self._url('account'),
+                                       newOrder=self._url('order'), revokeCert=self._url('revoke')))
+        if path == 'nonce':
+            return self._response()
+
+        jwk, payload = self._verify(url, json.loads(data))
+
+        if path == 'account':
+            assert payload['termsOfServiceAgreed']
+            kid = self._url('acct/{}'.format(len(self.accounts)))
+            self.accounts[kid] = jwk
+            return self._response(dict(status='valid'), 201, {'Location': kid})
+
+        if path == 'order':
+            oid = str(len(self.orders))
+            domains = [i['value'] for i in payload['identifiers']]
+            self.orders[oid] = dict(status='pending', domains=domains, jwk=jwk, valid=set(),
+                                    authorizations=[self._url('authz/{}/{}'.format(oid, d)) for d in domains],
+                                    finalize=self._url('finalize/{}'.format(oid)))
+            return self._response(self._order(oid), 201, {'Location': self._url('orders/' + oid)})
+
+        if path.startswith('authz/'):
+            _, oid, domain = path.split('/')
+            order = self.orders[oid]
+            return self._response(dict(
+                identifier=dict(type='dns', value=domain),
+                status='valid' if domain in order['valid'] else 'pending',
+                challenges=[dict(type='dns-01', url=self._url('chall/x'), token='dns'),
+                            dict(type='http-01', url=self._url('chall/{}/{}'.format(oid, domain)),
+                                 token='tok-' + domain.replace('.', '-'))]))
+
+        if path.startswith('chall/'):
+            _, oid, domain = path.split('/')
+            order = self.orders[oid]
+            token = 'tok-' + domain.replace('.', '-')
+            token_file = os.path.join(self.webroot, '.well-known', 'acme-challenge', token)
+            with open(token_file) as f:
+                self.seen_tokens[domain] = f.read()
+            assert self.seen_tokens[domain] == '{}.{}'.format(token, self._thumbprint(order['jwk']))
+            order['valid'].add(domain)
+            if order['valid'] == set(order['domains']):
+                order['status'] = 'ready'
+            return self._response(dict(type='http-01', status='processing'))
+
+        if path.startswith('finalize/'):
+            oid = path.split('/')[1]
+            order = self.orders[oid]
+            assert order['status'] == 'ready'
+            order['cert'] = self._issue(base64.urlsafe_b64decode(payload['csr'] + '='*(-len(payload['csr']) % 4)))
+            order['status'] = 'valid'
+            return self._response(self._order(oid))
+
+        if path.startswith('orders/'):
+            return self._response(self._order(path.split('/')[1]))
+
+        if path.startswith('cert/'):
+            return self._response(self.orders[path.split('/')[1]]['cert'])
+
+        if path == 'revoke':
+            self.revoked.append(payload['certificate'])
+            return self._response()
+
+        return self._response(dict(type='urn:ietf:params:acme:error:malformed', detail=path), 404)
+
+    def _order(self, oid):
+        order = self.orders[oid]
+        body = dict(status=order['status'], authorizations=order['authorizations'], finalize=order['finalize'])
+        if order['status'] == 'valid':
+            body['certificate'] = self._url('cert/' + oid)
+        return body
+
+
+@pytest.mark.parametrize('key_type', ['rsa', 'ecdsa'])
+def test_issue_round_trip(tmp_path, key_type):
+    webroot = str(tmp_path/'www')
+    server = FakeAcmeServer(webroot)
+    c = AcmeClient(DIRECTORY, str(tmp_path/'account.key'), poll_interval=0)
+    c._session = server
+
+    domains = ['a.example.com', 'b.example.com']
+    assert c.issue(domains, str(tmp_path/'ssl'), webroot, key_type=key_type) is True
+
+    assert server.calls[:4] == ['directory', 'nonce', 'account', 'order']
+    assert {'authz', 'chall', 'finalize', 'orders', 'cert'} <= set(server.calls)
+    assert sorted(server.seen_tokens) == domains
+    assert os.listdir(os.path.join(webroot, '.well-known', 'acme-challenge')) == []
+
+    ssl_dir = tmp_path/'ssl'
+    cert = x509.load_pem_x509_certificate((ssl_dir/'cert.pem').read_bytes())
+    san = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+    assert san.get_values_for_type(x509.DNSName) == domains
+    assert (ssl_dir/'fullchain.pem').read_text() == (ssl_dir/'cert.pem').read_text() + (ssl_dir/'chain.pem').read_text()
+    assert x509.load_pem_x509_certificate((ssl_dir/'chain.pem').read_bytes()) == server.ca_cert
+
+    key = load_pem_private_key((ssl_dir/'privkey.pem').read_bytes(), password=None)
+    assert isinstance(key, ec.EllipticCurvePrivateKey if key_type == 'ecdsa' else rsa.RSAPrivateKey)
+    der = (Encoding.DER, PublicFormat.SubjectPublicKeyInfo)
+    assert key.public_key().public_bytes(*der) == cert.public_key().public_bytes(*der)
+    assert oct((ssl_dir/'privkey.pem').stat().st_mode & 0o777) == '0o600'
+
+    # second order reuses the account, revoke signs with it too
+    c.issue(['c.example.com'], str(tmp_path/'ssl2'), webroot)
+    assert server.calls.count('account') == 1
+    assert c.revoke(str(ssl_dir/'cert.pem')) is True
+    assert len(server.revoked) == 1
@@ -0,0 +1,153 @@
+import copy
+import os
+
+from click.testing import CliRunner
+
+from jhubnginx import utils
+from jhubnginx._impl import add_or_check_vhosts, parse_desired, plan_changes
+from jhubnginx.app import cli
+
+DOMAINS = ['a.example.com', 'b.example.com']
+
+
+def _opts(tmp_path):
+    for domain in DOMAINS:
+        ssl_dir = tmp_path/'ssl'/domain
+        ssl_dir.mkdir(parents=True)
+        for name in ('privkey.pem', 'fullchain.pem', 'cert.pem'):
+            (ssl_dir/name).touch()
+
+    return utils.default_opts({
+        'nginx': {'sites': str(tmp_path/'sites'),
+                  'ssl_root': str(tmp_path/'ssl'),
+                  'check_cmd': 'true',
+                  'reload_cmd': 'true',
+                  'access_log': {'path': str(tmp_path/'log')}},
+        'letsencrypt': {'webroot': str(tmp_path/'www')},
+        'state_dir': str(tmp_path/'state'),
+    })
+
+
+def test_unchanged_hubs_with_other_flags_are_not_updated(tmp_path):
+    opts = _opts(tmp_path)
+    add_or_check_vhosts(DOMAINS, skip_dns_check=True, opts=copy.deepcopy(opts))
+
+    desired = parse_desired(dict(hubs=DOMAINS))
+    assert plan_changes(desired, opts)['unchanged'] == DOMAINS
+
+    # same as `--timing t.prom apply --email ... --refresh-ip`
+    other = copy.deepcopy(opts)
+    other['timing'] = dict(prometheus=str(tmp_path/'t.prom'))
+    utils.apply_overrides(other, email='someone@example.com', refresh_ip=True)
+
+    plan = plan_changes(desired, other)
+    assert plan['update'] == []
+    assert plan['unchanged'] == DOMAINS
+
+
+def test_empty_hubs_file_needs_explicit_prune(tmp_path):
+    hubs = tmp_path/'hubs.yml'
+    hubs.write_text('hubs: []\n')
+
+    r = CliRunner().invoke(cli, ['apply', '-f', str(hubs)])
+    assert r.exit_code != 0
+    assert '--prune' in r.output
+
+
+def test_move_hub_off_shared_certificate(sandbox, certbot_log, tmp_path):
+    from jhubnginx._impl import apply_hubs, current_vhosts
+
+    shared = [dict(domain=d, cert_name='teams') for d in DOMAINS]
+    plan = apply_hubs(parse_desired(dict(hubs=shared)), copy.deepcopy(sandbox), skip_dns_check=True)
+    assert plan['failed'] == {}
+
+    desired = parse_desired(dict(hubs=['a.example.com', dict(domain='b.example.com', cert_name='teams')]))
+    plan = apply_hubs(desired, copy.deepcopy(sandbox), skip_dns_check=True)
+
+    assert plan['update'] == ['a.example.com']
+    assert plan['failed'] == {}
+    vhosts = current_vhosts(sandbox)
+    assert vhosts['a.example.com']['ssl_dir'] == tmp_path/'ssl'/'a.example.com'
+    assert vhosts['b.example.com']['ssl_dir'] == tmp_path/'ssl'/'teams'
+    assert (tmp_path/'ssl'/'a.example.com'/'fullchain.pem').exists()
+    last = certbot_log()[-1]
+    assert last[last.index('--domains'):].count('--domains') == 1
+    assert last[last.index('--domains') + 1] == 'a.example.com'
+
+
+def test_failed_update_keeps_working_vhost(sandbox, tmp_path, monkeypatch):
+    from jhubnginx._impl import apply_hubs, current_vhosts
+
+    apply_hubs(parse_desired(dict(hubs=DOMAINS)), copy.deepcopy(sandbox), skip_dns_check=True)
+    before = (tmp_path/'sites'/'a.example.com.conf').read_text()
+
+    # certificate request "succeeds" but leaves no files behind
+    monkeypatch.setenv('SSL_ROOT', str(tmp_path/'elsewhere'))
+    desired = parse_desired(dict(hubs=[dict(domain='a.example.com', cert_name='new'), 'b.example.com']))
+    plan = apply_hubs(desired, copy.deepcopy(sandbox), skip_dns_check=True)
+
+    assert 'a.example.com' in plan['failed']
+    assert (tmp_path/'sites'/'a.example.com.conf').read_text() == before
+    assert sorted(current_vhosts(sandbox)) == DOMAINS
+
+
+def _domains(argv):
+    return [argv[i + 1] for i, a in enumerate(argv) if a == '--domains']
+
+
+def test_remove_domain_from_shared_certificate(sandbox, certbot_log, tmp_path):
+    from jhubnginx._impl import apply_hubs, current_vhosts, remove_vhost
+
+    domains = DOMAINS + ['c.example.com']
+    shared = [dict(domain=d, cert_name='teams') for d in domains]
+    plan = apply_hubs(parse_desired(dict(hubs=shared)), copy.deepcopy(sandbox), skip_dns_check=True)
+    assert plan['failed'] == {}
+    issued = len(certbot_log())
+
+    remove_vhost('a.example.com', copy.deepcopy(sandbox))
+
+    runs = certbot_log()[issued:]
+    assert len(runs) == 1
+    argv = runs[0]
+    assert argv[0] == 'certonly'
+    assert argv[argv.index('--cert-name') + 1] == 'teams'
+    assert _domains(argv) == ['b.example.com', 'c.example.com']
+    assert 'revoke' not in argv
+
+    assert not (tmp_path/'sites'/'a.example.com.conf').exists()
+    assert sorted(current_vhosts(sandbox)) == ['b.example.com', 'c.example.com']
+    for d in ('b.example.com', 'c.example.com'):
+        assert (tmp_path/'sites'/(d + '.conf')).exists()
+    assert sorted(os.listdir(str(tmp_path/'ssl'/'teams'))) == ['cert.pem', 'fullchain.pem', 'privkey.pem']
+
+
+def test_remove_last_domain_revokes(sandbox, certbot_log, tmp_path):
+    from jhubnginx._impl import apply_hubs, current_vhosts, remove_vhost
+
+    opts = copy.deepcopy(sandbox)
+    opts['letsencrypt']['ecdsa'] = True
+    apply_hubs(parse_desired(dict(hubs=DOMAINS)), copy.deepcopy(opts), skip_dns_check=True)
+    issued = len(certbot_log())
+
+    remove_vhost('a.example.com', copy.deepcopy(opts))
+
+    runs = certbot_log()[issued:]
+    ssl = tmp_path/'ssl'
+    assert runs == [['revoke', '-n', '--cert-path', str(ssl/'a.example.com'/'cert.pem')],
+                    ['revoke', '-n', '--cert-path', str(ssl/'a.example.com-ecdsa'/'cert.pem')]]
+    assert not (tmp_path/'sites'/'a.example.com.conf').exists()
+    assert sorted(current_vhosts(opts)) == ['b.example.com']
+
+
+def test_remove_keep_certificates(sandbox, certbot_log, tmp_path):
+    from jhubnginx._impl import apply_hubs, current_vhosts, remove_vhost
+
+    shared = [dict(domain=d, cert_name='teams') for d in DOMAINS]
+    apply_hubs(parse_desired(dict(hubs=shared)), copy.deepcopy(sandbox), skip_dns_check=True)
+    issued = len(certbot_log())
+
+    remove_vhost('a.example.com', copy.deepcopy(sandbox), keep_certificates=True)
+
+    assert certbot_log()[issued:] == []
+    assert sorted(current_vhosts(sandbox)) == ['b.example.com']
+    assert (tmp_path/'ssl'/'teams'/'cert.pem').exists()
@@ -0,0 +1,134 @@
+import fcntl
+import os
+import stat
+import threading
+import time
+
+import pytest
+
+from jhubnginx import certs, utils
+from jhubnginx.certs import (classify_certbot_error, backoff_delay, DomainThrottle,
+                             TRANSIENT, RATE_LIMITED, PERMANENT)
+
+# succeeds unless another instance holds the lock, like certbot does
+FAKE_CERTBOT = '''#!/bin/sh
+exec 9>"$CERTBOT_LOCK"
+flock -n 9 || { echo "Another instance of Certbot is already running."; exit 1; }
+echo "$@" >> "$CERTBOT_LOG"
+sleep 0.05
+'''
+
+
+@pytest.mark.parametrize('txt, kind', [
+    ('Error: urn:ietf:params:acme:error:rateLimited: too many certificates already issued', RATE_LIMITED),
+    ('Too Many Requests', RATE_LIMITED),
+    ('Invalid response from http://a.example.com/.well-known/acme-challenge/x: 404', PERMANENT),
+    ('DNS problem: NXDOMAIN looking up A for a.example.com', PERMANENT),
+    ('urn:ietf:params:acme:error:unauthorized', PERMANENT),
+    ('Connection reset by peer', TRANSIENT),
+    ('Another instance of Certbot is already running.', TRANSIENT),
+    ('', TRANSIENT),
+])
+def test_classify_certbot_error(txt, kind):
+    assert classify_certbot_error(txt) == kind
+
+
+def test_backoff_delay():
+    for attempt, full in [(0, 10), (1, 20), (2, 40), (5, 100)]:
+        for _ in range(50):
+            d = backoff_delay(attempt, 10, 100)
+            assert full/2 <= d <= full
+
+
+def test_domain_throttle_limits_concurrency():
+    throttle = DomainThrottle(concurrency=2)
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def work():
+        throttle.acquire('example.com')
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+        throttle.release('example.com')
+
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert peak[0] == 2
+
+
+def test_domain_throttle_pause():
+    throttle = DomainThrottle()
+    throttle.pause('example.com', 0.3)
+
+    t0 = time.time()
+    throttle.acquire('other.com')  # other domains are not paused
+    throttle.release('other.com')
+    assert time.time() - t0 < 0.1
+
+    throttle.acquire('example.com')
+    throttle.release('example.com')
+    assert time.time() - t0 >= 0.25
+
+
+@pytest.fixture
+def fake_certbot(tmp_path, monkeypatch):
+    bin_dir = tmp_path/'bin'
+    bin_dir.mkdir()
+    exe = bin_dir/'certbot'
+    exe.write_text(FAKE_CERTBOT)
+    os.chmod(str(exe), os.stat(str(exe)).st_mode | stat.S_IXUSR)
+
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ.get('PATH', ''))
+    monkeypatch.setenv('CERTBOT_LOCK', str(tmp_path/'certbot.lock'))
+    monkeypatch.setenv('CERTBOT_LOG', str(tmp_path/'certbot.log'))
+
+    return utils.default_opts({'letsencrypt': {'webroot': str(tmp_path/'www'),
+                                               'email': 'test@example.com',
+                                               'workers': 4,
+                                               'max_tries': 1}})
+
+
+def _log(tmp_path):
+    return (tmp_path/'certbot.log').read_text().splitlines()
+
+
+def test_concurrent_certbot_runs_do_not_collide(fake_certbot, tmp_path):
+    domains = ['hub{}.example{}.com'.format(i, i) for i in range(8)]
+
+    out = certs.issue_certificates(domains, fake_certbot)
+
+    assert out == {d: None for d in domains}
+    assert len(_log(tmp_path)) == 8
+
+
+def test_waits_for_certbot_of_another_process(fake_certbot, tmp_path):
+    with open(str(tmp_path/'certbot.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        timer = threading.Timer(0.5, lambda: fcntl.flock(f, fcntl.LOCK_UN))
+        timer.start()
+        out = certs.issue_certificates(['a.example.com'], fake_certbot)
+        timer.join()
+
+    assert out == {'a.example.com': None}
+    assert len(_log(tmp_path)) == 1
+
+
+def test_key_type_passed_to_certbot(sandbox, certbot_log):
+
+    sandbox['letsencrypt']['ecdsa'] = True
+    certs.obtain_certificate(['a.example.com'], sandbox, cert_name='a.example.com')
+
+    rsa, ecdsa = certbot_log()
+    assert rsa[rsa.index('--key-type') + 1] == 'rsa'
+    assert rsa[rsa.index('--cert-name') + 1] == 'a.example.com'
+    assert ecdsa[ecdsa.index('--key-type') + 1] == 'ecdsa'
+    assert ecdsa[ecdsa.index('--elliptic-curve') + 1] == 'secp256r1'
+    assert ecdsa[ecdsa.index('--cert-name') + 1] == 'a.example.com-ecdsa'
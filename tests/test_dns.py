@@ -0,0 +1,192 @@
+import threading
+import time
+
+import pytest
+
+from jhubnginx import utils, dns
+
+OLD_IP, NEW_IP, OTHER_IP = '203.0.113.1', '203.0.113.2', '198.51.100.7'
+
+
+@pytest.fixture
+def stale_cache(tmp_path, monkeypatch):
+    """ public_ip.json holds OLD_IP, endpoints report NEW_IP
+    """
+    opts = utils.default_opts({'state_dir': str(tmp_path)})
+    opts['public_ip']['cache_ttl'] = 3600
+    utils.write_json(str(tmp_path/'public_ip.json'), dict(ip=OLD_IP, time=time.time()))
+    monkeypatch.setattr(utils, 'query_public_ip', lambda *args, **kwargs: NEW_IP)
+
+    updates = []
+
+    def update_dns_many(pairs, opts):
+        updates.extend(pairs)
+        return {d: (True, '') for d, _ in pairs}
+
+    monkeypatch.setattr(dns, 'update_dns_many', update_dns_many)
+    return opts, updates
+
+
+def test_stale_cached_ip_does_not_revert_dns(stale_cache, monkeypatch):
+    opts, updates = stale_cache
+    monkeypatch.setattr(utils, 'resolve_hostname', lambda domain, use_dig=False: NEW_IP)
+
+    out = dns.check_dns_many(['a.example.com'], utils.public_ip(opts), opts)
+
+    assert out == {'a.example.com': (True, '')}
+    assert updates == []
+    assert utils.public_ip(opts) == NEW_IP  # cache refreshed
+
+
+def test_update_uses_current_ip(stale_cache, monkeypatch):
+    opts, updates = stale_cache
+    monkeypatch.setattr(utils, 'resolve_hostname', lambda domain, use_dig=False: OTHER_IP)
+
+    out = dns.check_dns_many(['a.example.com'], utils.public_ip(opts), opts)
+
+    assert out['a.example.com'][0]
+    assert updates == [('a.example.com', NEW_IP)]
+
+
+def test_check_dns_stale_cached_ip(stale_cache, monkeypatch):
+    opts, updates = stale_cache
+    monkeypatch.setattr(utils, 'resolve_hostname', lambda domain, use_dig=False: NEW_IP)
+
+    assert dns.check_dns('a.example.com', opts=opts) is True
+    assert updates == []
+
+
+class FakeDriver(object):
+    """ libcloud DNS driver accepting change batches, like route53
+    """
+    def __init__(self):
+        from libcloud.dns.base import Zone
+        self.zone = Zone('Z1', 'example.com.', 'master', 300, self)
+        self.records = {'old': OTHER_IP}
+        self.listings = 0
+        self.batches = []
+        self.accept = True
+
+    def list_zones(self):
+        return [self.zone]
+
+    def list_records(self, zone):
+        from libcloud.dns.base import Record
+        self.listings += 1
+        return [Record('A:' + name, name, 'A', ip, zone, self) for name, ip in self.records.items()]
+
+    def _post_changeset(self, zone, changes):
+        self.batches.append(changes)
+        if not self.accept:
+            return False
+        for _, name, _, ip, _ in changes:
+            self.records[name] = ip
+        return True
+
+
+@pytest.fixture
+def fake_driver(tmp_path, monkeypatch):
+    pytest.importorskip('libcloud')
+    driver = FakeDriver()
+    monkeypatch.setattr(dns, 'libcloud_driver', lambda cfg: driver)
+    opts = utils.default_opts({'state_dir': str(tmp_path), 'dns': {'type': 'route53', 'key': 'k'}})
+    return driver, opts
+
+
+def test_batched_update_keeps_index(fake_driver):
+    driver, opts = fake_driver
+    pairs = [('old.example.com', NEW_IP), ('new.example.com', NEW_IP)]
+
+    out = dns.update_dns_many(pairs, opts)
+
+    assert out == {'old.example.com': (True, ''), 'new.example.com': (True, '')}
+    assert len(driver.batches) == 1
+    assert driver.records == {'old': NEW_IP, 'new': NEW_IP}
+
+    index = dns.zone_index(driver, opts['dns'], opts)
+    assert index.find_record(driver.zone, 'new').data == NEW_IP
+    assert index.find_record(driver.zone, 'old').id == 'A:old'
+    assert driver.listings == 1  # updated in place, not listed again
+
+
+def test_rejected_batch_is_reported(fake_driver):
+    driver, opts = fake_driver
+    driver.accept = False
+
+    out = dns.update_dns_many([('old.example.com', NEW_IP)], opts)
+
+    assert out['old.example.com'][0] is False
+    index = dns.zone_index(driver, opts['dns'], opts)
+    assert index.find_record(driver.zone, 'old').data == OTHER_IP
+
+
+@pytest.fixture
+def fake_duckdns(tmp_path):
+    import http.server
+
+    requests = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            from urllib.parse import urlparse, parse_qs
+            q = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+            requests.append(q)
+            body = b'OK' if q.get('token') == 'good' else b'KO'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    srv = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=srv.serve_forever, daemon=True)
+    t.start()
+    yield 'http://127.0.0.1:{}/update'.format(srv.server_address[1]), requests
+    srv.shutdown()
+    srv.server_close()
+
+
+def test_duckdns_one_request_per_ip(fake_duckdns):
+    url, requests = fake_duckdns
+    opts = utils.default_opts({'dns': {'token': 'good', 'duckdns_url': url}})
+
+    out = dns.update_dns_many([('a.duckdns.org', NEW_IP),
+                               ('b.duckdns.org', NEW_IP),
+                               ('c.duckdns.org', OTHER_IP)], opts)
+
+    assert all(ok for ok, _ in out.values())
+    assert sorted((r['domains'], r['ip']) for r in requests) == [('a,b', NEW_IP), ('c', OTHER_IP)]
+
+
+def test_duckdns_refused(fake_duckdns):
+    url, requests = fake_duckdns
+    opts = utils.default_opts({'dns': {'token': 'bad', 'duckdns_url': url}})
+
+    out = dns.update_dns_many([('a.duckdns.org', NEW_IP)], opts)
+
+    assert out['a.duckdns.org'][0] is False
+    assert 'refused' in out['a.duckdns.org'][1]
+
+
+@pytest.mark.parametrize('domain, expect', [
+    ('example.com', 'example.com'),
+    ('x.example.com', 'example.com'),
+    ('hub.dev.example.com', 'dev.example.com'),
+    ('dev.example.com', 'dev.example.com'),
+    ('hub.prodev.example.com', 'example.com'),
+    ('X.Example.COM.', 'example.com'),
+    ('x.ample.com', 'ample.com'),
+    ('example.org', None),
+    ('com', None),
+])
+def test_zone_for_domain_longest_suffix(domain, expect):
+    zones = ['ample.com', 'example.com.', 'dev.example.com', 'Other.NET']
+    assert dns.zone_for_domain(domain, zones) == expect
+
+
+def test_zone_for_domain_needs_label_boundary():
+    assert dns.zone_for_domain('x.example.com', ['ample.com']) is None
+    assert dns.zone_for_domain('myexample.com', ['example.com']) is None
+    assert dns.zone_for_domain('x.example.com', []) is None
@@ -0,0 +1,129 @@
+import socket
+import struct
+import threading
+
+import pytest
+
+from jhubnginx import dnswatch
+from jhubnginx.dnswatch import TYPE_A, TYPE_NS, TYPE_SOA, encode_name, decode_name
+
+OLD_IP, NEW_IP = '203.0.113.1', '203.0.113.2'
+
+
+class StubDns(object):
+    """ Authoritative-ish DNS server on UDP answering from `records`:
+        (name, type) -> [value], SOA of `zone` is returned for missing names
+    """
+    def __init__(self, host, port=0, zone='example.com', records=None):
+        self.zone = zone
+        self.records = records or {}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.address = self.sock.getsockname()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.sock.close()
+
+    def _rdata(self, rtype, value):
+        if rtype == TYPE_A:
+            return socket.inet_aton(value)
+        if rtype == TYPE_SOA:
+            return encode_name(value) + encode_name('admin.' + self.zone) + struct.pack('>IIIII', 1, 60, 60, 60, 60)
+        return encode_name(value)
+
+    def _rr(self, owner, rtype, value):
+        rdata = self._rdata(rtype, value)
+        return owner + struct.pack('>HHIH', rtype, 1, 60, len(rdata)) + rdata
+
+    def _serve(self):
+        while True:
+            try:
+                data, peer = self.sock.recvfrom(512)
+            except OSError:
+                return
+            qid = struct.unpack('>H', data[:2])[0]
+            name, off = decode_name(data, 12)
+            qtype = struct.unpack('>H', data[off:off + 2])[0]
+            question = data[12:off + 4]
+
+            # answers point back at the question name, like real servers do
+            answer = [self._rr(b'\xc0\x0c', qtype, v) for v in self.records.get((name, qtype), [])]
+            authority = []
+            if not answer:
+                authority = [self._rr(encode_name(self.zone), TYPE_SOA, 'ns1.' + self.zone)]
+
+            header = struct.pack('>HHHHHH', qid, 0x8400, 1, len(answer), len(authority), 0)
+            self.sock.sendto(header + question + b''.join(answer + authority), peer)
+
+
+@pytest.fixture
+def servers():
+    """ ns1 (127.0.0.1) doubles as the resolver, ns2 is on 127.0.0.2, same port
+    """
+    ns = {('example.com', TYPE_NS): ['ns1.example.com', 'ns2.example.com'],
+          ('ns1.example.com', TYPE_A): ['127.0.0.1'],
+          ('ns2.example.com', TYPE_A): ['127.0.0.2']}
+    ns1 = StubDns('127.0.0.1', records={**ns, ('hub.example.com', TYPE_A): [NEW_IP]})
+    try:
+        ns2 = StubDns('127.0.0.2', ns1.address[1], records={**ns, ('hub.example.com', TYPE_A): [OLD_IP]})
+    except OSError:
+        ns1.close()
+        pytest.skip('127.0.0.2 is not usable')
+
+    yield ns1, ns2
+    ns1.close()
+    ns2.close()
+
+
+def _opts(ns1, **kw):
+    cfg = dict(resolver='127.0.0.1:{}'.format(ns1.address[1]),
+               port=ns1.address[1],
+               timeout=0.5,
+               interval=0.05,
+               max_interval=0.1)
+    cfg.update(kw)
+    return {'dns_watch': cfg}
+
+
+def test_find_zone(servers):
+    ns1, _ = servers
+    expect = ('example.com', ['ns1.example.com', 'ns2.example.com'])
+    assert dnswatch.find_zone('hub.example.com', ns1.address, timeout=1) == expect
+    assert dnswatch.find_zone('example.com', ns1.address, timeout=1) == expect
+
+
+def test_authoritative_servers(servers):
+    ns1, _ = servers
+    port = ns1.address[1]
+    assert dnswatch.authoritative_servers('hub.example.com', ns1.address, port=port, timeout=1) == [
+        ('127.0.0.1', port), ('127.0.0.2', port)]
+
+
+def test_wait_until_all_servers_agree(servers):
+    ns1, ns2 = servers
+    timer = threading.Timer(0.3, lambda: ns2.records.update({('hub.example.com', TYPE_A): [NEW_IP]}))
+    timer.start()
+    try:
+        out = dnswatch.wait_for_records([('hub.example.com', NEW_IP)], _opts(ns1, quorum='all'), timeout=5)
+    finally:
+        timer.cancel()
+    assert out == {'hub.example.com': True}
+
+
+def test_wait_times_out_without_quorum(servers):
+    ns1, _ = servers
+    pairs = [('hub.example.com', NEW_IP)]
+    assert dnswatch.wait_for_records(pairs, _opts(ns1, quorum='all'), timeout=0.3) == {'hub.example.com': False}
+    assert dnswatch.wait_for_records(pairs, _opts(ns1, quorum=1), timeout=0.3) == {'hub.example.com': True}
+
+
+def test_query_timeout(servers):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))  # never answers
+    try:
+        with pytest.raises(dnswatch.DnsQueryError):
+            dnswatch.query_a(sock.getsockname(), 'hub.example.com', timeout=0.2)
+    finally:
+        sock.close()
@@ -0,0 +1,46 @@
+from pathlib import Path
+
+from jhubnginx import utils
+from jhubnginx._impl import HubsEdit, read_hubs
+
+
+def _opts(tmp_path):
+    return utils.default_opts({
+        'nginx': {'sites': str(tmp_path/'sites'),
+                  'ssl_root': str(tmp_path/'ssl'),
+                  'layout': 'consolidated'},
+        'state_dir': str(tmp_path/'state'),
+    })
+
+
+def _hub(domain, port):
+    return dict(ssl_dir=Path('/ssl')/domain,
+                backends=[dict(address='127.0.0.1:{}'.format(port), weight=1)])
+
+
+def test_rollback_keeps_entries_of_others(tmp_path):
+    opts = _opts(tmp_path)
+    HubsEdit(opts, update={'a.example.com': _hub('a.example.com', 8000)}).apply()
+
+    mine = HubsEdit(opts, update={'a.example.com': _hub('a.example.com', 9000),
+                                  'b.example.com': _hub('b.example.com', 8001)})
+    mine.apply()
+    HubsEdit(opts, update={'c.example.com': _hub('c.example.com', 8002)}).apply()
+
+    mine.rollback()
+
+    hubs = read_hubs(opts)
+    assert sorted(hubs) == ['a.example.com', 'c.example.com']
+    assert hubs['a.example.com'] == _hub('a.example.com', 8000)
+
+
+def test_rollback_of_removal_restores_entry(tmp_path):
+    opts = _opts(tmp_path)
+    HubsEdit(opts, update={'a.example.com': _hub('a.example.com', 8000)}).apply()
+
+    change = HubsEdit(opts, remove=['a.example.com'])
+    change.apply()
+    assert read_hubs(opts) == {}
+
+    change.rollback()
+    assert read_hubs(opts) == {'a.example.com': _hub('a.example.com', 8000)}
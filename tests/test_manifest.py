@@ -0,0 +1,30 @@
+import copy
+
+from jhubnginx import utils, manifest
+
+
+def test_inputs_hash_ignores_options_not_in_config():
+    opts = utils.default_opts()
+    h = manifest.inputs_hash(opts, hub_ip='127.0.0.1', hub_port='8000')
+
+    other = copy.deepcopy(opts)
+    other['letsencrypt']['email'] = 'someone@example.com'
+    other['timing'] = dict(jsonl='/tmp/timing.jsonl')
+    other['locks'] = dict(timeout=1)
+    other['public_ip'] = dict(cache_ttl=0)
+    assert manifest.inputs_hash(other, hub_ip='127.0.0.1', hub_port='8000') == h
+
+
+def test_inputs_hash_tracks_rendered_options():
+    opts = utils.default_opts()
+    h = manifest.inputs_hash(opts, hub_ip='127.0.0.1', hub_port='8000')
+
+    other = copy.deepcopy(opts)
+    other['nginx']['compression']['level'] = 9
+    assert manifest.inputs_hash(other, hub_ip='127.0.0.1', hub_port='8000') != h
+
+    other = copy.deepcopy(opts)
+    other['letsencrypt']['webroot'] = '/srv/acme'
+    assert manifest.inputs_hash(other, hub_ip='127.0.0.1', hub_port='8000') != h
+
+    assert manifest.inputs_hash(opts, hub_ip='127.0.0.1', hub_port='8001') != h
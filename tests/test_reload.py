@@ -0,0 +1,159 @@
+import contextlib
+import os
+import threading
+
+import pytest
+
+from jhubnginx.reload import ReloadScheduler, ConfigChange, ConfigWrite
+from jhubnginx.locks import FileLock
+from jhubnginx.utils import JhubNginxError
+
+# fails mentioning the file while it contains BAD, like `nginx -t` does
+CHECK = 'if grep -q BAD {0}; then echo "nginx: [emerg] unknown directive in {0}:1"; exit 1; fi'
+
+
+def _write(path, txt):
+    with open(str(path), 'w') as f:
+        f.write(txt)
+
+
+def _slurp(path):
+    with open(str(path)) as f:
+        return f.read()
+
+
+def _submit_in_thread(scheduler, changes=(), timeout=5):
+    out = {}
+
+    def run():
+        try:
+            out['result'] = scheduler.submit(list(changes))
+        except Exception as e:
+            out['error'] = e
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    t.join(timeout)
+    assert not t.is_alive(), 'submit() is stuck'
+    return out
+
+
+def test_reload_ok(tmp_path):
+    marker = tmp_path/'reloaded'
+    s = ReloadScheduler('true', 'touch {}'.format(marker))
+    assert s.submit([]) == {}
+    assert marker.exists()
+
+
+def test_rollback_rejected_file(tmp_path):
+    good, bad = tmp_path/'good.conf', tmp_path/'bad.conf'
+    _write(good, 'fine')
+    _write(bad, 'BAD')
+    s = ReloadScheduler(CHECK.format(bad), 'true')
+
+    rejected = s.submit([ConfigChange(good, None), ConfigChange(bad, 'previous')])
+
+    assert list(rejected) == [os.path.abspath(str(bad))]
+    assert _slurp(bad) == 'previous'
+    assert _slurp(good) == 'fine'
+
+
+def test_rollback_of_new_file_removes_it(tmp_path):
+    bad = tmp_path/'bad.conf'
+    _write(bad, 'BAD')
+    s = ReloadScheduler(CHECK.format(bad), 'true')
+
+    assert os.path.abspath(str(bad)) in s.submit([ConfigChange(bad, None)])
+    assert not bad.exists()
+
+
+def test_check_failure_not_naming_a_file(tmp_path):
+    s = ReloadScheduler('echo broken; exit 1', 'true')
+    with pytest.raises(JhubNginxError):
+        s.submit([ConfigChange(tmp_path/'x.conf', None)])
+
+    # scheduler is still usable
+    s._check_cmd = 'true'
+    assert _submit_in_thread(s) == {'result': {}}
+
+
+def test_reload_failure(tmp_path):
+    s = ReloadScheduler('true', 'exit 1')
+    with pytest.raises(JhubNginxError):
+        s.submit([])
+
+
+class _BrokenRollback(ConfigChange):
+    def rollback(self):
+        raise OSError('disk on fire')
+
+
+def test_rollback_error_is_reported_and_does_not_wedge(tmp_path):
+    bad = tmp_path/'bad.conf'
+    _write(bad, 'BAD')
+    s = ReloadScheduler(CHECK.format(bad), 'true')
+
+    out = _submit_in_thread(s, [_BrokenRollback(bad, 'previous')])
+    assert isinstance(out.get('error'), JhubNginxError)
+    assert 'disk on fire' in str(out['error'])
+
+    _write(bad, 'fixed')
+    assert _submit_in_thread(s) == {'result': {}}
+
+
+def test_lock_error_is_reported_to_all_callers(tmp_path):
+    def broken_lock():
+        raise OSError('no space left')
+
+    s = ReloadScheduler('true', 'true', lock=broken_lock)
+    out = _submit_in_thread(s)
+    assert isinstance(out.get('error'), JhubNginxError)
+
+    s._reload_lock = contextlib.nullcontext
+    assert _submit_in_thread(s) == {'result': {}}
+
+
+def test_config_write_rejected_restores_previous(tmp_path):
+    good, bad = tmp_path/'sites'/'good.conf', tmp_path/'sites'/'bad.conf'
+    s = ReloadScheduler(CHECK.format(bad), 'true')
+    bad.parent.mkdir()
+    _write(bad, 'previous')
+
+    rejected = s.submit([ConfigWrite(good, 'fine'), ConfigWrite(bad, 'BAD')])
+
+    assert list(rejected) == [os.path.abspath(str(bad))]
+    assert _slurp(bad) == 'previous'
+    assert _slurp(good) == 'fine'
+
+
+def test_config_written_only_under_reload_lock(tmp_path):
+    path = tmp_path/'new.conf'
+    held = FileLock(tmp_path/'reload.lock')
+    s = ReloadScheduler('true', 'true', lock=lambda: FileLock(tmp_path/'reload.lock', timeout=5))
+
+    with held:
+        t = threading.Thread(target=s.submit, args=([ConfigWrite(path, 'txt')],), daemon=True)
+        t.start()
+        t.join(0.5)
+        assert t.is_alive()
+        assert not path.exists()  # other process checking config never sees it
+
+    t.join(5)
+    assert not t.is_alive()
+    assert _slurp(path) == 'txt'
+
+
+def test_unattributed_failure_rolls_back_whole_batch(tmp_path):
+    sites = tmp_path/'sites'
+    sites.mkdir()
+    old, new = sites/'old.conf', sites/'new.conf'
+    _write(old, 'previous')
+    # fails like a missing certificate does: no file:line of a changed config
+    check = 'if grep -q BAD {}/*.conf; then echo "nginx: [emerg] cannot load certificate"; exit 1; fi'.format(sites)
+    s = ReloadScheduler(check, 'true')
+
+    with pytest.raises(JhubNginxError, match='cannot load certificate'):
+        s.submit([ConfigWrite(old, 'BAD'), ConfigWrite(new, 'BAD')])
+
+    assert _slurp(old) == 'previous'
+    assert not new.exists()
@@ -0,0 +1,101 @@
+import copy
+import datetime
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+from cryptography import x509  # noqa: E402
+from cryptography.hazmat.primitives import hashes, serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import ec  # noqa: E402
+from cryptography.x509.oid import NameOID  # noqa: E402
+
+from jhubnginx import _impl  # noqa: E402
+from jhubnginx._impl import apply_hubs, certificate_inventory, parse_desired, renew_certificates  # noqa: E402
+
+NOW = 1700000000
+DAY = 24*60*60
+# domain -> seconds between certificate expiry and renewal threshold (30 days from NOW)
+EXPIRY = {'before.example.com': -1,
+          'at.example.com': 0,
+          'after.example.com': 1}
+
+
+def _write_cert(path, names, not_after):
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, names[0])])
+    utc = datetime.timezone.utc
+    cert = (x509.CertificateBuilder()
+            .subject_name(name).issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(datetime.datetime.fromtimestamp(NOW - 60*DAY, utc))
+            .not_valid_after(datetime.datetime.fromtimestamp(not_after, utc))
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName(n) for n in names]), critical=False)
+            .sign(key, hashes.SHA256()))
+    path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+
+
+@pytest.fixture
+def certs(sandbox, tmp_path, monkeypatch):
+    """ One vhost per EXPIRY entry with a certificate expiring relative to
+        the 30 day threshold, and one whose certificate can not be read
+    """
+    hubs = sorted(EXPIRY) + ['broken.example.com']
+    plan = apply_hubs(parse_desired(dict(hubs=hubs)), copy.deepcopy(sandbox), skip_dns_check=True)
+    assert plan['failed'] == {}
+
+    for domain, delta in EXPIRY.items():
+        _write_cert(tmp_path/'ssl'/domain/'cert.pem', [domain], NOW + 30*DAY + delta)
+
+    monkeypatch.setattr(_impl, 'time', SimpleNamespace(time=lambda: NOW, sleep=time.sleep))
+    return sandbox
+
+
+def test_certificate_inventory(certs, tmp_path):
+    inventory = {c['domains'][0]: c for c in certificate_inventory(certs)}
+
+    assert sorted(inventory) == sorted(list(EXPIRY) + ['broken.example.com'])
+    for domain, delta in EXPIRY.items():
+        c = inventory[domain]
+        assert c['ssl_dir'] == str(tmp_path/'ssl'/domain)
+        assert c['domains'] == [domain]
+        assert c['names'] == [domain]
+        assert c['not_after'] == NOW + 30*DAY + delta
+
+    assert inventory['broken.example.com']['names'] is None
+    assert inventory['broken.example.com']['not_after'] is None
+
+
+def test_renew_threshold_dry_run(certs, tmp_path, certbot_log):
+    issued = len(certbot_log())
+    due = renew_certificates(copy.deepcopy(certs), renew_before_days=30, dry_run=True)
+
+    ssl = tmp_path/'ssl'
+    assert sorted(due) == sorted(str(ssl/d) for d in ['at.example.com', 'before.example.com', 'broken.example.com'])
+    assert len(certbot_log()) == issued
+
+
+def test_renew_threshold_from_config(certs, tmp_path):
+    opts = copy.deepcopy(certs)
+    opts['letsencrypt']['renew_before_days'] = 31
+    assert len(renew_certificates(opts, dry_run=True)) == 4
+
+    opts['letsencrypt']['renew_before_days'] = 29
+    assert list(renew_certificates(opts, dry_run=True)) == [str(tmp_path/'ssl'/'broken.example.com')]
+
+
+def test_renew_runs_certbot_for_due_only(certs, tmp_path, certbot_log):
+    issued = len(certbot_log())
+    result = renew_certificates(copy.deepcopy(certs), domains=sorted(EXPIRY), renew_before_days=30)
+
+    ssl = tmp_path/'ssl'
+    assert result == {str(ssl/'before.example.com'): None, str(ssl/'at.example.com'): None}
+
+    runs = certbot_log()[issued:]
+    assert sorted(argv[argv.index('--cert-name') + 1] for argv in runs) == ['at.example.com',
+                                                                            'before.example.com']
+    for argv in runs:
+        assert '--force-renewal' in argv
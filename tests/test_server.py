@@ -0,0 +1,66 @@
+import threading
+
+from jhubnginx import utils
+from jhubnginx.server import VhostDaemon
+
+
+class _Daemon(VhostDaemon):
+    def cmd_boom(self):
+        print('about to fail')
+        raise KeyError('missing')
+
+
+def test_unexpected_error_is_returned():
+    d = _Daemon(utils.default_opts())
+    resp = d.dispatch(dict(cmd='boom'))
+    assert resp['ok'] is False
+    assert 'KeyError' in resp['error']
+    assert resp['output'] == 'about to fail\n'
+
+    # daemon still serves requests
+    assert d.dispatch(dict(cmd='status', args={'bad': 1}))['ok'] is False
+
+
+def test_http_session_is_shared_between_threads():
+    sessions = []
+    threads = [threading.Thread(target=lambda: sessions.append(utils.http_session())) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(set(map(id, sessions + [utils.http_session()]))) == 1
+
+
+class _SlowDaemon(VhostDaemon):
+    def __init__(self, opts):
+        VhostDaemon.__init__(self, opts)
+        self.barrier = threading.Barrier(2, timeout=5)
+
+    def cmd_slow(self, name):
+        from concurrent.futures import ThreadPoolExecutor
+
+        print('start', name)
+        self.barrier.wait()  # both requests are running at the same time
+        with ThreadPoolExecutor(2) as pool:
+            pool.submit(utils.same_output(print), 'worker', name).result()
+        print('end', name)
+        return name
+
+
+def test_requests_run_concurrently_with_own_output():
+    d = _SlowDaemon(utils.default_opts())
+    out = {}
+
+    def run(name):
+        out[name] = d.dispatch(dict(cmd='slow', args=dict(name=name)))
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in ('a', 'b')]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(10)
+
+    for name in ('a', 'b'):
+        assert out[name]['ok'], out[name]['error']
+        assert out[name]['output'] == 'start {0}\nworker {0}\nend {0}\n'.format(name)
@@ -0,0 +1,115 @@
+import pytest
+
+from jhubnginx.stats import QuantileSketch, parse_line, route_class, follow_lines
+
+
+def _line(uri='/hub/api/users', status='200', upgrade='', request_time='0.010',
+          connect='0.001', response='0.009'):
+    return '\t'.join(['1700000000.123', 'hub.example.com', 'GET', uri, status, upgrade,
+                      request_time, connect, response, '512']) + '\n'
+
+
+@pytest.mark.parametrize('q', [0.5, 0.9, 0.99])
+def test_quantile_within_relative_accuracy(q):
+    sketch = QuantileSketch(relative_accuracy=0.01)
+    values = [i/1000 for i in range(1, 10001)]
+    for v in values:
+        sketch.add(v)
+
+    expect = values[int(q*(len(values) - 1))]
+    assert sketch.quantile(q) == pytest.approx(expect, rel=0.01)
+
+
+def test_quantile_empty_and_zeros():
+    sketch = QuantileSketch()
+    assert sketch.quantile(0.5) is None
+
+    for v in [0, 0, 0, 1.0]:
+        sketch.add(v)
+    assert sketch.quantile(0.5) == 0.0
+    assert sketch.quantile(1) == pytest.approx(1.0, rel=0.01)
+
+
+def test_quantile_merge():
+    a, b, both = QuantileSketch(), QuantileSketch(), QuantileSketch()
+    for i in range(1, 101):
+        (a if i % 2 else b).add(i)
+        both.add(i)
+
+    a.merge(b)
+    assert a.count == 100
+    assert a.quantile(0.9) == both.quantile(0.9)
+
+
+def test_parse_line():
+    r = parse_line(_line())
+    assert r['host'] == 'hub.example.com'
+    assert r['status'] == 200
+    assert r['request_time'] == 0.010
+    assert r['connect_time'] == 0.001
+    assert r['response_time'] == 0.009
+
+
+def test_parse_line_websocket():
+    r = parse_line(_line(uri='/user/kirill/api/kernels/abc/channels', status='101',
+                         upgrade='websocket', request_time='3600.000'))
+    assert r['status'] == 101
+    assert r['upgrade'] == 'websocket'
+    assert route_class(r['uri'], r['upgrade']) == 'websocket'
+
+
+def test_parse_line_without_upstream():
+    r = parse_line(_line(status='404', connect='-', response='-'))
+    assert r['status'] == 404
+    assert r['connect_time'] == 0
+    assert r['response_time'] == 0
+
+
+def test_parse_line_upstream_retries():
+    r = parse_line(_line(connect='0.001, 0.002', response='0.5 : 0.25'))
+    assert r['connect_time'] == pytest.approx(0.003)
+    assert r['response_time'] == pytest.approx(0.75)
+
+
+def test_parse_line_tab_in_uri():
+    r = parse_line(_line(uri='/hub/a\tb'))
+    assert r['uri'] == '/hub/a\tb'
+    assert r['status'] == 200
+
+
+@pytest.mark.parametrize('line', ['', 'garbage\n', _line(status='abc')])
+def test_parse_line_malformed(line):
+    assert parse_line(line) is None
+
+
+@pytest.mark.parametrize('uri, upgrade, expect', [
+    ('/hub/static/js/main.js', '', 'static'),
+    ('/static/favicon.ico', '', 'static'),
+    ('/user/kirill/static/style.css', '', 'static'),
+    ('/user/kirill/lab/static/bundle.js', '', 'static'),
+    ('/user/kirill/nbextensions/x.js', '-', 'static'),
+    ('/hub/api/users', '', 'api'),
+    ('/user/kirill/api/contents', '-', 'api'),
+    ('/user/kirill/api/kernels/abc/channels', '', 'websocket'),
+    ('/user/kirill/terminals/websocket/1', '', 'websocket'),
+    ('/user/kirill/anything', 'websocket', 'websocket'),
+    ('/hub/login', '', 'page'),
+    ('/user/kirill/lab', '-', 'page'),
+])
+def test_route_class(uri, upgrade, expect):
+    assert route_class(uri, upgrade) == expect
+
+
+def test_follow_lines_multibyte_split_across_writes(tmp_path):
+    log = tmp_path/'hub.access.log'
+    line = _line(uri='/user/кирилл/api/contents').encode('utf-8')
+    cut = line.index('и'.encode('utf-8')) + 1  # middle of two byte character
+    log.write_bytes(line[:cut])
+
+    lines = follow_lines([str(log)], follow=True, poll=0)
+    assert next(lines) is None
+
+    with open(str(log), 'ab') as f:
+        f.write(line[cut:])
+    assert next(lines) == line.decode('utf-8')
+    assert next(lines) is None
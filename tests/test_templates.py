@@ -0,0 +1,107 @@
+import re
+from pathlib import Path
+
+import pytest
+
+from jhubnginx import utils
+from jhubnginx.utils import JhubNginxError
+from jhubnginx._impl import (template_env, render_vhost, render_hubs, parse_backend, backend_list,
+                             NGINX_HTTP_MARKER)
+
+
+def _opts(**tls):
+    opts = utils.default_opts()
+    opts['nginx']['tls'].update(tls)
+    return opts
+
+
+def _hubs(*domains):
+    return {d: dict(ssl_dir=Path('/ssl')/d, backends=[dict(address='127.0.0.1:8000', weight=1)])
+            for d in domains}
+
+
+def test_quic_reuseport_declared_once():
+    opts = _opts(http3=True)
+    configs = [template_env(opts).get_template('http.conf').render(header=NGINX_HTTP_MARKER, **opts),
+               render_vhost('a.example.com', opts),
+               render_vhost('b.example.com', opts),
+               render_hubs(_hubs('c.example.com', 'd.example.com'), opts)]
+    txt = '\n'.join(configs)
+
+    assert txt.count('quic reuseport;') == 1
+    assert txt.count('listen 443 quic') == 4
+
+
+def test_no_quic_without_http3():
+    opts = _opts(http3=False)
+    txt = template_env(opts).get_template('http.conf').render(header=NGINX_HTTP_MARKER, **opts)
+    assert 'quic' not in txt
+
+
+def _upstreams(txt):
+    """ upstream name -> lines inside its block
+    """
+    return {m.group(1): [line.strip() for line in m.group(2).strip().splitlines()]
+            for m in re.finditer(r'^upstream (\S+) \{\n(.*?)^\}', txt, re.M | re.S)}
+
+
+@pytest.mark.parametrize('txt, address, weight', [
+    ('127.0.0.1:8000', '127.0.0.1:8000', 1),
+    ('10.0.0.5', '10.0.0.5:8081', 1),
+    ('hub.internal:9000@3', 'hub.internal:9000', 3),
+    ('hub.internal@2', 'hub.internal:8081', 2),
+    (' 10.0.0.6:8000 ', '10.0.0.6:8000', 1),
+    ('[::1]:8000', '[::1]:8000', 1),
+    ('[::1]', '[::1]:8081', 1),
+    ('unix:/run/jupyterhub.sock', 'unix:/run/jupyterhub.sock', 1),
+    ('unix:/run/jupyterhub.sock@5', 'unix:/run/jupyterhub.sock', 5),
+])
+def test_parse_backend(txt, address, weight):
+    assert parse_backend(txt, default_port=8081) == dict(address=address, weight=weight)
+
+
+@pytest.mark.parametrize('txt', ['', '@2', '10.0.0.5@0', '10.0.0.5@-1', '10.0.0.5@heavy'])
+def test_parse_backend_rejects(txt):
+    with pytest.raises(JhubNginxError):
+        parse_backend(txt)
+
+
+def test_backend_list_defaults_to_hub_address():
+    assert backend_list(None, '10.0.0.5', 8081) == [dict(address='10.0.0.5:8081', weight=1)]
+    assert backend_list(['10.0.0.6', 'unix:/s.sock@2'], hub_port=8081) == [
+        dict(address='10.0.0.6:8081', weight=1),
+        dict(address='unix:/s.sock', weight=2)]
+
+
+def test_upstream_multiple_servers():
+    opts = utils.default_opts()
+    txt = render_vhost('a.example.com', opts,
+                       backends=['10.0.0.5:8000@3', '10.0.0.6:8000', 'unix:/run/hub.sock@2'])
+
+    assert _upstreams(txt)['jhub-a.example.com'] == [
+        'server 10.0.0.5:8000 weight=3 max_fails=3 fail_timeout=10s;',
+        'server 10.0.0.6:8000 max_fails=3 fail_timeout=10s;',
+        'server unix:/run/hub.sock weight=2 max_fails=3 fail_timeout=10s;',
+        'keepalive 32;',
+        'keepalive_timeout 60s;']
+    assert 'proxy_pass http://jhub-a.example.com' in txt
+
+
+def test_upstream_method_and_no_keepalive():
+    opts = utils.default_opts()
+    opts['nginx']['upstream'].update(method='least_conn', keepalive=0)
+    txt = render_vhost('a.example.com', opts, hub_ip='10.0.0.5', hub_port=8081)
+
+    assert _upstreams(txt)['jhub-a.example.com'] == [
+        'least_conn;',
+        'server 10.0.0.5:8081 max_fails=3 fail_timeout=10s;']
+
+
+def test_upstream_per_hub_in_consolidated_config():
+    opts = utils.default_opts()
+    hubs = _hubs('a.example.com', 'b.example.com')
+    hubs['b.example.com']['backends'] = [parse_backend('unix:/run/b.sock@4')]
+    upstreams = _upstreams(render_hubs(hubs, opts))
+
+    assert upstreams['jhub-a.example.com'][0] == 'server 127.0.0.1:8000 max_fails=3 fail_timeout=10s;'
+    assert upstreams['jhub-b.example.com'][0] == 'server unix:/run/b.sock weight=4 max_fails=3 fail_timeout=10s;'
@@ -0,0 +1,24 @@
+import multiprocessing
+
+from jhubnginx.timing import PrometheusSink
+
+
+def _record(path, n):
+    sink = PrometheusSink(path)
+    for _ in range(n):
+        sink(dict(name='certbot', seconds=0.5, ok=True))
+
+
+def test_prometheus_totals_from_concurrent_processes(tmp_path):
+    path = str(tmp_path/'jhub.prom')
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=_record, args=(path, 25)) for _ in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(30)
+        assert p.exitcode == 0
+
+    stats = PrometheusSink(path)._load()
+    assert stats['certbot']['seconds_count'] == 100
+    assert stats['certbot']['seconds_sum'] == 50